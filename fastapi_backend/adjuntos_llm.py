@@ -0,0 +1,260 @@
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+try:
+    import pymupdf
+except ImportError:  # pragma: no cover - versiones antiguas de PyMuPDF
+    try:
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+
+logger = logging.getLogger(__name__)
+
+# Cómo se envían los PDF adjuntos: base64 (en el mensaje, codificado una sola vez) o
+# azure_files (subidos una vez a la API de archivos y referenciados por id)
+MODO_ADJUNTOS = os.getenv("MODO_ADJUNTOS", "base64").strip().lower()
+# Memoria máxima para los adjuntos preparados (base64 o ids), en MB
+ADJUNTOS_CACHE_MB = int(os.getenv("ADJUNTOS_CACHE_MB", "256") or 256)
+# Adelgazar los PDF antes de adjuntarlos (imágenes reducidas, fuentes recortadas, objetos sin uso fuera)
+ADELGAZAR_PDF = os.getenv("ADELGAZAR_PDF", "false").strip().lower() in {"1", "true", "si", "sí", "yes"}
+# Resolución y calidad JPEG de las imágenes de los PDF adelgazados
+DPI_IMAGENES_ADJUNTOS = int(os.getenv("DPI_IMAGENES_ADJUNTOS", "150") or 150)
+CALIDAD_IMAGENES_ADJUNTOS = int(os.getenv("CALIDAD_IMAGENES_ADJUNTOS", "75") or 75)
+
+
+def adelgazar_pdf(contenido: bytes) -> bytes:
+    """
+    Versión reducida del PDF: imágenes por encima de ``DPI_IMAGENES_ADJUNTOS`` remuestreadas,
+    fuentes recortadas a los glifos usados y objetos sin referencias eliminados.
+
+    No se linealiza: MuPDF dejó de admitirlo en la 1.26 (``linear=True`` falla) y solo sirve
+    para mostrar la primera página antes de descargar el resto, no para un PDF que se envía
+    entero al modelo.
+    """
+    if pymupdf is None:
+        raise RuntimeError("PyMuPDF es requerido para adelgazar PDF")
+
+    documento = pymupdf.open(stream=contenido, filetype="pdf")
+    try:
+        try:
+            # Solo las imágenes claramente por encima del objetivo: recomprimir las demás apenas ahorra
+            documento.rewrite_images(
+                dpi_threshold=int(DPI_IMAGENES_ADJUNTOS * 1.5),
+                dpi_target=DPI_IMAGENES_ADJUNTOS,
+                quality=CALIDAD_IMAGENES_ADJUNTOS,
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudieron reducir las imágenes del PDF: {e}")
+        try:
+            documento.subset_fonts()
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudieron recortar las fuentes del PDF: {e}")
+        return documento.tobytes(
+            garbage=4,
+            clean=True,
+            deflate=True,
+            deflate_images=True,
+            deflate_fonts=True,
+            use_objstms=True,
+        )
+    finally:
+        documento.close()
+
+
+# Recortes por páginas ya construidos: (sha256, páginas) -> PDF
+MAX_RECORTES_EN_MEMORIA = 64
+_recortes: "OrderedDict[Tuple[str, Tuple[int, ...]], bytes]" = OrderedDict()
+_recortes_lock = threading.Lock()
+
+
+def recortar_pdf(sha256: str, contenido: bytes, paginas: Tuple[int, ...]) -> bytes:
+    """
+    PDF con solo ``paginas`` (numeradas desde 1) del original. Se memoriza por documento y
+    páginas: las preguntas que eligen las mismas páginas reciben los mismos bytes, así el
+    ``AlmacenAdjuntos`` reutiliza su bloque.
+    """
+    if pymupdf is None:
+        raise RuntimeError("PyMuPDF es requerido para recortar PDF")
+
+    clave = (sha256, tuple(paginas))
+    with _recortes_lock:
+        if clave in _recortes:
+            _recortes.move_to_end(clave)
+            return _recortes[clave]
+
+    original = pymupdf.open(stream=contenido, filetype="pdf")
+    recorte = pymupdf.open()
+    try:
+        for pagina in paginas:
+            if 1 <= pagina <= original.page_count:
+                recorte.insert_pdf(original, from_page=pagina - 1, to_page=pagina - 1)
+        resultado = recorte.tobytes(garbage=3, deflate=True, no_new_id=True)
+    finally:
+        recorte.close()
+        original.close()
+
+    with _recortes_lock:
+        _recortes[clave] = resultado
+        while len(_recortes) > MAX_RECORTES_EN_MEMORIA:
+            _recortes.popitem(last=False)
+    return resultado
+
+
+class AdelgazadorPdf:
+    """
+    ``adelgazar_pdf`` con el resultado en disco por SHA-256 del original y parámetros de las
+    imágenes: cambiar ``DPI_IMAGENES_ADJUNTOS`` o ``CALIDAD_IMAGENES_ADJUNTOS`` genera otra versión.
+    """
+
+    def __init__(self, directorio: Path):
+        self.directorio = Path(directorio)
+        self._lock = threading.Lock()
+        self.bytes_originales = 0
+        self.bytes_adelgazados = 0
+
+    def __call__(self, sha256: str, contenido: bytes) -> bytes:
+        cache_path = self.directorio / f"{sha256}-{DPI_IMAGENES_ADJUNTOS}dpi-q{CALIDAD_IMAGENES_ADJUNTOS}.pdf"
+        if cache_path.exists():
+            adelgazado = cache_path.read_bytes()
+        else:
+            try:
+                adelgazado = adelgazar_pdf(contenido)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo adelgazar el PDF ({sha256[:12]}), se envía el original: {e}")
+                return contenido
+            # Si no reduce nada se guarda el original para no volver a intentarlo
+            if len(adelgazado) >= len(contenido):
+                adelgazado = contenido
+            tmp_path = None
+            try:
+                # Temporal propio: dos análisis del mismo PDF pueden guardarlo a la vez
+                self.directorio.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    "wb", dir=self.directorio, prefix=f"{cache_path.stem}.", suffix=".pdf.tmp", delete=False
+                ) as f:
+                    tmp_path = Path(f.name)
+                    f.write(adelgazado)
+                os.replace(tmp_path, cache_path)
+            except Exception as e:
+                if tmp_path is not None:
+                    tmp_path.unlink(missing_ok=True)
+                logger.warning(f"⚠️ No se pudo guardar el PDF adelgazado en caché: {e}")
+            logger.info(
+                f"🗜️ PDF adelgazado ({sha256[:12]}): {len(contenido) / 1e6:.2f} MB → "
+                f"{len(adelgazado) / 1e6:.2f} MB (-{(1 - len(adelgazado) / max(1, len(contenido))) * 100:.0f}%)"
+            )
+        with self._lock:
+            self.bytes_originales += len(contenido)
+            self.bytes_adelgazados += len(adelgazado)
+        return adelgazado
+
+
+class AlmacenAdjuntos:
+    """
+    Bloques de contenido de los PDF adjuntos, preparados una vez por documento.
+
+    Con ``subir`` cada PDF se sube una sola vez a cada ``destino`` (el recurso del proveedor
+    que atenderá la llamada: un id de archivo solo existe donde se subió) y las preguntas lo
+    referencian por id; sin él se codifica en base64 una sola vez. Con ``adelgazar`` se
+    envía antes la versión reducida del PDF. Los bloques se guardan por SHA-256 del
+    contenido y destino hasta ``max_bytes`` (se descartan los menos usados).
+    """
+
+    def __init__(
+        self,
+        subir: Optional[Callable[[str, bytes, Hashable], str]] = None,
+        max_bytes: int = 256 * 1024 * 1024,
+        adelgazar: Optional[AdelgazadorPdf] = None,
+    ):
+        self.subir = subir
+        self.adelgazar = adelgazar
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._locks_documento: Dict[Tuple[str, Hashable], threading.Lock] = {}
+        self._bloques: "OrderedDict[Tuple[str, Hashable], Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self.preparados = 0
+        self.reutilizados = 0
+
+    def _guardar(self, clave: Tuple[str, Hashable], bloque: Dict[str, Any]):
+        tamano = len(bloque.get("data") or "")
+        with self._lock:
+            self._bloques[clave] = bloque
+            self._bytes += tamano
+            while self._bytes > self.max_bytes and len(self._bloques) > 1:
+                _, descartado = self._bloques.popitem(last=False)
+                self._bytes -= len(descartado.get("data") or "")
+
+    def _preparar(self, sha256: str, nombre: str, contenido: bytes, destino: Hashable) -> Dict[str, Any]:
+        if self.adelgazar is not None:
+            contenido = self.adelgazar(sha256, contenido)
+        if self.subir is not None:
+            try:
+                id_archivo = self.subir(nombre, contenido, destino)
+                logger.info(f"📤 Adjunto {nombre} subido al proveedor ({id_archivo})")
+                return {"type": "file", "source_type": "id", "id": id_archivo}
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo subir {nombre} al proveedor, se enviará en base64: {e}")
+        return {
+            "type": "file",
+            "source_type": "base64",
+            "data": base64.b64encode(contenido).decode("utf-8"),
+            "mime_type": "application/pdf",
+            "filename": nombre,
+        }
+
+    def bloque(self, nombre: str, contenido: bytes, destino: Hashable = None) -> Dict[str, Any]:
+        """
+        Bloque ``file`` del mensaje para el PDF (el mismo objeto para todas las preguntas que
+        van al mismo ``destino``; sin ``subir`` el destino no importa).
+        """
+        sha256 = hashlib.sha256(contenido).hexdigest()
+        clave = (sha256, destino if self.subir is not None else None)
+        with self._lock:
+            lock_documento = self._locks_documento.setdefault(clave, threading.Lock())
+
+        # Un lock por documento y destino: dos análisis del mismo PDF no lo suben dos veces
+        with lock_documento:
+            with self._lock:
+                bloque = self._bloques.get(clave)
+                if bloque is not None:
+                    self._bloques.move_to_end(clave)
+                    self.reutilizados += 1
+                    return bloque
+            bloque = self._preparar(sha256, nombre, contenido, clave[1])
+            self._guardar(clave, bloque)
+            with self._lock:
+                self.preparados += 1
+                self._locks_documento.pop(clave, None)
+            return bloque
+
+    def olvidar(self, contenido: bytes):
+        """Descarta los bloques de un PDF en todos los destinos (p. ej. si el proveedor ya no reconoce su id)."""
+        sha256 = hashlib.sha256(contenido).hexdigest()
+        with self._lock:
+            for clave in [c for c in self._bloques if c[0] == sha256]:
+                bloque = self._bloques.pop(clave)
+                self._bytes -= len(bloque.get("data") or "")
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            resumen = {
+                "modo": "referencias" if self.subir is not None else "base64",
+                "documentos": len({sha256 for sha256, _ in self._bloques}),
+                "bloques": len(self._bloques),
+                "mb_en_memoria": round(self._bytes / 1e6, 1),
+                "preparados": self.preparados,
+                "reutilizados": self.reutilizados,
+            }
+        if self.adelgazar is not None:
+            resumen["mb_originales"] = round(self.adelgazar.bytes_originales / 1e6, 2)
+            resumen["mb_adelgazados"] = round(self.adelgazar.bytes_adelgazados / 1e6, 2)
+        return resumen
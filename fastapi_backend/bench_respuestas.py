@@ -0,0 +1,155 @@
+"""
+Benchmark de la respuesta de /estado: serialización, bytes enviados y endpoint completo.
+
+Compara el camino anterior (saneado recursivo + ``jsonable_encoder`` de FastAPI + encoder
+JSON estándar, sin compresión) con el actual (``RespuestaJSON`` con orjson + gzip/brotli),
+y después mide ``GET /estado`` de punta a punta con ``TestClient``: el handler actual de
+``main`` frente a una copia del anterior que devolvía un dict saneado. Por defecto usa el
+mayor archivo de progreso disponible, replicando sus resultados hasta el tamaño típico de
+un análisis completo.
+
+Uso:
+    python bench_respuestas.py [ruta_progreso.json] [--iteraciones N] [--kb OBJETIVO]
+"""
+import argparse
+import gzip
+import json
+import time
+import uuid
+from pathlib import Path
+
+from fastapi.encoders import jsonable_encoder
+
+from respuestas import RespuestaJSON, _sanitize_json_for_response, orjson, brotli
+
+PROGRESO_DIR = Path(__file__).resolve().parent / "progreso"
+
+
+def _cargar_payload(ruta: Path, objetivo_kb: int) -> dict:
+    with open(ruta, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    resultados = data.get("resultados") or []
+    if resultados:
+        base = list(resultados)
+        while len(json.dumps(data, ensure_ascii=False).encode("utf-8")) < objetivo_kb * 1024:
+            data["resultados"].extend(dict(r) for r in base)
+    return data
+
+
+def _medir(funcion, iteraciones: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(iteraciones):
+        funcion()
+    return (time.perf_counter() - inicio) / iteraciones * 1000
+
+
+def _serializar_stdlib(data: dict) -> bytes:
+    # Lo que hacía FastAPI con el dict saneado que devolvía el handler: jsonable_encoder
+    # recorre todo el payload y JSONResponse.render lo escribe con el encoder estándar
+    return json.dumps(
+        jsonable_encoder(_sanitize_json_for_response(data)),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _serializar_orjson(data: dict) -> bytes:
+    # Respuesta construida en el handler: sin jsonable_encoder
+    return RespuestaJSON(data).body
+
+
+def _app_anterior(progreso_dir: Path):
+    """Copia mínima del handler anterior de /estado: devolvía un dict saneado."""
+    from fastapi import FastAPI
+
+    app = FastAPI()
+
+    @app.get("/estado/{id_analisis}")
+    def obtener_estado(id_analisis: str):
+        with open(progreso_dir / f"{id_analisis}.json", "r", encoding="utf-8") as f:
+            data = json.load(f)
+        progreso = data.get("progreso", 0)
+        total = data.get("total_preguntas", 1)
+        data["porcentaje"] = round((progreso / total) * 100, 1) if total > 0 else 0
+        return _sanitize_json_for_response(data)
+
+    return app
+
+
+def _medir_endpoint(data: dict, iteraciones: int):
+    """``GET /estado`` con TestClient (sin compresión) contra un progreso temporal."""
+    import logging
+
+    from fastapi.testclient import TestClient
+
+    import main
+
+    logging.disable(logging.INFO)
+    id_analisis = f"bench-{uuid.uuid4()}"
+    ruta = main.PROGRESO_DIR / f"{id_analisis}.json"
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    cabeceras = {"Accept-Encoding": "identity"}
+    try:
+        filas = []
+        for nombre, app in (("antes: dict saneado", _app_anterior(main.PROGRESO_DIR)), ("actual: main", main.app)):
+            with TestClient(app) as cliente:
+                url = f"/estado/{id_analisis}"
+                cuerpo = cliente.get(url, headers=cabeceras).content
+                filas.append((nombre, _medir(lambda: cliente.get(url, headers=cabeceras), iteraciones), len(cuerpo)))
+        return filas
+    finally:
+        ruta.unlink(missing_ok=True)
+        logging.disable(logging.NOTSET)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("ruta", nargs="?", help="Archivo de progreso a usar como payload")
+    parser.add_argument("--iteraciones", type=int, default=500)
+    parser.add_argument("--kb", type=int, default=85, help="Tamaño objetivo del payload en KB")
+    parser.add_argument("--sin-endpoint", action="store_true", help="No medir GET /estado con TestClient")
+    args = parser.parse_args()
+
+    if args.ruta:
+        ruta = Path(args.ruta)
+    else:
+        ruta = max(PROGRESO_DIR.glob("*.json"), key=lambda p: p.stat().st_size)
+
+    data = _cargar_payload(ruta, args.kb)
+    print(f"Payload: {ruta.name} ({len(data.get('resultados', []))} resultados)")
+
+    cuerpo_antes = _serializar_stdlib(data)
+    ms_antes = _medir(lambda: _serializar_stdlib(data), args.iteraciones)
+
+    print(f"\n{'Camino':<36}{'ms/respuesta':>14}{'bytes':>12}")
+    print(f"{'antes: saneado + encoder + json':<36}{ms_antes:>14.3f}{len(cuerpo_antes):>12}")
+
+    if orjson is None:
+        print("orjson no instalado: no se puede medir el camino actual")
+        return
+
+    cuerpo = _serializar_orjson(data)
+    ms_orjson = _medir(lambda: _serializar_orjson(data), args.iteraciones)
+    print(f"{'actual: RespuestaJSON (orjson)':<36}{ms_orjson:>14.3f}{len(cuerpo):>12}")
+
+    ms_gzip = _medir(lambda: gzip.compress(_serializar_orjson(data), compresslevel=5), args.iteraciones)
+    print(f"{'orjson + gzip (nivel 5)':<36}{ms_gzip:>14.3f}{len(gzip.compress(cuerpo, compresslevel=5)):>12}")
+
+    if brotli is not None:
+        ms_br = _medir(lambda: brotli.compress(_serializar_orjson(data), quality=5), args.iteraciones)
+        print(f"{'orjson + brotli (q5)':<36}{ms_br:>14.3f}{len(brotli.compress(cuerpo, quality=5)):>12}")
+    else:
+        print("brotli no instalado: se omite la medición con brotli")
+
+    if not args.sin_endpoint:
+        print(f"\n{'GET /estado (TestClient)':<36}{'ms/petición':>14}{'bytes':>12}")
+        for nombre, ms, tamano in _medir_endpoint(data, max(1, args.iteraciones // 5)):
+            print(f"{nombre:<36}{ms:>14.3f}{tamano:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Mide la respuesta de la API durante una subida grande a /analizar.
+
+Levanta el backend en un hilo con uvicorn (directorios en una carpeta temporal y sin
+lanzar el análisis en segundo plano), sube un archivo de N MB y mientras tanto consulta
+/health cada 50 ms. Al final muestra la latencia de /health y el retraso del event loop
+que registra el propio backend.
+
+Con --comparar sube también el mismo archivo a un endpoint que reproduce el manejo
+anterior (``await upload.read()`` + escritura bloqueante en el event loop). Con
+--repeticiones se alternan las subidas N veces y se muestra la mediana de cada métrica:
+una sola pasada es muy ruidosa.
+
+El bloqueo del manejo anterior es un único parón por subida, así que se ve en los
+máximos (lag max, /health max) y no en el p99 del lag.
+
+Uso:
+    python bench_subida.py [--mb 100] [--puerto 8765] [--comparar] [--repeticiones 5]
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import httpx
+import uvicorn
+from fastapi import UploadFile, File
+
+import main as backend
+from blobs import AlmacenBlobs
+from metricas import _percentil, MonitorEventLoop
+
+
+def _registrar_endpoint_bloqueante(destino_dir: Path):
+    @backend.app.post("/_bench/subida_bloqueante")
+    async def subida_bloqueante(files: UploadFile = File(...)):
+        contenido = await files.read()
+        with open(destino_dir / "bloqueante.bin", "wb") as f:
+            f.write(contenido)
+        return {"bytes": len(contenido)}
+
+
+def _subir(url: str, ruta: Path, nombre_campo: str) -> float:
+    inicio = time.perf_counter()
+    with open(ruta, "rb") as f:
+        resp = httpx.post(url, files={nombre_campo: (ruta.name, f, "application/pdf")}, timeout=600)
+    resp.raise_for_status()
+    return time.perf_counter() - inicio
+
+
+def _medir_durante(base_url: str, subida) -> dict:
+    latencias = []
+    parar = threading.Event()
+
+    def sondear():
+        with httpx.Client(timeout=30) as cliente:
+            while not parar.is_set():
+                inicio = time.perf_counter()
+                cliente.get(f"{base_url}/health")
+                latencias.append(time.perf_counter() - inicio)
+                time.sleep(0.05)
+
+    # Reiniciar la ventana del monitor para medir solo esta subida
+    backend.monitor_event_loop._muestras.clear()
+    backend.monitor_event_loop._max = 0.0
+
+    sondeo = threading.Thread(target=sondear, daemon=True)
+    sondeo.start()
+    duracion = subida()
+    parar.set()
+    sondeo.join()
+
+    lag = httpx.get(f"{base_url}/health", timeout=30).json()["checks"]["event_loop"]
+    return {
+        "duracion_s": duracion,
+        "health_p50_ms": _percentil(latencias, 0.5) * 1000,
+        "health_max_ms": max(latencias, default=0.0) * 1000,
+        "health_peticiones": len(latencias),
+        "lag_p99_ms": lag["p99_ms"],
+        "lag_max_ms": lag["max_ms"],
+    }
+
+
+def _mediana(medidas: list) -> dict:
+    return {clave: statistics.median(m[clave] for m in medidas) for clave in medidas[0]}
+
+
+def _imprimir(titulo: str, r: dict):
+    print(
+        f"{titulo:<28}{r['duracion_s']:>9.2f}s{r['health_peticiones']:>8}"
+        f"{r['health_p50_ms']:>10.1f}{r['health_max_ms']:>10.1f}"
+        f"{r['lag_p99_ms']:>10.1f}{r['lag_max_ms']:>10.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=int, default=100)
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--comparar", action="store_true")
+    parser.add_argument("--repeticiones", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        backend.BASE_DIR = tmp_dir
+        backend.PROGRESO_DIR = tmp_dir / "progreso"
+        backend.PROGRESO_DIR.mkdir()
+        backend.almacen_blobs = AlmacenBlobs(tmp_dir / "blobs")
+        # Solo interesa la subida: el análisis en segundo plano no se ejecuta
+        backend.analizar_documento = lambda *a, **k: None
+        backend.monitor_event_loop = MonitorEventLoop(intervalo=0.01)
+        if args.comparar:
+            _registrar_endpoint_bloqueante(tmp_dir)
+
+        server = uvicorn.Server(uvicorn.Config(backend.app, port=args.puerto, log_level="warning"))
+        hilo = threading.Thread(target=server.run, daemon=True)
+        hilo.start()
+        while not server.started:
+            time.sleep(0.05)
+
+        archivo = tmp_dir / "bundle.pdf"
+        with open(archivo, "wb") as f:
+            for _ in range(args.mb):
+                f.write(os.urandom(1024 * 1024))
+
+        base_url = f"http://127.0.0.1:{args.puerto}"
+        endpoints = {"/analizar": f"{base_url}/analizar"}
+        if args.comparar:
+            endpoints["anterior (bloqueante)"] = f"{base_url}/_bench/subida_bloqueante"
+
+        print(
+            f"Subida de {args.mb} MB · /health cada 50 ms · monitor del loop cada 10 ms · "
+            f"mediana de {args.repeticiones} repetición(es)\n"
+        )
+        print(f"{'Endpoint':<28}{'total':>10}{'health':>8}{'p50 ms':>10}{'max ms':>10}{'lag p99':>10}{'lag max':>10}")
+
+        # Las subidas se alternan para que el ruido de la máquina afecte a ambas por igual
+        medidas = {titulo: [] for titulo in endpoints}
+        for _ in range(max(1, args.repeticiones)):
+            for titulo, url in endpoints.items():
+                medidas[titulo].append(_medir_durante(base_url, lambda: _subir(url, archivo, "files")))
+        for titulo, serie in medidas.items():
+            _imprimir(titulo, _mediana(serie))
+
+        server.should_exit = True
+        hilo.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFIESTO = "manifest.json"
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def es_sha256(valor: Any) -> bool:
+    return isinstance(valor, str) and bool(_SHA256_RE.match(valor))
+
+
+class AlmacenBlobs:
+    """Almacén direccionado por contenido: cada documento se guarda una vez en ``<sha[:2]>/<sha>``.
+
+    Los análisis no copian los archivos; guardan un manifiesto con nombre y hash de cada uno.
+    """
+
+    def __init__(self, directorio: Path):
+        self.directorio = Path(directorio)
+
+    def ruta(self, sha256: str) -> Path:
+        if not es_sha256(sha256):
+            raise ValueError(f"Hash SHA-256 inválido: {sha256!r}")
+        return self.directorio / sha256[:2] / sha256
+
+    def existe(self, sha256: str) -> bool:
+        try:
+            return self.ruta(sha256).is_file()
+        except ValueError:
+            return False
+
+    def consultar(self, hashes: Iterable[str]) -> Dict[str, List[str]]:
+        existentes, faltantes = [], []
+        for sha256 in hashes:
+            sha256 = (sha256 or "").lower()
+            (existentes if self.existe(sha256) else faltantes).append(sha256)
+        return {"existentes": existentes, "faltantes": faltantes}
+
+    def ruta_temporal(self) -> Path:
+        tmp_dir = self.directorio / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        return tmp_dir / f"{uuid.uuid4()}.part"
+
+    def incorporar(self, origen: Path, sha256: str) -> Path:
+        """Mueve ``origen`` (ya hasheado) al almacén. Si el blob ya existía, se descarta el origen."""
+        destino = self.ruta(sha256)
+        if destino.exists():
+            Path(origen).unlink(missing_ok=True)
+            logger.info("♻️ Blob ya existente, se reutiliza: %s", sha256[:12])
+            return destino
+
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(origen, destino)
+        logger.info("💾 Blob guardado: %s", sha256[:12])
+        return destino
+
+
+def escribir_manifiesto(analisis_dir: Path, documentos: List[Dict[str, Any]]) -> Path:
+    analisis_dir.mkdir(parents=True, exist_ok=True)
+    path = analisis_dir / MANIFIESTO
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"documentos": documentos}, f, indent=2, ensure_ascii=False)
+    return path
+
+
+def leer_manifiesto(analisis_dir: Path) -> Optional[List[Dict[str, Any]]]:
+    path = analisis_dir / MANIFIESTO
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("documentos") or []
@@ -0,0 +1,295 @@
+import re
+import unicodedata
+from typing import Any, Dict, Iterator, List, Optional
+
+from normalizacion import pagina_en
+
+# Incrementar al cambiar la segmentación: invalida los índices de cláusulas en caché
+VERSION_CLAUSULAS = "1"
+
+# Un encabezado no ocupa más de una línea corta
+LONGITUD_MAX_ENCABEZADO = 160
+LONGITUD_MAX_TITULO = 80
+# Saltos admitidos en la numeración de primer nivel (cláusulas suprimidas o mal extraídas)
+SALTO_MAX_NUMERACION = 3
+# Cláusulas de primer nivel más cortas que esto (de media) antes de reiniciar la numeración son el índice
+LONGITUD_MEDIA_INDICE = 200
+
+_ROMANO = r"[IVXLC]+"
+_ANEXO_RE = re.compile(
+    r"^(anexo|annex|ap[eé]ndice|appendix|schedule|exhibit)\s+([A-Z]|\d{1,3}|" + _ROMANO + r")\b[\s.:\-–—]*(.*)$",
+    re.IGNORECASE,
+)
+_CLAUSULA_NOMBRADA_RE = re.compile(
+    r"^(cl[aá]usula|clause|art[ií]culo|article|secci[oó]n|section)\s+"
+    r"(\d{1,3}(?:\.\d{1,3})*|" + _ROMANO + r"\b|[a-záéíóúñ]+(?:\s+[a-záéíóúñ]+)?)[\s.:\-–—]*(.*)$",
+    re.IGNORECASE,
+)
+_CLAUSULA_NUMERADA_RE = re.compile(r"^(\d{1,3}(?:\.\d{1,3}){0,4})(\.?)\s+(\S.*)$")
+# Líneas del índice del contrato: "1. Definiciones ........ 3"
+_LINEA_INDICE_RE = re.compile(r"(?:\.{4,}|…{2,}|_{4,})\s*\d{1,4}$")
+_ROMANO_RE = re.compile(r"^" + _ROMANO + r"$", re.IGNORECASE)
+
+_UNIDADES = {
+    "primer": 1, "segund": 2, "tercer": 3, "cuart": 4, "quint": 5,
+    "sext": 6, "septim": 7, "setim": 7, "octav": 8, "noven": 9,
+}
+_DECENAS = {"undecim": 11, "duodecim": 12, "decim": 10, "vigesim": 20, "trigesim": 30, "cuadragesim": 40}
+_CARDINALES_EN = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+
+# Referencias a cláusulas y anexos en el texto de una respuesta
+_REFERENCIA_RE = re.compile(
+    r"\b(?:(?:cl[aá]usulas?|clauses?|art[ií]culos?|articles?|secci[oó]n|section|apartado)\s+"
+    r"(\d{1,3}(?:\.\d{1,3})*)"
+    r"|(anexo|annex|ap[eé]ndice|appendix|schedule|exhibit)\s+([A-Z]|\d{1,3}|" + _ROMANO + r")\b)",
+    re.IGNORECASE,
+)
+
+
+def _sin_tildes(texto: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", texto) if unicodedata.category(c) != "Mn")
+
+
+def _romano_a_entero(romano: str) -> Optional[int]:
+    valores = {"I": 1, "V": 5, "X": 10, "L": 50, "C": 100}
+    total = 0
+    romano = romano.upper()
+    for i, letra in enumerate(romano):
+        valor = valores[letra]
+        total += -valor if i + 1 < len(romano) and valores[romano[i + 1]] > valor else valor
+    return total or None
+
+
+def _ordinal_a_entero(palabras: str) -> Optional[int]:
+    """"Primera" -> 1, "Vigésima Segunda" / "decimotercera" -> 22 / 13; None si no es un ordinal."""
+    resto = re.sub(r"\s+", "", _sin_tildes(palabras).lower())
+    if resto in _CARDINALES_EN:
+        return _CARDINALES_EN[resto]
+    total = 0
+    for prefijo, valor in _DECENAS.items():
+        if resto.startswith(prefijo):
+            total, resto = valor, resto[len(prefijo):].lstrip("oa")
+            break
+    for prefijo, valor in _UNIDADES.items():
+        if resto.startswith(prefijo):
+            total, resto = total + valor, resto[len(prefijo):]
+            break
+    return total if total and resto in {"", "a", "o", "as", "os"} else None
+
+
+def _numero_clausula(numero: str) -> Optional[str]:
+    """Número de la cláusula en la forma "30.1" (los ordinales y romanos se pasan a cifras)."""
+    numero = numero.strip()
+    if re.match(r"^\d", numero):
+        return numero.rstrip(".")
+    if _ROMANO_RE.match(numero):
+        return str(_romano_a_entero(numero))
+    ordinal = _ordinal_a_entero(numero)
+    return str(ordinal) if ordinal else None
+
+
+def _titulo(resto: str) -> str:
+    """Rótulo de la cláusula: su título o, si empieza directamente con el texto, su inicio."""
+    resto = resto.strip().rstrip(".:")
+    corte = re.search(r"\.\s", resto)
+    if corte and corte.start() <= LONGITUD_MAX_TITULO:
+        resto = resto[:corte.start()]
+    return resto if len(resto) <= LONGITUD_MAX_TITULO else resto[:LONGITUD_MAX_TITULO].rstrip() + "…"
+
+
+def _encabezado(linea: str) -> Optional[Dict[str, Any]]:
+    """Tipo, número y título si la línea abre una cláusula o un anexo."""
+    if len(linea) > LONGITUD_MAX_ENCABEZADO or _LINEA_INDICE_RE.search(linea):
+        return None
+
+    coincidencia = _ANEXO_RE.match(linea)
+    if coincidencia:
+        palabra, numero, resto = coincidencia.groups()
+        # "Anexo I del presente contrato..." a principio de línea no es un encabezado
+        if resto and resto[:1].islower():
+            return None
+        return {"tipo": "anexo", "numero": numero.upper(), "nivel": 0, "titulo": _titulo(resto)}
+
+    coincidencia = _CLAUSULA_NOMBRADA_RE.match(linea)
+    if coincidencia:
+        palabra, numero, resto = coincidencia.groups()
+        palabras = numero.split()
+        if len(palabras) == 2 and _numero_clausula(numero) is None:
+            # "CLÁUSULA QUINTA DURACIÓN": la segunda palabra ya es el título
+            numero, resto = palabras[0], f"{palabras[1]} {resto}".strip()
+        numero = _numero_clausula(numero)
+        if numero is None or (resto and resto[:1].islower()):
+            return None
+        return {"tipo": "clausula", "numero": numero, "nivel": numero.count(".") + 1, "titulo": _titulo(resto)}
+
+    coincidencia = _CLAUSULA_NUMERADA_RE.match(linea)
+    if coincidencia:
+        numero, punto, resto = coincidencia.groups()
+        if not (resto[:1].isupper() or resto[:1] in "\"“'«("):
+            return None
+        # "5 DURACIÓN" solo como encabezado en mayúsculas; "5. Duración" o "5.1 El..." siempre
+        if "." not in numero and not punto and not resto.isupper():
+            return None
+        return {"tipo": "clausula", "numero": numero, "nivel": numero.count(".") + 1, "titulo": _titulo(resto)}
+    return None
+
+
+def _nodo(encabezado: Dict[str, Any], linea: str, inicio: int, contenedor: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    prefijo = f"{contenedor['id']}/" if contenedor else ""
+    if encabezado["tipo"] == "anexo":
+        identificador = f"anexo-{encabezado['numero']}"
+    else:
+        identificador = f"{prefijo}{encabezado['numero']}"
+    return {
+        "id": identificador,
+        "tipo": encabezado["tipo"],
+        "numero": encabezado["numero"],
+        "titulo": encabezado["titulo"],
+        "encabezado": linea[:LONGITUD_MAX_ENCABEZADO],
+        "nivel": encabezado["nivel"],
+        "inicio": inicio,
+        "fin": None,
+        "hijos": [],
+    }
+
+
+def _es_indice(hermanos: List[Dict[str, Any]], inicio: int) -> bool:
+    """Las cláusulas anteriores a un reinicio de la numeración eran el índice del contrato."""
+    if not hermanos or any(h["hijos"] for h in hermanos):
+        return False
+    return (inicio - hermanos[0]["inicio"]) / len(hermanos) < LONGITUD_MEDIA_INDICE
+
+
+def segmentar_clausulas(texto: str, mapa_paginas: Optional[List[Dict[str, int]]] = None) -> List[Dict[str, Any]]:
+    """
+    Árbol de cláusulas numeradas, anexos y apéndices del texto normalizado.
+
+    Cada nodo lleva su número ("30.1"), título, desplazamientos ``inicio``/``fin`` en
+    ``texto``, páginas (con ``mapa_paginas``) y sus ``hijos``. Las subcláusulas cuelgan de
+    la cláusula cuyo número las prefija y la numeración de primer nivel debe avanzar (con
+    saltos de hasta ``SALTO_MAX_NUMERACION``): el resto de líneas que empiezan con un
+    número son texto. Dentro de un anexo la numeración empieza de nuevo.
+    """
+    raiz: List[Dict[str, Any]] = []
+    pila: List[Dict[str, Any]] = []
+    anexo: Optional[Dict[str, Any]] = None
+
+    def cerrar_hasta(nivel: int, posicion: int):
+        while pila and pila[-1]["nivel"] >= nivel:
+            pila.pop()["fin"] = posicion
+
+    posicion = 0
+    for linea in texto.split("\n"):
+        inicio, posicion = posicion, posicion + len(linea) + 1
+        linea = linea.strip()
+        encabezado = _encabezado(linea) if linea else None
+        if encabezado is None:
+            continue
+
+        if encabezado["tipo"] == "anexo":
+            cerrar_hasta(0, inicio)
+            anexo = _nodo(encabezado, linea, inicio, None)
+            raiz.append(anexo)
+            pila.append(anexo)
+            continue
+
+        hermanos = anexo["hijos"] if anexo else raiz
+        nivel = encabezado["nivel"]
+        if nivel == 1:
+            anteriores = [h for h in hermanos if h["tipo"] == "clausula"]
+            numero = int(encabezado["numero"])
+            ultimo = int(anteriores[-1]["numero"]) if anteriores else 0
+            if numero == 1 and anteriores and _es_indice(anteriores, inicio):
+                del hermanos[-len(anteriores):]
+                cerrar_hasta(1, inicio)
+                ultimo = 0
+            if not ultimo < numero <= ultimo + SALTO_MAX_NUMERACION:
+                continue
+            cerrar_hasta(1, inicio)
+            padre_hijos = hermanos
+        else:
+            # Sube hasta la cláusula que numera a esta ("30" para "30.1")
+            prefijo = encabezado["numero"].rsplit(".", 1)[0]
+            abiertos = [n for n in pila if n["tipo"] == "clausula"]
+            padre = next((n for n in reversed(abiertos) if n["numero"] == prefijo), None)
+            if padre is None:
+                continue
+            cerrar_hasta(padre["nivel"] + 1, inicio)
+            padre_hijos = padre["hijos"]
+
+        nodo = _nodo(encabezado, linea, inicio, anexo)
+        padre_hijos.append(nodo)
+        pila.append(nodo)
+
+    cerrar_hasta(0, len(texto))
+    if mapa_paginas:
+        for nodo in recorrer(raiz):
+            nodo["pagina_inicio"] = pagina_en(mapa_paginas, nodo["inicio"])
+            nodo["pagina_fin"] = pagina_en(mapa_paginas, max(nodo["inicio"], nodo["fin"] - 1))
+    return raiz
+
+
+def recorrer(arbol: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Todos los nodos del árbol, en orden del documento."""
+    for nodo in arbol:
+        yield nodo
+        yield from recorrer(nodo["hijos"])
+
+
+def contar_clausulas(arbol: List[Dict[str, Any]]) -> Dict[str, int]:
+    nodos = list(recorrer(arbol))
+    return {
+        "clausulas": sum(1 for n in nodos if n["tipo"] == "clausula"),
+        "anexos": sum(1 for n in nodos if n["tipo"] == "anexo"),
+    }
+
+
+def clausula_en(arbol: List[Dict[str, Any]], posicion: int) -> Optional[Dict[str, Any]]:
+    """La cláusula más interna que contiene el carácter ``posicion`` del texto."""
+    encontrada = None
+    nodos = arbol
+    while nodos:
+        nodo = next((n for n in nodos if n["inicio"] <= posicion < n["fin"]), None)
+        if nodo is None:
+            break
+        encontrada, nodos = nodo, nodo["hijos"]
+    return encontrada
+
+
+def buscar_clausula(arbol: List[Dict[str, Any]], referencia: str) -> Optional[Dict[str, Any]]:
+    """
+    Nodo de una referencia como "Cláusula 30.1", "clause 7", "cláusula quinta", "Anexo II"
+    o "Schedule 3". Las cláusulas se buscan primero en el cuerpo y después en los anexos.
+    """
+    referencia = referencia.strip()
+    coincidencia = _REFERENCIA_RE.match(referencia)
+    if coincidencia and coincidencia.group(3):
+        numero = coincidencia.group(3).upper()
+        return next((n for n in arbol if n["tipo"] == "anexo" and n["numero"] == numero), None)
+
+    if coincidencia:
+        numero = coincidencia.group(1)
+    else:
+        coincidencia = _CLAUSULA_NOMBRADA_RE.match(referencia)
+        numero = _numero_clausula(coincidencia.group(2).split()[0] if coincidencia else referencia)
+    if numero is None:
+        return None
+    cuerpo = [n for n in arbol if n["tipo"] != "anexo"]
+    for nodos in (recorrer(cuerpo), recorrer(arbol)):
+        nodo = next((n for n in nodos if n["tipo"] == "clausula" and n["numero"] == numero), None)
+        if nodo is not None:
+            return nodo
+    return None
+
+
+def referencias_en(texto: str) -> List[str]:
+    """Referencias a cláusulas y anexos en ``texto`` (p. ej. una respuesta), sin repetir."""
+    referencias: List[str] = []
+    for coincidencia in _REFERENCIA_RE.finditer(texto or ""):
+        referencia = coincidencia.group(0).strip()
+        if referencia.lower() not in {r.lower() for r in referencias}:
+            referencias.append(referencia)
+    return referencias
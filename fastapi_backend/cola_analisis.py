@@ -0,0 +1,207 @@
+import heapq
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from eventos import EVENTO_PREGUNTA_COMPLETADA, ESTADOS_FINALES
+from metricas import PredictorTiempos, predictor_tiempos
+
+logger = logging.getLogger(__name__)
+
+EN_COLA = "en_cola"
+ACTIVO = "activo"
+
+
+class ColaLlena(Exception):
+    """No se admiten más trabajos; ``retry_after`` es la espera sugerida en segundos."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Cola de análisis llena, reintentar en {retry_after} s")
+        self.retry_after = retry_after
+
+
+class ColaAnalisis:
+    """
+    Ejecuta los análisis con ``max_activos`` en paralelo y como mucho ``max_en_cola`` esperando.
+
+    El avance de cada trabajo se sigue con los eventos del bus (un evento por pregunta
+    completada); los tiempos por pregunta y por página salen del ``PredictorTiempos``
+    según el perfil (modo, modelo, páginas) de cada trabajo.
+    """
+
+    def __init__(self, max_activos: int = 2, max_en_cola: int = 10, predictor: Optional[PredictorTiempos] = None):
+        self.max_activos = max(1, max_activos)
+        self.max_en_cola = max(0, max_en_cola)
+        self.predictor = predictor or predictor_tiempos
+        self._lock = threading.Lock()
+        self._trabajos: Dict[str, Dict[str, Any]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.max_activos, thread_name_prefix="analisis")
+
+    def _pendientes(self, estado: str) -> List[Dict[str, Any]]:
+        trabajos = [t for t in self._trabajos.values() if t["estado"] == estado]
+        return sorted(trabajos, key=lambda t: t["encolado"])
+
+    def _restante_s(self, trabajo: Dict[str, Any]) -> float:
+        return self.predictor.predecir_restante(
+            trabajo["modo"],
+            trabajo["modelo"],
+            trabajo["paginas"],
+            trabajo["total"] - trabajo["hechas"],
+            extraccion_pendiente=trabajo["estado"] == EN_COLA,
+        )["restante_s"]
+
+    def _simular(self) -> Tuple[Dict[str, Dict[str, float]], List[float]]:
+        """
+        Reparte los trabajos en cola (FIFO) entre los huecos que van quedando libres.
+        Devuelve la previsión de cada trabajo y cuándo queda libre cada hueco al final.
+        """
+        huecos = [self._restante_s(t) for t in self._pendientes(ACTIVO)]
+        huecos += [0.0] * max(0, self.max_activos - len(huecos))
+        heapq.heapify(huecos)
+
+        previsiones = {
+            t["id"]: {"inicio_s": 0.0, "fin_s": self._restante_s(t)}
+            for t in self._pendientes(ACTIVO)
+        }
+        for trabajo in self._pendientes(EN_COLA):
+            inicio = heapq.heappop(huecos)
+            fin = inicio + self._restante_s(trabajo)
+            heapq.heappush(huecos, fin)
+            previsiones[trabajo["id"]] = {"inicio_s": inicio, "fin_s": fin}
+        return previsiones, huecos
+
+    def _comprobar_sitio(self):
+        if len(self._pendientes(EN_COLA)) < self.max_en_cola or len(self._pendientes(ACTIVO)) < self.max_activos:
+            return
+        # El primer hueco se libera cuando termina el trabajo activo más avanzado
+        espera = min(
+            (self._restante_s(t) for t in self._pendientes(ACTIVO)),
+            default=self.predictor.segundos_por_pregunta(),
+        )
+        raise ColaLlena(max(1, math.ceil(espera)))
+
+    def admitir(self):
+        """Lanza ``ColaLlena`` si no cabe otro trabajo."""
+        with self._lock:
+            self._comprobar_sitio()
+
+    def enviar(
+        self,
+        id_analisis: str,
+        total_preguntas: int,
+        perfil: Dict[str, Any],
+        funcion: Callable,
+        *args,
+    ) -> Dict[str, Any]:
+        """
+        Admite y encola el trabajo. ``perfil`` lleva ``modo``, ``modelo`` y ``paginas`` (si se
+        conocen) para elegir los tiempos de referencia. Devuelve su ETA inicial.
+        """
+        with self._lock:
+            self._comprobar_sitio()
+            trabajo = self._trabajos[id_analisis] = {
+                "id": id_analisis,
+                "estado": EN_COLA,
+                "total": max(1, int(total_preguntas or 1)),
+                "hechas": 0,
+                "encolado": time.time(),
+                "modo": perfil.get("modo", "texto"),
+                "modelo": perfil.get("modelo"),
+                "paginas": perfil.get("paginas"),
+            }
+        self._executor.submit(self._ejecutar, trabajo, funcion, *args)
+        logger.info("📥 Análisis %s encolado (%s)", id_analisis, self.resumen())
+        return self.eta(id_analisis)
+
+    def cancelar(self, id_analisis: str) -> bool:
+        """Retira el trabajo si sigue en cola; devuelve False si no estaba o ya ha empezado."""
+        with self._lock:
+            trabajo = self._trabajos.get(id_analisis)
+            if trabajo is None or trabajo["estado"] != EN_COLA:
+                return False
+            del self._trabajos[id_analisis]
+        logger.info("🛑 Análisis %s retirado de la cola", id_analisis)
+        return True
+
+    def _ejecutar(self, trabajo: Dict[str, Any], funcion: Callable, *args):
+        id_analisis = trabajo["id"]
+        with self._lock:
+            # Cancelado (o sustituido por otro envío del mismo id) mientras esperaba
+            if self._trabajos.get(id_analisis) is not trabajo:
+                logger.info("⏭️ Análisis %s cancelado antes de empezar, se omite", id_analisis)
+                return
+            trabajo["estado"] = ACTIVO
+            espera = time.time() - trabajo["encolado"]
+        self.predictor.registrar_espera_cola(espera)
+        try:
+            funcion(*args)
+        except Exception as e:
+            logger.error(f"❌ Error no controlado en el análisis {id_analisis}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                if self._trabajos.get(id_analisis) is trabajo:
+                    del self._trabajos[id_analisis]
+
+    def observar_evento(self, evento: Dict[str, Any]):
+        """Observador del bus: actualiza el avance y las páginas de los trabajos activos."""
+        datos = evento.get("datos") or {}
+        with self._lock:
+            trabajo = self._trabajos.get(evento.get("id"))
+            if trabajo is None or trabajo["estado"] != ACTIVO:
+                return
+            if datos.get("total_preguntas"):
+                trabajo["total"] = int(datos["total_preguntas"])
+            if datos.get("total_paginas"):
+                trabajo["paginas"] = int(datos["total_paginas"])
+            if datos.get("estado") in ESTADOS_FINALES:
+                trabajo["hechas"] = trabajo["total"]
+            elif evento.get("tipo") == EVENTO_PREGUNTA_COMPLETADA:
+                trabajo["hechas"] = int(datos.get("progreso") or trabajo["hechas"] + 1)
+
+    def eta(self, id_analisis: str) -> Optional[Dict[str, Any]]:
+        """Posición en cola y segundos estimados hasta el inicio y el final, o None si no está en la cola."""
+        with self._lock:
+            trabajo = self._trabajos.get(id_analisis)
+            if trabajo is None:
+                return None
+            prevision = self._simular()[0][id_analisis]
+            en_cola = self._pendientes(EN_COLA)
+            posicion = next((i for i, t in enumerate(en_cola, start=1) if t["id"] == id_analisis), 0)
+        return {
+            "estado_cola": trabajo["estado"],
+            "posicion_cola": posicion,
+            "inicio_estimado_s": round(prevision["inicio_s"], 1),
+            "eta_s": round(prevision["fin_s"], 1),
+            "eta_p90_s": round(
+                prevision["inicio_s"] + self.predictor.predecir_restante(
+                    trabajo["modo"],
+                    trabajo["modelo"],
+                    trabajo["paginas"],
+                    trabajo["total"] - trabajo["hechas"],
+                    extraccion_pendiente=trabajo["estado"] == EN_COLA,
+                )["restante_p90_s"],
+                1,
+            ),
+            "segundos_por_pregunta": round(
+                self.predictor.segundos_por_pregunta(trabajo["modo"], trabajo["modelo"], trabajo["paginas"]), 2
+            ),
+            "preguntas_restantes": max(0, trabajo["total"] - trabajo["hechas"]),
+        }
+
+    def espera_estimada(self) -> float:
+        """Segundos hasta que empezaría un trabajo que se encolase ahora."""
+        with self._lock:
+            return min(self._simular()[1])
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "activos": len(self._pendientes(ACTIVO)),
+                "en_cola": len(self._pendientes(EN_COLA)),
+                "max_activos": self.max_activos,
+                "max_en_cola": self.max_en_cola,
+                "segundos_por_pregunta": round(self.predictor.segundos_por_pregunta(), 2),
+            }
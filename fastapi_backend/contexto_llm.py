@@ -0,0 +1,339 @@
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Codificación de tiktoken para contar tokens (o200k_base: familia GPT-4o)
+TOKENIZADOR = os.getenv("TOKENIZADOR", "o200k_base")
+# Sin tokenizador disponible se aproxima un token cada 4 caracteres
+CARACTERES_POR_TOKEN = 4
+# Los proveedores facturan cada página de un PDF adjunto como imagen además de su texto
+TOKENS_POR_PAGINA_ADJUNTO = int(os.getenv("TOKENS_POR_PAGINA_ADJUNTO", "258"))
+
+# Ventana de contexto por modelo/deployment (prefijo del nombre). VENTANAS_CONTEXTO (JSON)
+# añade o sustituye entradas; VENTANA_CONTEXTO_TOKENS se usa si ninguna coincide
+VENTANAS_CONTEXTO = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "o3": 200000,
+    "o4-mini": 200000,
+    "gemini-2.5": 1048576,
+    "gemini-2.0": 1048576,
+}
+VENTANA_CONTEXTO_TOKENS = int(os.getenv("VENTANA_CONTEXTO_TOKENS", "128000"))
+# Tope opcional por debajo de la ventana para no pagar prompts enormes (0 = solo la ventana)
+MAX_TOKENS_CONTEXTO = int(os.getenv("MAX_TOKENS_CONTEXTO", "0") or 0)
+# Reserva para la respuesta del modelo
+MARGEN_RESPUESTA_TOKENS = int(os.getenv("MARGEN_RESPUESTA_TOKENS", "2000"))
+
+# Qué hacer cuando los documentos no caben: priorizar_principal, recortar_anexos, fragmentos
+# o mapreduce (el worker pregunta a cada ventana del documento y sintetiza las respuestas)
+ESTRATEGIA_CONTEXTO = os.getenv("ESTRATEGIA_CONTEXTO", "priorizar_principal").strip().lower()
+ESTRATEGIAS = ("priorizar_principal", "recortar_anexos", "fragmentos", "mapreduce")
+# Tamaño de los fragmentos de la estrategia ``fragmentos`` (y de los trozos con que se llenan las ventanas)
+TOKENS_POR_FRAGMENTO = int(os.getenv("TOKENS_POR_FRAGMENTO", "800"))
+# Tamaño máximo de cada ventana del map-reduce (0 = todo el presupuesto del modelo)
+TOKENS_POR_VENTANA_MAPA = int(os.getenv("TOKENS_POR_VENTANA_MAPA", "0") or 0)
+
+MARCA_RECORTE = "\n[...]\n"
+
+try:
+    VENTANAS_CONTEXTO.update(json.loads(os.getenv("VENTANAS_CONTEXTO", "") or "{}"))
+except ValueError:
+    logger.warning("⚠️ VENTANAS_CONTEXTO no es un JSON válido, se ignora")
+
+if ESTRATEGIA_CONTEXTO not in ESTRATEGIAS:
+    logger.warning(f"⚠️ ESTRATEGIA_CONTEXTO desconocida ({ESTRATEGIA_CONTEXTO}), se usa priorizar_principal")
+    ESTRATEGIA_CONTEXTO = "priorizar_principal"
+
+
+@lru_cache(maxsize=1)
+def _codificador():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZADOR)
+    except Exception as e:
+        logger.warning(f"⚠️ Tokenizador {TOKENIZADOR} no disponible, se aproximarán los tokens: {e}")
+        return None
+
+
+def metodo_conteo() -> str:
+    return f"tiktoken:{TOKENIZADOR}" if _codificador() is not None else "aproximado"
+
+
+def _contar(texto: Optional[str]) -> int:
+    if not texto:
+        return 0
+    codificador = _codificador()
+    if codificador is None:
+        return -(-len(texto) // CARACTERES_POR_TOKEN)
+    return len(codificador.encode(texto, disallowed_special=()))
+
+
+# Los mismos textos (documentos del análisis) se miden en cada pregunta
+@lru_cache(maxsize=256)
+def contar_tokens(texto: Optional[str]) -> int:
+    """Tokens de ``texto`` con el tokenizador configurado o, si no está disponible, aproximados."""
+    return _contar(texto)
+
+
+def recortar_a_tokens(texto: str, max_tokens: int) -> str:
+    """Primeros ``max_tokens`` tokens de ``texto``."""
+    if max_tokens <= 0:
+        return ""
+    if contar_tokens(texto) <= max_tokens:
+        return texto
+    codificador = _codificador()
+    if codificador is None:
+        return texto[:max_tokens * CARACTERES_POR_TOKEN]
+    return codificador.decode(codificador.encode(texto, disallowed_special=())[:max_tokens])
+
+
+def ventana_contexto(modelo: Optional[str]) -> int:
+    """Ventana del modelo: la entrada con el prefijo más largo que coincide con su nombre."""
+    nombre = (modelo or "").lower()
+    coincidencias = [p for p in VENTANAS_CONTEXTO if nombre.startswith(p.lower())]
+    if not coincidencias:
+        return VENTANA_CONTEXTO_TOKENS
+    return int(VENTANAS_CONTEXTO[max(coincidencias, key=len)])
+
+
+def presupuesto_contexto(modelo: Optional[str], tokens_fijos: int = 0) -> int:
+    """Tokens disponibles para los documentos, descontando prompt, pregunta y respuesta."""
+    limite = ventana_contexto(modelo) - MARGEN_RESPUESTA_TOKENS
+    if MAX_TOKENS_CONTEXTO:
+        limite = min(limite, MAX_TOKENS_CONTEXTO)
+    return max(0, limite - tokens_fijos)
+
+
+def tokens_adjuntos(textos_pdf: List[str], paginas: int) -> int:
+    """Estimación de lo que cuesta enviar los PDFs como adjuntos (texto más imagen por página)."""
+    return sum(contar_tokens(t) for t in textos_pdf) + paginas * TOKENS_POR_PAGINA_ADJUNTO
+
+
+def _priorizar_principal(principal: str, anexos: List[str], presupuesto: int) -> Tuple[List[str], int]:
+    """Principal completo (o recortado si no cabe solo) y anexos en orden mientras quede sitio."""
+    partes = [recortar_a_tokens(principal, presupuesto)]
+    restante = presupuesto - contar_tokens(partes[0])
+    recortados = 0
+    for anexo in anexos:
+        tokens = contar_tokens(anexo)
+        if tokens <= restante:
+            partes.append(anexo)
+            restante -= tokens
+            continue
+        recortados += 1
+        if restante > 0:
+            partes.append(recortar_a_tokens(anexo, restante) + MARCA_RECORTE)
+            restante = 0
+    return partes, recortados
+
+
+def _recortar_anexos(principal: str, anexos: List[str], presupuesto: int) -> Tuple[List[str], int]:
+    """Principal completo y el resto repartido a partes iguales entre los anexos."""
+    partes = [recortar_a_tokens(principal, presupuesto)]
+    restante = presupuesto - contar_tokens(partes[0])
+
+    # Reparto equitativo: lo que no usan los anexos cortos se reparte entre los largos
+    tamanos = {i: contar_tokens(a) for i, a in enumerate(anexos)}
+    cupos: Dict[int, int] = {}
+    pendientes = sorted(tamanos, key=tamanos.get)
+    while pendientes:
+        cuota = restante // len(pendientes)
+        indice = pendientes.pop(0)
+        cupos[indice] = min(tamanos[indice], cuota)
+        restante -= cupos[indice]
+
+    recortados = 0
+    for i, anexo in enumerate(anexos):
+        if cupos[i] >= tamanos[i]:
+            partes.append(anexo)
+        else:
+            recortados += 1
+            if cupos[i] > 0:
+                partes.append(recortar_a_tokens(anexo, cupos[i]) + MARCA_RECORTE)
+    return partes, recortados
+
+
+_PALABRA_RE = re.compile(r"\w{3,}", re.UNICODE)
+# Cabecera de la sección de definiciones de un contrato
+_DEFINICIONES_RE = re.compile(
+    r"^\s*(?:(?:cl[aá]usula|art[ií]culo|section|article)?\s*[\dIVX]+[\.\)\-]*\s*)?"
+    r"(?:definiciones|definitions|defined terms|interpretaci[oó]n|interpretation)\b",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def _terminos(texto: str) -> List[str]:
+    return [t.lower() for t in _PALABRA_RE.findall(texto)]
+
+
+def indexar(texto: str) -> Counter:
+    """Frecuencia de los términos de ``texto`` (índice local para ``puntuar_relevancia``)."""
+    return Counter(_terminos(texto))
+
+
+def puntuar_relevancia(indices: List[Counter], consulta: str) -> List[float]:
+    """Puntuación de cada texto indexado: términos de la consulta ponderados por su rareza entre los textos."""
+    consulta_terminos = set(_terminos(consulta))
+    n = len(indices)
+    df = Counter(t for terminos in indices for t in consulta_terminos & terminos.keys())
+    return [
+        sum(
+            math.log(1 + n / df[t]) * terminos[t] / (terminos[t] + 1.2)
+            for t in consulta_terminos
+            if terminos[t]
+        )
+        for terminos in indices
+    ]
+
+
+def elegir_paginas(indice_paginas: List[Tuple[int, Counter]], consulta: str, max_paginas: int) -> List[int]:
+    """Las ``max_paginas`` páginas más relacionadas con la consulta (solo las que comparten algún término)."""
+    puntuaciones = puntuar_relevancia([terminos for _, terminos in indice_paginas], consulta)
+    mejores = sorted(range(len(indice_paginas)), key=lambda i: puntuaciones[i], reverse=True)[:max_paginas]
+    return sorted(indice_paginas[i][0] for i in mejores if puntuaciones[i] > 0)
+
+
+def paginas_definiciones(textos_paginas: List[Tuple[int, str]], max_paginas: int = 2) -> List[int]:
+    """Página donde empieza la sección de definiciones y las siguientes, hasta ``max_paginas``."""
+    numeros = [numero for numero, _ in textos_paginas]
+    for i, (_, texto) in enumerate(textos_paginas):
+        if _DEFINICIONES_RE.search(texto):
+            return numeros[i:i + max_paginas]
+    return []
+
+
+@lru_cache(maxsize=64)
+def _fragmentar(texto: str) -> Tuple[Tuple[str, int], ...]:
+    """
+    Trozos de ~``TOKENS_POR_FRAGMENTO`` tokens, con sus tokens, cortando por líneas
+    (el texto extraído de los PDF apenas tiene párrafos).
+    """
+    fragmentos, actual, tokens_actual = [], [], 0
+    for linea in texto.split("\n"):
+        tokens = _contar(linea) + 1
+        if actual and tokens_actual + tokens > TOKENS_POR_FRAGMENTO:
+            fragmentos.append(("\n".join(actual), tokens_actual))
+            actual, tokens_actual = [], 0
+        if tokens > TOKENS_POR_FRAGMENTO:
+            # Línea enorme (texto sin saltos): se parte por caracteres
+            paso = max(1, len(linea) * TOKENS_POR_FRAGMENTO // tokens)
+            fragmentos.extend(
+                (linea[i:i + paso], _contar(linea[i:i + paso])) for i in range(0, len(linea), paso)
+            )
+            continue
+        actual.append(linea)
+        tokens_actual += tokens
+    if actual:
+        fragmentos.append(("\n".join(actual), tokens_actual))
+    return tuple((f, t) for f, t in fragmentos if f.strip())
+
+
+def _fragmentos_relevantes(
+    principal: str,
+    anexos: List[str],
+    presupuesto: int,
+    consulta: str,
+) -> Tuple[List[str], int]:
+    """Fragmentos con más términos de la pregunta (ponderados por rareza) hasta llenar el presupuesto."""
+    fragmentos = [f for texto in [principal, *anexos] for f in _fragmentar(texto)]
+    puntuaciones = puntuar_relevancia([indexar(f) for f, _ in fragmentos], consulta)
+    n = len(fragmentos)
+
+    elegidos, restante = set(), presupuesto
+    for i in sorted(range(n), key=lambda i: puntuaciones[i], reverse=True):
+        tokens = fragmentos[i][1]
+        if tokens <= restante:
+            elegidos.add(i)
+            restante -= tokens
+    # Se mantiene el orden original para que las cláusulas se lean en secuencia
+    return [fragmentos[i][0] for i in sorted(elegidos)], n - len(elegidos)
+
+
+def dividir_en_ventanas(textos: List[str], presupuesto: int) -> List[str]:
+    """
+    Parte los documentos en ventanas consecutivas de como mucho ``presupuesto`` tokens
+    (o ``TOKENS_POR_VENTANA_MAPA`` si es menor), sin cortar fragmentos por la mitad.
+    """
+    limite = min(presupuesto, TOKENS_POR_VENTANA_MAPA) if TOKENS_POR_VENTANA_MAPA else presupuesto
+    limite = max(1, limite)
+    ventanas, actual, tokens_actual = [], [], 0
+    for texto in textos:
+        if not texto:
+            continue
+        for fragmento, tokens in _fragmentar(texto):
+            if tokens > limite:
+                fragmento, tokens = recortar_a_tokens(fragmento, limite), limite
+            if actual and tokens_actual + tokens > limite:
+                ventanas.append("\n".join(actual))
+                actual, tokens_actual = [], 0
+            actual.append(fragmento)
+            tokens_actual += tokens
+    if actual:
+        ventanas.append("\n".join(actual))
+    return ventanas
+
+
+def ajustar_contexto(
+    principal: Optional[str],
+    anexos: List[str],
+    presupuesto: int,
+    consulta: str = "",
+    estrategia: Optional[str] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Ensambla el texto de los documentos para el LLM sin pasar de ``presupuesto`` tokens.
+
+    Si todo cabe se envía completo; si no, se aplica ``estrategia`` (por defecto
+    ``ESTRATEGIA_CONTEXTO``). Devuelve el texto y un resumen con la estrategia usada.
+    ``mapreduce`` no se resuelve aquí: si llega, se recorta con ``priorizar_principal``.
+    """
+    anexos = [a for a in anexos if a]
+    if not principal and anexos:
+        principal, anexos = anexos[0], anexos[1:]
+    principal = principal or ""
+
+    tokens_original = contar_tokens(principal) + sum(contar_tokens(a) for a in anexos)
+    info: Dict[str, Any] = {
+        "estrategia": "completo",
+        "tokens_original": tokens_original,
+        "presupuesto": presupuesto,
+    }
+    if tokens_original <= presupuesto:
+        info["tokens_enviados"] = tokens_original
+        return "\n\n".join([principal, *anexos]).strip(), info
+
+    estrategia = estrategia or ESTRATEGIA_CONTEXTO
+    if estrategia not in ("recortar_anexos", "fragmentos"):
+        estrategia = "priorizar_principal"
+    if estrategia == "fragmentos":
+        partes, descartados = _fragmentos_relevantes(principal, anexos, presupuesto, consulta)
+        info["fragmentos_descartados"] = descartados
+        texto = MARCA_RECORTE.join(partes).strip()
+    else:
+        ajuste = _recortar_anexos if estrategia == "recortar_anexos" else _priorizar_principal
+        partes, recortados = ajuste(principal, anexos, presupuesto)
+        info["principal_recortado"] = contar_tokens(principal) > presupuesto
+        info["anexos_recortados"] = recortados
+        texto = "\n\n".join(p for p in partes if p).strip()
+
+    info["estrategia"] = estrategia
+    info["tokens_enviados"] = _contar(texto)
+    logger.warning(
+        f"✂️ Contexto de {tokens_original} tokens sobre el presupuesto de {presupuesto}: "
+        f"estrategia {estrategia}, se envían {info['tokens_enviados']}"
+    )
+    return texto, info
@@ -0,0 +1,208 @@
+import logging
+import os
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from contexto_llm import ESTRATEGIA_CONTEXTO, ajustar_contexto, contar_tokens, metodo_conteo, presupuesto_contexto
+from metricas import PredictorTiempos, predictor_tiempos
+from worker import (
+    ADJUNTOS_POR_PAGINAS,
+    CASCADA_MODELOS,
+    PROMPT_HUMANO_REDUCCION,
+    PROMPT_SISTEMA_TEXTO,
+    _mapa_cache_path,
+    _modelo_barato,
+    _normalizar_documentos,
+    _obtener_metadata_llm,
+    _paginas_por_pregunta,
+    _prefiltrar,
+    _preparar_contexto_documentos,
+    _tokens_adjuntos_contexto,
+    _tokens_fijos,
+    _tokens_fijos_mapa,
+    _tokens_paginas,
+    _ventanas_mapa,
+)
+
+logger = logging.getLogger(__name__)
+
+# Respuesta de ~70 palabras en Markdown más la línea RISK
+TOKENS_RESPUESTA_ESTIMADOS = int(os.getenv("TOKENS_RESPUESTA_ESTIMADOS", "180"))
+# Precios opcionales por millón de tokens; sin ellos no se calcula el coste
+PRECIO_TOKENS_ENTRADA_1M = os.getenv("PRECIO_TOKENS_ENTRADA_1M", "").strip()
+PRECIO_TOKENS_SALIDA_1M = os.getenv("PRECIO_TOKENS_SALIDA_1M", "").strip()
+# Fracción de preguntas que la cascada repite en el modelo principal mientras no hay medidas
+TASA_ESCALADO_INICIAL = 0.5
+
+
+def _coste(tokens_entrada: int, tokens_salida: int) -> Optional[float]:
+    if not (PRECIO_TOKENS_ENTRADA_1M and PRECIO_TOKENS_SALIDA_1M):
+        return None
+    try:
+        return round(
+            tokens_entrada / 1e6 * float(PRECIO_TOKENS_ENTRADA_1M)
+            + tokens_salida / 1e6 * float(PRECIO_TOKENS_SALIDA_1M),
+            4,
+        )
+    except ValueError:
+        logger.warning("⚠️ PRECIO_TOKENS_* no son números válidos, no se calcula el coste")
+        return None
+
+
+def estimar_analisis(
+    contratos_paths,
+    preguntas: List[Dict[str, Any]],
+    usar_adjuntos_pdf: bool,
+    predictor: Optional[PredictorTiempos] = None,
+) -> Dict[str, Any]:
+    """
+    Estima tokens, llamadas al LLM y duración de un análisis sin llamar al LLM.
+
+    Solo ejecuta los pasos locales (páginas, extracción de texto, que queda en caché para
+    el análisis real, y conteo de tokens). La duración sale de los tiempos medidos.
+    """
+    predictor = predictor or predictor_tiempos
+    inicio = time.monotonic()
+
+    contexto = _preparar_contexto_documentos(_normalizar_documentos(contratos_paths))
+    llm_metadata = _obtener_metadata_llm()
+    total_paginas = contexto.get("total_paginas")
+
+    documentos = [
+        {
+            "nombre": doc["name"],
+            "paginas": doc["paginas"] or None,
+            "tokens_texto": contar_tokens(doc["texto"]),
+            "tokens_original": doc["tokens_original"],
+        }
+        for doc in contexto.get("documentos", [])
+    ]
+
+    # Sin PDFs el modo adjuntos acaba usando el texto, igual que en el análisis real
+    paginas_pdf = sum(doc["paginas"] or 0 for doc in contexto.get("documentos", []) if doc["extension"] == ".pdf")
+    modo = "adjuntos" if usar_adjuntos_pdf and paginas_pdf else "texto"
+
+    modelo = llm_metadata.get("modelo_llm")
+    if modo == "adjuntos":
+        tokens_documento = _tokens_adjuntos_contexto(contexto)
+    else:
+        tokens_documento = contar_tokens(contexto.get("texto_principal")) + sum(
+            contar_tokens(t) for t in contexto.get("textos_anexos", [])
+        )
+
+    textos = [t for t in [contexto.get("texto_principal"), *contexto.get("textos_anexos", [])] if t]
+
+    # Mismo ajuste a la ventana del modelo que en ``_analizar_pregunta_medida``/``_analizar_pregunta``
+    def llamadas_pregunta(pregunta: str, seccion: str) -> Tuple[List[int], str]:
+        """Tokens de entrada de cada llamada que hará la pregunta y la estrategia de contexto."""
+        if modo == "adjuntos":
+            tokens_fijos = _tokens_fijos(pregunta, seccion, True)
+            tokens_adjuntos, estrategia = tokens_documento, "adjuntos"
+            seleccion = _paginas_por_pregunta(pregunta, seccion, contexto) if ADJUNTOS_POR_PAGINAS else {}
+            if seleccion:
+                tokens_adjuntos, estrategia = _tokens_paginas(seleccion, contexto), "adjuntos_paginas"
+            if tokens_adjuntos <= presupuesto_contexto(modelo, tokens_fijos):
+                return [tokens_fijos + tokens_adjuntos], estrategia
+        tokens_fijos = _tokens_fijos(pregunta, seccion, False)
+        presupuesto = presupuesto_contexto(modelo, tokens_fijos)
+        if ESTRATEGIA_CONTEXTO == "mapreduce" and sum(contar_tokens(t) for t in textos) > presupuesto:
+            # Una llamada por ventana sin hallazgos en caché y la reducción (con ~una respuesta por ventana)
+            ventanas = _ventanas_mapa(pregunta, seccion, textos, modelo)
+            tokens_fijos_mapa = _tokens_fijos_mapa(pregunta, seccion)
+            llamadas = [
+                tokens_fijos_mapa + contar_tokens(v)
+                for v in ventanas
+                if not _mapa_cache_path(v, pregunta, seccion, modelo).exists()
+            ]
+            llamadas.append(
+                contar_tokens(PROMPT_SISTEMA_TEXTO)
+                + contar_tokens(PROMPT_HUMANO_REDUCCION.format(seccion=seccion, pregunta=pregunta, hallazgos=""))
+                + len(ventanas) * TOKENS_RESPUESTA_ESTIMADOS
+            )
+            return llamadas, "mapreduce"
+        _, info = ajustar_contexto(
+            contexto.get("texto_principal"),
+            contexto.get("textos_anexos", []),
+            presupuesto,
+            consulta=f"{seccion}\n{pregunta}",
+        )
+        return [tokens_fijos + info["tokens_enviados"]], info["estrategia"]
+
+    # Con la cascada cada pregunta se responde primero con el modelo barato y una parte
+    # (la tasa de escalado medida, o TASA_ESCALADO_INICIAL sin medidas) se repite en el principal
+    modelo_barato = _modelo_barato() if CASCADA_MODELOS else None
+    tasa_medida = predictor.tasa_escalado(modelo_barato) if modelo_barato else None
+    tasa_escalado = tasa_medida if tasa_medida is not None else TASA_ESCALADO_INICIAL
+
+    tokens_por_llamada: List[int] = []
+    tokens_cascada: List[int] = []
+    estrategias: Counter = Counter()
+    decisiones_prefiltro: Counter = Counter()
+    for p in preguntas:
+        pregunta = p.get("Pregunta", "")
+        seccion = p.get("Sección", "Sin sección")
+        prefiltro = _prefiltrar(pregunta, contexto, registrar=False)
+        if prefiltro:
+            decisiones_prefiltro[prefiltro["decision"]] += 1
+            if prefiltro["decision"] == "sin_evaluar":
+                continue
+        llamadas, estrategia = llamadas_pregunta(pregunta, seccion)
+        estrategias[estrategia] += 1
+        # Las preguntas que el prefiltro manda al modelo barato no pasan por la cascada
+        if modelo_barato and (not prefiltro or prefiltro["decision"] == "llm"):
+            tokens_cascada.extend(llamadas)
+        else:
+            tokens_por_llamada.extend(llamadas)
+
+    llamadas_llm = len(tokens_por_llamada) + round(len(tokens_cascada) * (1 + tasa_escalado))
+    tokens_entrada = sum(tokens_por_llamada) + round(sum(tokens_cascada) * (1 + tasa_escalado))
+    tokens_salida = llamadas_llm * TOKENS_RESPUESTA_ESTIMADOS
+
+    # Las preguntas descartadas por el prefiltro no esperan al LLM. Los tiempos por pregunta
+    # medidos con la cascada ya incluyen los dos niveles
+    tiempo = predictor.predecir_restante(
+        modo, modelo, total_paginas, len(preguntas) - decisiones_prefiltro["sin_evaluar"]
+    )
+
+    cascada = None
+    if modelo_barato:
+        cascada = {
+            "modelo_barato": modelo_barato,
+            "tasa_escalado": round(tasa_escalado, 3),
+            "tasa_medida": tasa_medida is not None,
+            "llamadas_barato": len(tokens_cascada),
+            "llamadas_principal": round(len(tokens_cascada) * tasa_escalado),
+            "tokens_entrada_barato": sum(tokens_cascada),
+            "tokens_entrada_principal": round(sum(tokens_cascada) * tasa_escalado),
+        }
+
+    return {
+        "modo": modo,
+        "modelo_llm": modelo,
+        "proveedor_llm": llm_metadata.get("proveedor_llm"),
+        "documentos": documentos,
+        "total_paginas": total_paginas,
+        "preguntas": len(preguntas),
+        "llamadas_llm": llamadas_llm,
+        "tokens_documento": tokens_documento,
+        "tokens_entrada": tokens_entrada,
+        "tokens_entrada_max_llamada": max(tokens_por_llamada + tokens_cascada, default=0),
+        "tokens_salida": tokens_salida,
+        "estrategias_contexto": dict(estrategias),
+        "prefiltro": dict(decisiones_prefiltro),
+        "cascada": cascada,
+        "coste_estimado": _coste(tokens_entrada, tokens_salida),
+        "analisis_s": round(tiempo["restante_s"], 1),
+        "analisis_p90_s": round(tiempo["restante_p90_s"], 1),
+        "conteo_tokens": metodo_conteo(),
+        "tiempo_estimacion_s": round(time.monotonic() - inicio, 2),
+    }
+
+
+def leer_preguntas(preguntas_path) -> List[Dict[str, Any]]:
+    df_preguntas = pd.read_excel(preguntas_path)
+    df_preguntas = df_preguntas.where(pd.notnull(df_preguntas), None)
+    return df_preguntas.to_dict("records")
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Suscripción comodín: recibe los eventos de todos los análisis
+TODOS = "*"
+
+EVENTO_PREGUNTA_COMPLETADA = "pregunta_completada"
+EVENTO_ESTADO = "estado"
+EVENTO_ERROR = "error"
+
+ESTADOS_FINALES = {"completado", "error", "pausado"}
+
+
+class BusEventos:
+    """Bus en memoria que reparte los eventos del worker entre los clientes conectados.
+
+    El worker publica desde hilos del threadpool; cada suscriptor vive en el event loop
+    de FastAPI, por lo que la entrega se hace con ``call_soon_threadsafe``.
+    """
+
+    def __init__(self, max_pendientes: int = 256):
+        self._lock = threading.Lock()
+        self._max_pendientes = max_pendientes
+        self._suscriptores: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._versiones: Dict[str, int] = {}
+        self._observadores: List[Callable[[Dict[str, Any]], None]] = []
+
+    def observar(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        """Registra un callback síncrono que recibe cada evento en el hilo que lo publica."""
+        with self._lock:
+            self._observadores.append(callback)
+
+    def version(self, id_analisis: str) -> int:
+        with self._lock:
+            return self._versiones.get(id_analisis, 0)
+
+    def siguiente_version(self, id_analisis: str, version_actual: Optional[int] = 0) -> int:
+        """Reserva la siguiente versión del análisis (monótona aunque se reinicie el fichero)."""
+        with self._lock:
+            version = max(self._versiones.get(id_analisis, 0), int(version_actual or 0)) + 1
+            self._versiones[id_analisis] = version
+            return version
+
+    def suscribir(self, id_analisis: str = TODOS) -> asyncio.Queue:
+        """Registra una cola en el loop actual. Debe llamarse desde una corrutina."""
+        loop = asyncio.get_running_loop()
+        cola: asyncio.Queue = asyncio.Queue(maxsize=self._max_pendientes)
+        with self._lock:
+            self._suscriptores.setdefault(id_analisis, []).append((loop, cola))
+        return cola
+
+    def cancelar(self, id_analisis: str, cola: asyncio.Queue) -> None:
+        with self._lock:
+            suscriptores = self._suscriptores.get(id_analisis, [])
+            self._suscriptores[id_analisis] = [s for s in suscriptores if s[1] is not cola]
+            if not self._suscriptores[id_analisis]:
+                del self._suscriptores[id_analisis]
+
+    def publicar(
+        self,
+        id_analisis: str,
+        tipo: str,
+        datos: Optional[Dict[str, Any]] = None,
+        version: Optional[int] = None,
+    ) -> None:
+        evento = {
+            "tipo": tipo,
+            "id": id_analisis,
+            "version": version if version is not None else self.version(id_analisis),
+            "timestamp": time.time(),
+            "datos": datos or {},
+        }
+
+        with self._lock:
+            destinos = list(self._suscriptores.get(id_analisis, [])) + list(self._suscriptores.get(TODOS, []))
+            observadores = list(self._observadores)
+
+        for callback in observadores:
+            try:
+                callback(evento)
+            except Exception as e:
+                logger.warning(f"⚠️ Error en observador de eventos: {e}", exc_info=True)
+
+        for loop, cola in destinos:
+            try:
+                loop.call_soon_threadsafe(_entregar, cola, evento)
+            except RuntimeError:
+                # El loop del suscriptor ya se cerró
+                self.cancelar(id_analisis, cola)
+                self.cancelar(TODOS, cola)
+
+
+def _entregar(cola: asyncio.Queue, evento: Dict[str, Any]) -> None:
+    """Encola el evento descartando el más antiguo si el cliente no consume a tiempo."""
+    if cola.full():
+        try:
+            cola.get_nowait()
+        except asyncio.QueueEmpty:  # pragma: no cover - carrera improbable
+            pass
+        logger.warning("⚠️ Cliente de eventos lento, se descarta el evento más antiguo")
+    cola.put_nowait(evento)
+
+
+bus_eventos = BusEventos()
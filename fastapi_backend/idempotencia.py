@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CABECERA = "Idempotency-Key"
+
+
+class ClaveReutilizada(Exception):
+    """La misma clave de idempotencia llegó con una petición distinta."""
+
+
+class RegistroIdempotencia:
+    """
+    Recuerda durante ``ttl_horas`` la respuesta a cada ``Idempotency-Key`` por endpoint.
+
+    Una petición repetida devuelve la respuesta original en lugar de lanzar otro trabajo;
+    si la original sigue en curso, la repetida espera a que termine. Solo se guardan las
+    respuestas 2xx: tras un error el cliente puede reintentar con la misma clave.
+    """
+
+    def __init__(self, directorio: Path, ttl_horas: float = 24):
+        self.directorio = Path(directorio)
+        self.ttl_s = ttl_horas * 3600
+        self._en_curso: Dict[str, asyncio.Future] = {}
+
+    def _ruta(self, ambito: str, clave: str) -> Path:
+        nombre = hashlib.sha256(f"{ambito}:{clave}".encode("utf-8")).hexdigest()
+        return self.directorio / f"{nombre}.json"
+
+    def _leer(self, ruta: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(ruta, "r", encoding="utf-8") as f:
+                registro = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            # Registro ilegible (p. ej. de una versión que no escribía de forma atómica):
+            # se trata como inexistente para que el reintento se ejecute de nuevo
+            logger.warning(f"⚠️ Registro de idempotencia ilegible, se descarta ({ruta.name}): {e}")
+            ruta.unlink(missing_ok=True)
+            return None
+        if not isinstance(registro, dict) or "huella" not in registro:
+            ruta.unlink(missing_ok=True)
+            return None
+        if registro.get("creada", 0) < time.time() - self.ttl_s:
+            ruta.unlink(missing_ok=True)
+            return None
+        return registro
+
+    def _guardar(self, ruta: Path, registro: Dict[str, Any]):
+        self.directorio.mkdir(parents=True, exist_ok=True)
+        self.purgar_caducadas()
+        # Escritura atómica: una caída a mitad no deja un registro truncado
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=self.directorio, suffix=".json.tmp", delete=False
+        ) as f:
+            tmp_path = Path(f.name)
+            json.dump(registro, f, ensure_ascii=False, default=str)
+        try:
+            os.replace(tmp_path, ruta)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    async def ejecutar(
+        self,
+        ambito: str,
+        clave: str,
+        huella: str,
+        funcion: Callable[[], Awaitable[Tuple[int, Any]]],
+    ) -> Tuple[int, Any, bool]:
+        """
+        Ejecuta ``funcion`` (que devuelve ``(status, contenido)``) una sola vez por clave.
+        Devuelve ``(status, contenido, repetida)``.
+        """
+        ruta = self._ruta(ambito, clave)
+        while True:
+            registro = await asyncio.to_thread(self._leer, ruta)
+            if registro is not None:
+                if registro["huella"] != huella:
+                    raise ClaveReutilizada(clave)
+                logger.info("🔁 Petición repetida (%s, clave %s): se devuelve la respuesta original", ambito, clave)
+                return registro["status"], registro["contenido"], True
+
+            pendiente = self._en_curso.get(ruta.name)
+            if pendiente is None:
+                break
+            # La petición original sigue en curso: esperar y volver a comprobar
+            await asyncio.shield(pendiente)
+
+        pendiente = asyncio.get_running_loop().create_future()
+        self._en_curso[ruta.name] = pendiente
+        try:
+            status, contenido = await funcion()
+            if 200 <= status < 300:
+                await asyncio.to_thread(self._guardar, ruta, {
+                    "ambito": ambito,
+                    "huella": huella,
+                    "status": status,
+                    "contenido": contenido,
+                    "creada": time.time(),
+                })
+            return status, contenido, False
+        finally:
+            self._en_curso.pop(ruta.name, None)
+            pendiente.set_result(None)
+
+    def purgar_caducadas(self):
+        limite = time.time() - self.ttl_s
+        for ruta in self.directorio.glob("*.json"):
+            try:
+                if ruta.stat().st_mtime < limite:
+                    ruta.unlink(missing_ok=True)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo purgar la clave de idempotencia {ruta.name}: {e}")
@@ -1,15 +1,17 @@
 from fastapi import FastAPI, UploadFile, BackgroundTasks, Request, Form, File
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+import asyncio
+import hashlib
 import uuid
 import os
 import json
 import logging
+import shutil
 from pathlib import Path
 from datetime import datetime
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Any
-from numbers import Real
-import math
+from typing import List, Any, Tuple, BinaryIO
+from contextlib import asynccontextmanager
 
 
 def _generar_nombre_default(nombres_archivos: List[str]) -> str:
@@ -22,16 +24,6 @@ def _generar_nombre_default(nombres_archivos: List[str]) -> str:
     return f"{base}_{fecha_tag}"
 
 
-def _sanitize_json_for_response(value: Any) -> Any:
-    if isinstance(value, dict):
-        return {k: _sanitize_json_for_response(v) for k, v in value.items()}
-    if isinstance(value, list):
-        return [_sanitize_json_for_response(item) for item in value]
-    if isinstance(value, Real):
-        if math.isnan(value) or math.isinf(value):
-            return None
-    return value
-
 # Cargar variables de entorno desde .env si existe
 try:
     from dotenv import load_dotenv
@@ -50,8 +42,23 @@ from worker import (
     analizar_documento_con_preguntas_custom, 
     analizar_pregunta_texto,
     reanalizar_pregunta_individual_sobreescribir,
-    reanalizar_documento_global_sobreescribir
+    reanalizar_documento_global_sobreescribir,
+    reanudar_analisis,
+    guardar_progreso,
+    indice_clausulas,
+    llamadas_en_vuelo,
+    almacen_adjuntos,
+    pool_llm,
+    _obtener_metadata_llm,
 )
+from eventos import bus_eventos, TODOS, ESTADOS_FINALES
+from respuestas import RespuestaJSON, CompresionMiddleware
+from metricas import monitor_event_loop, predictor_tiempos
+from subidas import AlmacenSubidas, SubidaNoEncontrada, OffsetInvalido
+from blobs import AlmacenBlobs, es_sha256, escribir_manifiesto, leer_manifiesto
+from cola_analisis import ColaAnalisis, ColaLlena
+from idempotencia import RegistroIdempotencia, ClaveReutilizada, CABECERA as CABECERA_IDEMPOTENCIA
+from estimacion import estimar_analisis, leer_preguntas
 import sys
 sys.path.append(str(Path(__file__).parent.parent / "src"))
 from db.analisis_db import actualizar_resultados_analisis
@@ -67,7 +74,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    monitor_event_loop.iniciar()
+    yield
+    await monitor_event_loop.detener()
+
+# orjson serializa NaN/Inf como null: las respuestas no necesitan un saneado recursivo
+app = FastAPI(default_response_class=RespuestaJSON, lifespan=_lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -77,21 +91,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Brotli o gzip según Accept-Encoding para respuestas de más de RESPUESTA_COMPRESION_MIN_BYTES
+app.add_middleware(
+    CompresionMiddleware,
+    minimum_size=int(os.getenv("RESPUESTA_COMPRESION_MIN_BYTES", "1024")),
+)
+
 BASE_DIR = Path(__file__).resolve().parent
 PROGRESO_DIR = BASE_DIR / "progreso"
 # Cambiar a usar el archivo de preguntas en src/docs/
 PREGUNTAS_PATH = BASE_DIR.parent / "src" / "docs" / "preguntas-risk-analyzer.xlsx"
 PROGRESO_DIR.mkdir(exist_ok=True)
 
+# Intervalo de keepalive del canal SSE; también acota lo que tarda en detectarse una desconexión
+SSE_KEEPALIVE_S = float(os.getenv("SSE_KEEPALIVE_S", "2"))
+# Tope de espera del long-poll de /estado (por debajo de los timeouts habituales de proxy)
+ESTADO_WAIT_MAX_S = float(os.getenv("ESTADO_WAIT_MAX_S", "60"))
+# Tamaño de bloque al persistir archivos subidos
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Tamaño máximo aceptado por cada PUT de una subida reanudable
+SUBIDA_BLOQUE_MAX_BYTES = int(os.getenv("SUBIDA_BLOQUE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+almacen_subidas = AlmacenSubidas(
+    BASE_DIR / "subidas",
+    ttl_horas=float(os.getenv("SUBIDAS_TTL_HORAS", "24")),
+)
+
+# Análisis en paralelo y en espera; por encima se responde 429 con Retry-After
+cola_analisis = ColaAnalisis(
+    max_activos=int(os.getenv("MAX_ANALISIS_ACTIVOS", "2")),
+    max_en_cola=int(os.getenv("MAX_ANALISIS_EN_COLA", "10")),
+)
+bus_eventos.observar(cola_analisis.observar_evento)
+
+# Respuestas recordadas por Idempotency-Key para que los reintentos no dupliquen trabajos
+registro_idempotencia = RegistroIdempotencia(
+    BASE_DIR / "idempotencia",
+    ttl_horas=float(os.getenv("IDEMPOTENCIA_TTL_HORAS", "24")),
+)
+
+# Documentos direccionados por contenido; cada análisis solo guarda su manifiesto
+almacen_blobs = AlmacenBlobs(BASE_DIR / "blobs")
+
 logger.info(f"Sistema iniciado. BASE_DIR: {BASE_DIR}")
 logger.info(f"PREGUNTAS_PATH: {PREGUNTAS_PATH}, existe: {PREGUNTAS_PATH.exists()}")
 
 
-def _obtener_paths_contrato(id_analisis: str) -> List[Path]:
-    """Recupera todos los archivos asociados a un análisis."""
+class DocumentosIncompletos(Exception):
+    """Faltan en el almacén blobs que el manifiesto del análisis referencia."""
+
+    def __init__(self, faltantes: List[str]):
+        super().__init__(f"Faltan {len(faltantes)} documento(s) del análisis en el almacén")
+        self.faltantes = faltantes
+
+
+def _obtener_paths_contrato(id_analisis: str) -> List[Any]:
+    """
+    Recupera todos los archivos asociados a un análisis.
+    Con manifiesto devuelve sus entradas (``path`` del blob, ``nombre``, ``sha256``) en orden;
+    si falta alguno de sus blobs lanza ``DocumentosIncompletos`` en lugar de devolver
+    solo parte del contrato.
+    """
     contratos_dir = BASE_DIR / "contratos"
     analisis_dir = contratos_dir / id_analisis
 
+    manifiesto = leer_manifiesto(analisis_dir)
+    if manifiesto is not None:
+        faltantes = [doc["sha256"] for doc in manifiesto if not almacen_blobs.existe(doc["sha256"])]
+        if faltantes:
+            raise DocumentosIncompletos(faltantes)
+        return [{**doc, "path": almacen_blobs.ruta(doc["sha256"])} for doc in manifiesto]
+
     if analisis_dir.exists() and analisis_dir.is_dir():
         return sorted([p for p in analisis_dir.iterdir() if p.is_file()])
 
@@ -99,21 +169,349 @@ def _obtener_paths_contrato(id_analisis: str) -> List[Path]:
     legacy_files = sorted(contratos_dir.glob(f"{id_analisis}*"))
     return [p for p in legacy_files if p.is_file()]
 
+def _persistir_upload(origen: BinaryIO, destino: Path) -> Tuple[int, str]:
+    """Copia el archivo subido a disco por bloques calculando su SHA-256 en la misma pasada."""
+    digest = hashlib.sha256()
+    total = 0
+    origen.seek(0)
+    with open(destino, "wb") as f:
+        while True:
+            bloque = origen.read(UPLOAD_CHUNK_BYTES)
+            if not bloque:
+                break
+            digest.update(bloque)
+            f.write(bloque)
+            total += len(bloque)
+    return total, digest.hexdigest()
+
+def _sha256_upload(origen: BinaryIO) -> str:
+    """SHA-256 del archivo subido leído por bloques (se vuelve a leer desde el inicio al persistirlo)."""
+    digest = hashlib.sha256()
+    origen.seek(0)
+    for bloque in iter(lambda: origen.read(UPLOAD_CHUNK_BYTES), b""):
+        digest.update(bloque)
+    origen.seek(0)
+    return digest.hexdigest()
+
+def _resolver_documentos(
+    solicitados: List[dict],
+    recibidos: List[dict],
+) -> Tuple[List[dict], List[str]]:
+    """
+    Ordena los documentos del análisis según ``solicitados`` (``nombre`` + ``sha256``).
+    Cada uno se toma de lo recibido en esta petición o, si no, del almacén de blobs.
+    Devuelve los documentos y los hashes que no están en ningún sitio.
+    """
+    por_hash = {doc["sha256"]: doc for doc in recibidos}
+    documentos: List[dict] = []
+    faltantes: List[str] = []
+
+    for entrada in solicitados:
+        sha256 = str(entrada.get("sha256") or "").lower()
+        if not es_sha256(sha256):
+            raise ValueError(f"Hash SHA-256 inválido en el manifiesto: {entrada.get('sha256')!r}")
+
+        if sha256 in por_hash:
+            doc = dict(por_hash[sha256])
+            doc["nombre"] = Path(entrada.get("nombre") or doc["nombre"]).name
+        elif almacen_blobs.existe(sha256):
+            doc = {
+                "nombre": Path(entrada.get("nombre") or sha256).name,
+                "sha256": sha256,
+                "tamano": almacen_blobs.ruta(sha256).stat().st_size,
+                "reutilizado": True,
+            }
+        else:
+            faltantes.append(sha256)
+            continue
+        documentos.append(doc)
+
+    return documentos, faltantes
+
+_preguntas_cache: Tuple[float, int] = (0.0, 0)
+
+def _contar_preguntas() -> int:
+    """Número de preguntas del banco (se relee solo si cambia el archivo)."""
+    global _preguntas_cache
+    mtime = PREGUNTAS_PATH.stat().st_mtime
+    if _preguntas_cache[0] != mtime:
+        import pandas as pd
+        _preguntas_cache = (mtime, len(pd.read_excel(PREGUNTAS_PATH)))
+    return _preguntas_cache[1]
+
+def _perfil_cola(usar_adjuntos_pdf: bool, paginas: int | None = None) -> dict:
+    """Perfil con el que la cola elige los tiempos medidos para estimar el ETA."""
+    return {
+        "modo": "adjuntos" if usar_adjuntos_pdf else "texto",
+        "modelo": _obtener_metadata_llm().get("modelo_llm"),
+        "paginas": paginas,
+    }
+
+def _respuesta_documentos_incompletos(id_analisis: str, error: DocumentosIncompletos) -> JSONResponse:
+    logger.error(f"❌ {error} ({id_analisis}): {', '.join(h[:12] for h in error.faltantes)}")
+    return JSONResponse(status_code=409, content={"error": str(error), "faltantes": error.faltantes})
+
+def _respuesta_cola_llena(error: ColaLlena) -> JSONResponse:
+    logger.warning(f"🚦 {error}")
+    return JSONResponse(
+        status_code=429,
+        content={"error": str(error), "retry_after": error.retry_after, "cola": cola_analisis.resumen()},
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+async def _registrar_y_lanzar_analisis(
+    id_analisis: str,
+    documentos: List[dict],
+    analysis_name: str | None,
+    use_pdf_attachments: bool,
+    reutilizar_resultados: bool = True,
+    presupuesto_tokens: int | None = None,
+):
+    """
+    Escribe el manifiesto y el progreso inicial de un análisis con sus documentos ya en el
+    almacén y lo pone en la cola. La respuesta incluye el ETA estimado.
+    ``presupuesto_tokens`` sustituye al presupuesto por defecto (0 = sin límite).
+    """
+    cola_analisis.admitir()
+    # Antes de escribir nada: un error aquí no debe dejar un análisis "en_cola" para siempre
+    if not PREGUNTAS_PATH.exists():
+        logger.error(f"❌ ARCHIVO DE PREGUNTAS NO ENCONTRADO: {PREGUNTAS_PATH}")
+        return JSONResponse(status_code=500, content={"error": "Archivo de preguntas no encontrado"})
+    total_preguntas = await asyncio.to_thread(_contar_preguntas)
+
+    progreso_path = PROGRESO_DIR / f"{id_analisis}.json"
+    logger.info(f"📊 Creando archivo de progreso: {progreso_path}")
+
+    cleaned_names = [doc["nombre"] for doc in documentos]
+    analysis_name = (analysis_name or "").strip()
+    if not analysis_name:
+        analysis_name = _generar_nombre_default(cleaned_names)
+
+    logger.info(f"🆔 Nombre del análisis: {analysis_name}")
+
+    manifiesto = [
+        {"nombre": doc["nombre"], "sha256": doc["sha256"], "tamano": doc["tamano"]}
+        for doc in documentos
+    ]
+    analisis_dir = BASE_DIR / "contratos" / id_analisis
+    await asyncio.to_thread(escribir_manifiesto, analisis_dir, manifiesto)
+
+    progreso_inicial = {
+        "estado": "en_cola",
+        "resultados": [],
+        "archivos": cleaned_names,
+        "nombre_analisis": analysis_name,
+        "documentos_info": [
+            {
+                "nombre": doc["nombre"],
+                "extension": Path(doc["nombre"]).suffix,
+                "paginas": None,
+                "sha256": doc["sha256"],
+            }
+            for doc in documentos
+        ],
+    }
+    if presupuesto_tokens is not None:
+        progreso_inicial["presupuesto_tokens"] = presupuesto_tokens or None
+    await asyncio.to_thread(guardar_progreso, progreso_path, progreso_inicial)
+    logger.info("✅ Archivo de progreso inicializado")
+
+    logger.info("🚀 Encolando análisis con %d archivo(s)...", len(documentos))
+    try:
+        eta = cola_analisis.enviar(
+            id_analisis,
+            total_preguntas,
+            _perfil_cola(use_pdf_attachments),
+            analizar_documento,
+            [{**doc, "path": almacen_blobs.ruta(doc["sha256"])} for doc in manifiesto],
+            PREGUNTAS_PATH,
+            progreso_path,
+            use_pdf_attachments,
+            reutilizar_resultados,
+        )
+    except Exception:
+        # No se llegó a encolar (p. ej. la cola se llenó entre admitir y enviar)
+        progreso_path.unlink(missing_ok=True)
+        shutil.rmtree(analisis_dir, ignore_errors=True)
+        raise
+
+    return {
+        "id": id_analisis,
+        "archivos": cleaned_names,
+        "nombre_analisis": analysis_name,
+        "use_pdf_attachments": use_pdf_attachments,
+        "reutilizados": [doc["sha256"] for doc in documentos if doc.get("reutilizado")],
+        "eta": eta,
+    }
+
+def _guardar_upload_en_almacen(upload: UploadFile) -> Tuple[int, str]:
+    tmp_path = almacen_blobs.ruta_temporal()
+    try:
+        tamano, sha256 = _persistir_upload(upload.file, tmp_path)
+        almacen_blobs.incorporar(tmp_path, sha256)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return tamano, sha256
+
+@app.post("/blobs/consultar")
+async def consultar_blobs(request: Request):
+    """
+    Indica qué documentos ya están en el servidor para no volver a subirlos.
+    Cuerpo: ``{"sha256": [...]}``; respuesta: ``{"existentes": [...], "faltantes": [...]}``.
+    """
+    data = await request.json() or {}
+    hashes = data.get("sha256") or []
+    if not isinstance(hashes, list):
+        return JSONResponse(status_code=400, content={"error": "'sha256' debe ser una lista de hashes"})
+    return await asyncio.to_thread(almacen_blobs.consultar, hashes)
+
+async def _idempotente(request: Request, ambito: str, datos_peticion: Any, ejecutar):
+    """
+    Ejecuta ``ejecutar`` respetando la cabecera ``Idempotency-Key``: una repetición de la misma
+    petición devuelve la respuesta original (con ``Idempotent-Replayed: true``) sin lanzar otro trabajo.
+    """
+    clave = request.headers.get(CABECERA_IDEMPOTENCIA)
+    if not clave:
+        return await ejecutar()
+
+    huella = hashlib.sha256(
+        json.dumps(datos_peticion, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+
+    async def _ejecutar():
+        respuesta = await ejecutar()
+        if isinstance(respuesta, JSONResponse):
+            return respuesta.status_code, json.loads(respuesta.body)
+        return 200, respuesta
+
+    try:
+        status, contenido, repetida = await registro_idempotencia.ejecutar(ambito, clave, huella, _ejecutar)
+    except ClaveReutilizada:
+        return JSONResponse(
+            status_code=422,
+            content={"error": f"La clave {CABECERA_IDEMPOTENCIA} ya se usó con una petición distinta"},
+        )
+
+    return RespuestaJSON(
+        status_code=status,
+        content=contenido,
+        headers={"Idempotent-Replayed": "true"} if repetida else None,
+    )
+
 @app.post("/analizar")
 async def iniciar_analisis(
-    background_tasks: BackgroundTasks,
+    request: Request,
     use_pdf_attachments: bool = Form(False),
     analysis_name: str = Form(None),
+    manifiesto: str = Form(None),
+    reutilizar_resultados: bool = Form(True),
+    presupuesto_tokens: int | None = Form(None),
     files: List[UploadFile] = File(None),
     file: UploadFile | None = File(None),
 ):
+    """
+    Sube los documentos y lanza el análisis.
+    ``manifiesto`` (JSON ``[{"nombre", "sha256"}, ...]``) fija el orden de los documentos y
+    permite omitir en ``files`` los que ya están en el servidor (ver ``/blobs/consultar``).
+    Con ``reutilizar_resultados`` un análisis idéntico ya completado se clona sin llamar al LLM.
+    ``presupuesto_tokens`` limita los tokens que puede gastar el análisis (0 = sin límite).
+    Admite ``Idempotency-Key`` para que los reintentos no dupliquen el análisis.
+    """
     uploads: List[UploadFile] = []
     if files:
         uploads.extend([f for f in files if f is not None])
     if file is not None:
         uploads.append(file)
 
-    if not uploads:
+    datos_peticion = {
+        "use_pdf_attachments": use_pdf_attachments,
+        "analysis_name": analysis_name,
+        "manifiesto": manifiesto,
+        "reutilizar_resultados": reutilizar_resultados,
+        "presupuesto_tokens": presupuesto_tokens,
+        "archivos": [(u.filename, u.size) for u in uploads],
+    }
+    if request.headers.get(CABECERA_IDEMPOTENCIA):
+        # Otro archivo con el mismo nombre y tamaño es otra petición: la huella lleva el contenido
+        datos_peticion["archivos"] = await asyncio.to_thread(
+            lambda: [(u.filename, u.size, _sha256_upload(u.file)) for u in uploads]
+        )
+    return await _idempotente(
+        request,
+        "analizar",
+        datos_peticion,
+        lambda: _iniciar_analisis(
+            uploads,
+            use_pdf_attachments,
+            analysis_name,
+            manifiesto,
+            reutilizar_resultados,
+            presupuesto_tokens,
+        ),
+    )
+
+def _leer_manifiesto_form(manifiesto: str | None):
+    """Lista del campo ``manifiesto`` (o None si no viene), o la respuesta 400 si no es válido."""
+    if not manifiesto:
+        return None
+    try:
+        solicitados = json.loads(manifiesto)
+        if not isinstance(solicitados, list):
+            raise ValueError
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "'manifiesto' debe ser una lista JSON"})
+    return solicitados
+
+async def _recibir_documentos(uploads: List[UploadFile], solicitados: List[dict] | None):
+    """
+    Guarda los archivos recibidos en el almacén y resuelve el manifiesto. Devuelve los
+    documentos en orden o la respuesta 409 con los hashes que faltan.
+    """
+    # Todo el acceso a disco se hace fuera del event loop para no bloquear otras peticiones
+    recibidos: List[dict] = []
+
+    for index, upload in enumerate(uploads, start=1):
+        original_name = Path(upload.filename or f"documento_{index}").name
+        tamano, sha256 = await asyncio.to_thread(_guardar_upload_en_almacen, upload)
+
+        logger.info(
+            "💾 Archivo guardado: %s (%d bytes, sha256=%s)",
+            original_name,
+            tamano,
+            sha256[:12],
+        )
+        recibidos.append({"nombre": original_name, "sha256": sha256, "tamano": tamano})
+
+    if solicitados is None:
+        return recibidos
+
+    documentos, faltantes = await asyncio.to_thread(_resolver_documentos, solicitados, recibidos)
+    if faltantes:
+        return JSONResponse(
+            status_code=409,
+            content={"error": "Faltan documentos por subir", "faltantes": faltantes},
+        )
+    return documentos
+
+async def _iniciar_analisis(
+    uploads: List[UploadFile],
+    use_pdf_attachments: bool,
+    analysis_name: str | None,
+    manifiesto: str | None,
+    reutilizar_resultados: bool,
+    presupuesto_tokens: int | None = None,
+):
+    # Rechazar antes de persistir nada si la cola está llena
+    try:
+        cola_analisis.admitir()
+    except ColaLlena as e:
+        return _respuesta_cola_llena(e)
+
+    solicitados = _leer_manifiesto_form(manifiesto)
+    if isinstance(solicitados, JSONResponse):
+        return solicitados
+
+    if not uploads and not solicitados:
         return JSONResponse(status_code=400, content={"error": "No se adjuntaron archivos para el análisis"})
 
     id_analisis = str(uuid.uuid4())
@@ -121,87 +519,216 @@ async def iniciar_analisis(
     logger.info(
         "🔥 INICIO ANÁLISIS - ID: %s, Archivos: %s",
         id_analisis,
-        ", ".join(nombres_archivos),
+        ", ".join(nombres_archivos) or "(todos ya en el servidor)",
     )
 
     try:
-        contratos_dir = BASE_DIR / "contratos"
-        contratos_dir.mkdir(exist_ok=True)
+        documentos = await _recibir_documentos(uploads, solicitados)
+        if isinstance(documentos, JSONResponse):
+            return documentos
 
-        analisis_dir = contratos_dir / id_analisis
-        analisis_dir.mkdir(exist_ok=True)
-        logger.info(f"📁 Directorio del análisis creado: {analisis_dir}")
+        return await _registrar_y_lanzar_analisis(
+            id_analisis,
+            documentos,
+            analysis_name,
+            use_pdf_attachments,
+            reutilizar_resultados,
+            presupuesto_tokens,
+        )
+
+    except ColaLlena as e:
+        return _respuesta_cola_llena(e)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.error(f"❌ ERROR EN ANÁLISIS {id_analisis}: {str(e)}", exc_info=True)
+        return JSONResponse(status_code=500, content={"error": f"Error al procesar archivo: {str(e)}"})
+
+@app.post("/estimar")
+async def estimar(
+    use_pdf_attachments: bool = Form(False),
+    manifiesto: str = Form(None),
+    files: List[UploadFile] = File(None),
+):
+    """
+    Estima tokens, llamadas al LLM, coste y duración de un análisis sin lanzarlo.
+    Recibe los documentos igual que ``/analizar``; quedan en el servidor (y su texto
+    extraído en caché), así que iniciar después el análisis no los vuelve a subir.
+    """
+    uploads = [f for f in files or [] if f is not None]
+    solicitados = _leer_manifiesto_form(manifiesto)
+    if isinstance(solicitados, JSONResponse):
+        return solicitados
+    if not uploads and not solicitados:
+        return JSONResponse(status_code=400, content={"error": "No se adjuntaron archivos para estimar"})
+
+    try:
+        documentos = await _recibir_documentos(uploads, solicitados)
+        if isinstance(documentos, JSONResponse):
+            return documentos
+
+        entradas = [{**doc, "path": almacen_blobs.ruta(doc["sha256"])} for doc in documentos]
+        preguntas = await asyncio.to_thread(leer_preguntas, PREGUNTAS_PATH)
+        estimacion = await asyncio.to_thread(estimar_analisis, entradas, preguntas, use_pdf_attachments)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.error(f"❌ ERROR EN ESTIMACIÓN: {str(e)}", exc_info=True)
+        return JSONResponse(status_code=500, content={"error": f"Error al estimar el análisis: {str(e)}"})
 
-        stored_paths: List[Path] = []
-        cleaned_names: List[str] = []
+    estimacion["espera_cola_s"] = round(cola_analisis.espera_estimada(), 1)
+    estimacion["total_s"] = round(estimacion["espera_cola_s"] + estimacion["analisis_s"], 1)
+    return estimacion
 
-        for index, upload in enumerate(uploads, start=1):
-            original_name = upload.filename or f"documento_{index}"
-            safe_name = f"{index:02d}_{Path(original_name).name}"
-            destino = analisis_dir / safe_name
+@app.post("/subidas")
+async def crear_subida(request: Request):
+    """Inicia una subida reanudable. Cuerpo: ``{"nombre", "tamano", "sha256"?}``."""
+    data = await request.json()
+    nombre = (data or {}).get("nombre")
+    tamano = (data or {}).get("tamano")
+    if not nombre or not isinstance(tamano, int) or tamano < 0:
+        return JSONResponse(status_code=400, content={"error": "Se requieren 'nombre' y 'tamano'"})
+
+    subida = await asyncio.to_thread(almacen_subidas.crear, nombre, tamano, data.get("sha256"))
+    return {**subida, "tamano_bloque_max": SUBIDA_BLOQUE_MAX_BYTES}
 
-            contenido = await upload.read()
-            with open(destino, "wb") as f:
-                f.write(contenido)
+@app.get("/subidas/{id_subida}")
+async def estado_subida(id_subida: str):
+    """Devuelve cuántos bytes se han recibido (``offset``) para reanudar la subida."""
+    try:
+        return await asyncio.to_thread(almacen_subidas.estado, id_subida)
+    except SubidaNoEncontrada:
+        return JSONResponse(status_code=404, content={"error": "Subida no encontrada"})
 
-            logger.info(
-                "💾 Archivo guardado: %s (%d bytes)",
-                destino,
-                len(contenido),
+@app.put("/subidas/{id_subida}")
+async def subir_bloque(id_subida: str, offset: int, request: Request):
+    """Recibe un bloque de la subida en ``offset``. Responde 409 con el offset esperado si no encaja."""
+    bloque = bytearray()
+    async for trozo in request.stream():
+        bloque.extend(trozo)
+        if len(bloque) > SUBIDA_BLOQUE_MAX_BYTES:
+            return JSONResponse(
+                status_code=413,
+                content={"error": f"Bloque mayor que {SUBIDA_BLOQUE_MAX_BYTES} bytes"},
             )
 
-            stored_paths.append(destino)
-            cleaned_names.append(original_name)
+    try:
+        return await asyncio.to_thread(almacen_subidas.escribir_bloque, id_subida, offset, bytes(bloque))
+    except SubidaNoEncontrada:
+        return JSONResponse(status_code=404, content={"error": "Subida no encontrada"})
+    except OffsetInvalido as e:
+        return JSONResponse(status_code=409, content={"error": str(e), "offset": e.offset})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
-        progreso_path = PROGRESO_DIR / f"{id_analisis}.json"
-        logger.info(f"📊 Creando archivo de progreso: {progreso_path}")
-
-        analysis_name = (analysis_name or "").strip()
-        if not analysis_name:
-            analysis_name = _generar_nombre_default(cleaned_names)
-
-        logger.info(f"🆔 Nombre del análisis: {analysis_name}")
-
-        with open(progreso_path, "w", encoding="utf-8") as f:
-            json.dump({
-                "estado": "en_cola",
-                "resultados": [],
-                "archivos": cleaned_names,
-                "nombre_analisis": analysis_name,
-                "documentos_info": [
-                    {
-                        "nombre": name,
-                        "extension": Path(name).suffix,
-                        "paginas": None,
-                    }
-                    for name in cleaned_names
-                ],
-            }, f)
-        logger.info("✅ Archivo de progreso inicializado")
-
-        if not PREGUNTAS_PATH.exists():
-            logger.error(f"❌ ARCHIVO DE PREGUNTAS NO ENCONTRADO: {PREGUNTAS_PATH}")
-            return JSONResponse(status_code=500, content={"error": "Archivo de preguntas no encontrado"})
-
-        logger.info("🚀 Lanzando análisis en segundo plano con %d archivo(s)...", len(stored_paths))
-        background_tasks.add_task(
-            analizar_documento,
-            stored_paths,
-            PREGUNTAS_PATH,
-            progreso_path,
-            use_pdf_attachments,
-        )
+def _completar_subida_en_almacen(id_subida: str) -> None:
+    tmp_path = almacen_blobs.ruta_temporal()
+    try:
+        info = almacen_subidas.completar(id_subida, tmp_path)
+        # None: ya se incorporó en una petición anterior (reintento)
+        if info is not None:
+            almacen_blobs.incorporar(tmp_path, info["sha256"])
+            logger.info("💾 Subida %s incorporada al almacén (%d bytes)", id_subida, info["tamano"])
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
-        return {
-            "id": id_analisis,
-            "archivos": cleaned_names,
-             "nombre_analisis": analysis_name,
-            "use_pdf_attachments": use_pdf_attachments,
-        }
+@app.post("/subidas/finalizar")
+async def finalizar_subidas(request: Request):
+    """
+    Pasa las subidas completas al almacén de blobs y lanza el análisis.
+    Cuerpo: ``{"documentos": [{"id_subida", "sha256"?} | {"nombre", "sha256"}, ...], "analysis_name"?,
+    "use_pdf_attachments"?, "reutilizar_resultados"?, "presupuesto_tokens"?}``.
+    Las entradas con ``sha256`` se toman de documentos que ya estaban en el servidor.
+    Se sigue aceptando ``{"ids_subida": [...]}``. Admite ``Idempotency-Key``.
+    """
+    data = await request.json() or {}
+    # Un reintento puede referenciar por hash lo que antes era una subida: identificar los
+    # documentos por contenido cuando el cliente lo indica, no por id de subida
+    datos_peticion = {
+        **{k: v for k, v in data.items() if k not in ("documentos", "ids_subida")},
+        "documentos": [
+            [e.get("nombre"), e["sha256"]] if e.get("sha256") else e
+            for e in data.get("documentos") or [{"id_subida": i} for i in data.get("ids_subida") or []]
+        ],
+    }
+    return await _idempotente(
+        request,
+        "subidas/finalizar",
+        datos_peticion,
+        lambda: _finalizar_subidas(data),
+    )
+
+async def _finalizar_subidas(data: dict):
+    entradas = data.get("documentos") or [{"id_subida": i} for i in data.get("ids_subida") or []]
+    if not entradas:
+        return JSONResponse(status_code=400, content={"error": "No se indicaron subidas para el análisis"})
+
+    # Con la cola llena las subidas se conservan: el cliente puede finalizar más tarde
+    try:
+        cola_analisis.admitir()
+    except ColaLlena as e:
+        return _respuesta_cola_llena(e)
+
+    id_analisis = str(uuid.uuid4())
+    ids_subida = [e["id_subida"] for e in entradas if e.get("id_subida")]
+    logger.info(
+        "🔥 INICIO ANÁLISIS (subidas reanudables) - ID: %s, Subidas: %s, ya en el servidor: %d",
+        id_analisis,
+        ", ".join(ids_subida),
+        len(entradas) - len(ids_subida),
+    )
+
+    try:
+        # Primero se comprueba todo (subidas completas, hashes, documentos ya en el servidor)
+        # y solo después se consumen las subidas: si algo falla, el cliente puede reintentar
+        # con los mismos ids
+        for id_subida in ids_subida:
+            estado = await asyncio.to_thread(almacen_subidas.estado, id_subida)
+            if not estado["completa"]:
+                return JSONResponse(
+                    status_code=409,
+                    content={"error": "Subida incompleta", "id_subida": id_subida, "offset": estado["offset"]},
+                )
+
+        solicitados: List[dict] = []
+        recibidos: List[dict] = []
+
+        for entrada in entradas:
+            if entrada.get("id_subida"):
+                info = await asyncio.to_thread(almacen_subidas.verificar, entrada["id_subida"])
+                recibidos.append(info)
+                solicitados.append({"nombre": info["nombre"], "sha256": info["sha256"]})
+            else:
+                solicitados.append(entrada)
+
+        documentos, faltantes = await asyncio.to_thread(_resolver_documentos, solicitados, recibidos)
+        if faltantes:
+            return JSONResponse(
+                status_code=409,
+                content={"error": "Faltan documentos por subir", "faltantes": faltantes},
+            )
+
+        for id_subida in ids_subida:
+            await asyncio.to_thread(_completar_subida_en_almacen, id_subida)
 
+        return await _registrar_y_lanzar_analisis(
+            id_analisis,
+            documentos,
+            data.get("analysis_name"),
+            bool(data.get("use_pdf_attachments", False)),
+            bool(data.get("reutilizar_resultados", True)),
+            _leer_presupuesto(data),
+        )
+
+    except ColaLlena as e:
+        return _respuesta_cola_llena(e)
+    except SubidaNoEncontrada as e:
+        return JSONResponse(status_code=404, content={"error": f"Subida no encontrada: {e}"})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
     except Exception as e:
         logger.error(f"❌ ERROR EN ANÁLISIS {id_analisis}: {str(e)}", exc_info=True)
-        return JSONResponse(status_code=500, content={"error": f"Error al procesar archivo: {str(e)}"})
+        return JSONResponse(status_code=500, content={"error": f"Error al procesar las subidas: {str(e)}"})
 
 @app.get("/procesos")
 def listar_procesos():
@@ -255,15 +782,46 @@ def listar_procesos():
 @app.get("/progreso/{id_analisis}")
 def obtener_progreso(id_analisis: str):
     """Alias para /estado/{id_analisis} para compatibilidad"""
-    return obtener_estado(id_analisis)
+    return _leer_estado(id_analisis)
+
+async def _esperar_cambio(id_analisis: str, since_version: int, wait: float) -> None:
+    """Espera sin ocupar hilos a que el análisis supere ``since_version`` o venza ``wait``."""
+    # Suscribirse antes de leer la versión para no perder un cambio intermedio
+    cola = bus_eventos.suscribir(id_analisis)
+    try:
+        snapshot = await asyncio.to_thread(_leer_snapshot_estado, id_analisis)
+        if (snapshot.get("version") or 0) > since_version:
+            return
+
+        loop = asyncio.get_running_loop()
+        limite = loop.time() + wait
+        while True:
+            restante = limite - loop.time()
+            if restante <= 0:
+                return
+            try:
+                evento = await asyncio.wait_for(cola.get(), timeout=restante)
+            except asyncio.TimeoutError:
+                return
+            if (evento.get("version") or 0) > since_version:
+                return
+    finally:
+        bus_eventos.cancelar(id_analisis, cola)
 
 @app.get("/estado/{id_analisis}")
-def obtener_estado(id_analisis: str):
+async def obtener_estado(id_analisis: str, wait: float = 0, since_version: int | None = None):
+    """Estado del análisis. Con ``wait`` y ``since_version`` funciona como long-poll:
+    responde en cuanto la versión supera ``since_version`` o al vencer ``wait`` segundos."""
+    if wait > 0 and since_version is not None:
+        await _esperar_cambio(id_analisis, since_version, min(wait, ESTADO_WAIT_MAX_S))
+    return await asyncio.to_thread(_leer_estado, id_analisis)
+
+def _leer_estado(id_analisis: str):
     logger.info(f"🔍 Consultando estado del análisis: {id_analisis}")
     path = PROGRESO_DIR / f"{id_analisis}.json"
     if not path.exists():
         logger.warning(f"📂 Archivo de progreso no encontrado: {path}")
-        return JSONResponse(status_code=200, content={"estado": "no_iniciado", "resultados": [], "porcentaje": 0})
+        return JSONResponse(status_code=200, content={"estado": "no_iniciado", "resultados": [], "porcentaje": 0, "version": 0})
     
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -279,14 +837,20 @@ def obtener_estado(id_analisis: str):
             
             # Añadir porcentaje al resultado
             data["porcentaje"] = porcentaje
+
+            # Posición en la cola y tiempo estimado mientras el análisis no ha terminado
+            eta = cola_analisis.eta(id_analisis)
+            if eta is not None:
+                data["eta"] = eta
             
             logger.info(f"📈 Progreso calculado: {progreso}/{total} = {porcentaje}%")
-            return _sanitize_json_for_response(data)
+            # Respuesta ya construida: FastAPI no recorre el payload con jsonable_encoder
+            return RespuestaJSON(data)
             
         # Si es una lista, es el formato antiguo
         if isinstance(data, list):
             completado = all(row.get("Estado") == "✅ Completado" for row in data) and len(data) > 0
-            return _sanitize_json_for_response({
+            return RespuestaJSON({
                 "estado": "completado" if completado else "en_progreso",
                 "resultados": data,
                 "porcentaje": 100 if completado else 0
@@ -294,19 +858,96 @@ def obtener_estado(id_analisis: str):
         # Si es un error
         if isinstance(data, dict) and "error" in data:
             return {"estado": "error", "resultados": [], "error": data["error"], "porcentaje": 0}
-        return _sanitize_json_for_response({"estado": "en_progreso", "resultados": [], "porcentaje": 0})
+        return {"estado": "en_progreso", "resultados": [], "porcentaje": 0}
         
     except Exception as e:
         logger.error(f"❌ Error al leer archivo de progreso {path}: {str(e)}")
         return JSONResponse(status_code=200, content={"estado": "error", "resultados": [], "error": "Archivo de progreso corrupto", "porcentaje": 0})
 
+@app.get("/resultados/{id_analisis}")
+def obtener_resultados(id_analisis: str, desde: int = 0, desde_version: int | None = None):
+    """
+    Devuelve solo los resultados nuevos o modificados para que el cliente los fusione
+    con su copia: los de índice >= ``desde`` y, si se indica ``desde_version``, solo los
+    escritos después de esa versión (incluidos los reanálisis individuales).
+    Si ``completo`` es True el cliente debe descartar su copia desde ``desde``.
+    """
+    path = PROGRESO_DIR / f"{id_analisis}.json"
+    if not path.exists():
+        return JSONResponse(status_code=404, content={"error": "No existe el análisis"})
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        logger.error(f"❌ Error al leer archivo de progreso {path}: {str(e)}")
+        return JSONResponse(status_code=500, content={"error": "Archivo de progreso corrupto"})
+
+    if isinstance(data, list):
+        # Formato antiguo: solo lista de resultados
+        data = {"estado": "completado", "resultados": data}
+
+    resultados = data.get("resultados") or []
+    version = data.get("version", 0)
+    completo = desde_version is None or desde_version < data.get("version_reinicio_resultados", 0)
+
+    seleccion = [
+        {**resultado, "indice": indice}
+        for indice, resultado in enumerate(resultados)
+        if indice >= desde
+        and isinstance(resultado, dict)
+        and (completo or (resultado.get("version") or 0) > desde_version)
+    ]
+
+    logger.info(
+        "📦 Resultados incrementales %s: %d de %d (desde=%d, desde_version=%s)",
+        id_analisis, len(seleccion), len(resultados), desde, desde_version,
+    )
+
+    return RespuestaJSON({
+        "id": id_analisis,
+        "version": version,
+        "completo": completo,
+        "total_resultados": len(resultados),
+        "progreso": {k: v for k, v in data.items() if k != "resultados"},
+        "resultados": seleccion,
+    })
+
+@app.get("/clausulas/{id_analisis}")
+def obtener_clausulas(id_analisis: str):
+    """
+    Índice de cláusulas, anexos y apéndices de cada documento del análisis, con sus
+    títulos, desplazamientos en el texto normalizado y páginas (para saltar a una cláusula).
+    """
+    try:
+        contratos_paths = _obtener_paths_contrato(id_analisis)
+    except DocumentosIncompletos as e:
+        return _respuesta_documentos_incompletos(id_analisis, e)
+    if not contratos_paths:
+        return JSONResponse(status_code=404, content={"error": "No existen los documentos del análisis"})
+    try:
+        documentos = indice_clausulas(contratos_paths)
+    except Exception as e:
+        logger.error(f"❌ Error al segmentar las cláusulas de {id_analisis}: {str(e)}")
+        return JSONResponse(status_code=500, content={"error": "No se pudieron segmentar los documentos"})
+    return {"id": id_analisis, "documentos": documentos}
+
 @app.post("/reanalisar_pregunta/{id_analisis}/{num_pregunta}")
 async def reanalizar_pregunta(id_analisis: str, num_pregunta: int, request: Request, background_tasks: BackgroundTasks):
     """
     Re-analiza una pregunta individual de forma asíncrona SOBREESCRIBIENDO el análisis original.
     El proceso se ejecuta en background usando el mismo ID y progreso_path original.
+    Admite ``Idempotency-Key``: un reintento no vuelve a lanzar el re-análisis.
     """
     data = await request.json()
+    return await _idempotente(
+        request,
+        f"reanalisar_pregunta/{id_analisis}/{num_pregunta}",
+        data,
+        lambda: _reanalizar_pregunta(id_analisis, num_pregunta, data, background_tasks),
+    )
+
+async def _reanalizar_pregunta(id_analisis: str, num_pregunta: int, data: Any, background_tasks: BackgroundTasks):
     pregunta_modificada = data.get("pregunta") if data else None
     seccion_modificada = data.get("seccion") if data else None
     
@@ -339,7 +980,10 @@ async def reanalizar_pregunta(id_analisis: str, num_pregunta: int, request: Requ
     seccion = seccion_modificada or pregunta_original.get("Sección", "")
     
     # Verificar que el contrato original existe
-    contrato_files = _obtener_paths_contrato(id_analisis)
+    try:
+        contrato_files = _obtener_paths_contrato(id_analisis)
+    except DocumentosIncompletos as e:
+        return _respuesta_documentos_incompletos(id_analisis, e)
     if not contrato_files:
         return JSONResponse(status_code=404, content={"error": "No existe el contrato original"})
 
@@ -350,8 +994,7 @@ async def reanalizar_pregunta(id_analisis: str, num_pregunta: int, request: Requ
     progreso_original["tipo_reanalisis"] = f"individual_pregunta_{num_pregunta}"
     
     # Guardar estado actualizado
-    with open(original_path, "w", encoding="utf-8") as f:
-        json.dump(progreso_original, f, ensure_ascii=False, indent=2)
+    guardar_progreso(original_path, progreso_original)
     
     # Preparar datos para el análisis individual
     pregunta_data = {
@@ -371,14 +1014,110 @@ async def reanalizar_pregunta(id_analisis: str, num_pregunta: int, request: Requ
     logger.info(f"Re-análisis individual iniciado para pregunta {num_pregunta} del análisis {id_analisis}. SOBREESCRIBIENDO análisis original.")
     return {"id": id_analisis, "mensaje": "Re-análisis individual iniciado (sobreescribiendo análisis original)"}
 
+def _leer_presupuesto(data: Any) -> int | None:
+    """``presupuesto_tokens`` de un cuerpo JSON: None si no viene, ValueError si no es un entero >= 0."""
+    if data.get("presupuesto_tokens") is None:
+        return None
+    presupuesto = data["presupuesto_tokens"]
+    if isinstance(presupuesto, bool) or not isinstance(presupuesto, int) or presupuesto < 0:
+        raise ValueError("'presupuesto_tokens' debe ser un entero >= 0")
+    return presupuesto
+
+@app.post("/reanudar/{id_analisis}")
+async def reanudar(id_analisis: str, request: Request):
+    """
+    Reanuda un análisis pausado por agotar su presupuesto de tokens.
+    Cuerpo opcional: ``{"presupuesto_tokens": N}`` con el nuevo límite total (0 o sin él = sin límite).
+    Admite ``Idempotency-Key``.
+    """
+    data = await _leer_json_opcional(request)
+    return await _idempotente(
+        request,
+        f"reanudar/{id_analisis}",
+        data,
+        lambda: _reanudar(id_analisis, data),
+    )
+
+async def _leer_json_opcional(request: Request) -> dict:
+    cuerpo = await request.body()
+    return json.loads(cuerpo) if cuerpo.strip() else {}
+
+async def _reanudar(id_analisis: str, data: dict):
+    try:
+        presupuesto = _leer_presupuesto(data)
+        cola_analisis.admitir()
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except ColaLlena as e:
+        return _respuesta_cola_llena(e)
+
+    progreso_path = PROGRESO_DIR / f"{id_analisis}.json"
+    if not progreso_path.exists():
+        return JSONResponse(status_code=404, content={"error": "No existe el análisis"})
+    try:
+        contrato_files = _obtener_paths_contrato(id_analisis)
+    except DocumentosIncompletos as e:
+        return _respuesta_documentos_incompletos(id_analisis, e)
+    if not contrato_files:
+        return JSONResponse(status_code=404, content={"error": "No existe el contrato original"})
+
+    with open(progreso_path, "r", encoding="utf-8") as f:
+        progreso = json.load(f)
+    if progreso.get("estado") != "pausado":
+        return JSONResponse(
+            status_code=409,
+            content={"error": f"El análisis no está pausado (estado: {progreso.get('estado')})"},
+        )
+
+    usados = (progreso.get("uso_tokens") or {}).get("total", 0)
+    if presupuesto and presupuesto <= usados:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"El nuevo presupuesto debe superar los {usados} tokens ya usados"},
+        )
+    progreso["presupuesto_tokens"] = presupuesto or None
+    progreso["estado"] = "en_cola"
+    await asyncio.to_thread(guardar_progreso, progreso_path, progreso)
+
+    try:
+        eta = cola_analisis.enviar(
+            id_analisis,
+            len(progreso.get("preguntas_originales") or []),
+            _perfil_cola(progreso.get("usar_adjuntos_pdf", False), progreso.get("total_paginas")),
+            reanudar_analisis,
+            contrato_files,
+            progreso_path,
+        )
+    except ColaLlena as e:
+        progreso["estado"] = "pausado"
+        await asyncio.to_thread(guardar_progreso, progreso_path, progreso)
+        return _respuesta_cola_llena(e)
+
+    logger.info(f"▶️ Análisis {id_analisis} reanudado (presupuesto: {presupuesto or 'sin límite'})")
+    return {"id": id_analisis, "presupuesto_tokens": presupuesto or None, "eta": eta}
+
 @app.post("/reanalisar_global/{id_analisis}")
-async def reanalizar_global(id_analisis: str, request: Request, background_tasks: BackgroundTasks):
+async def reanalizar_global(id_analisis: str, request: Request):
     """
     Re-analiza todas las preguntas usando las preguntas editadas enviadas por el usuario.
     SOBREESCRIBE el análisis original con el mismo ID.
+    Admite ``Idempotency-Key``: un reintento no vuelve a lanzar el re-análisis.
     """
     data = await request.json()
+    return await _idempotente(
+        request,
+        f"reanalisar_global/{id_analisis}",
+        data,
+        lambda: _reanalizar_global(id_analisis, data),
+    )
+
+async def _reanalizar_global(id_analisis: str, data: Any):
     preguntas_editadas = data.get("preguntas", [])
+
+    try:
+        cola_analisis.admitir()
+    except ColaLlena as e:
+        return _respuesta_cola_llena(e)
     
     # Verificar que el análisis original existe
     original_path = PROGRESO_DIR / f"{id_analisis}.json"
@@ -386,7 +1125,10 @@ async def reanalizar_global(id_analisis: str, request: Request, background_tasks
         return JSONResponse(status_code=404, content={"error": "No existe el análisis original"})
     
     # Verificar que el contrato original existe
-    contrato_files = _obtener_paths_contrato(id_analisis)
+    try:
+        contrato_files = _obtener_paths_contrato(id_analisis)
+    except DocumentosIncompletos as e:
+        return _respuesta_documentos_incompletos(id_analisis, e)
     if not contrato_files:
         return JSONResponse(status_code=404, content={"error": "No existe el contrato original"})
 
@@ -395,6 +1137,10 @@ async def reanalizar_global(id_analisis: str, request: Request, background_tasks
     with open(original_path, "r", encoding="utf-8") as f:
         progreso_original = json.load(f)
     
+    # Campos que se restauran si la cola rechaza el trabajo
+    campos_reanalisis = ("estado", "fecha_modificacion", "tipo_reanalisis", "preguntas_editadas")
+    anteriores = {campo: progreso_original[campo] for campo in campos_reanalisis if campo in progreso_original}
+
     # Actualizar estado a "reanalisis_en_progreso" para indicar que está re-procesándose
     progreso_original["estado"] = "reanalisis_en_progreso"
     progreso_original["fecha_modificacion"] = datetime.now().isoformat()
@@ -402,19 +1148,132 @@ async def reanalizar_global(id_analisis: str, request: Request, background_tasks
     progreso_original["preguntas_editadas"] = preguntas_editadas
     
     # Guardar estado actualizado
-    with open(original_path, "w", encoding="utf-8") as f:
-        json.dump(progreso_original, f, ensure_ascii=False, indent=2)
+    guardar_progreso(original_path, progreso_original)
     
-    # Lanzar el análisis en segundo plano con las preguntas editadas USANDO EL MISMO archivo de progreso
-    background_tasks.add_task(
-        reanalizar_documento_global_sobreescribir,
-        contrato_files,
-        preguntas_editadas,
-        original_path,
-    )
+    # Encolar el análisis con las preguntas editadas USANDO EL MISMO archivo de progreso
+    try:
+        eta = cola_analisis.enviar(
+            id_analisis,
+            len(preguntas_editadas),
+            _perfil_cola(progreso_original.get("usar_adjuntos_pdf", False), progreso_original.get("total_paginas")),
+            reanalizar_documento_global_sobreescribir,
+            contrato_files,
+            preguntas_editadas,
+            original_path,
+        )
+    except ColaLlena as e:
+        for campo in campos_reanalisis:
+            progreso_original.pop(campo, None)
+        progreso_original.update(anteriores)
+        guardar_progreso(original_path, progreso_original)
+        return _respuesta_cola_llena(e)
     
     logger.info(f"Reanálisis global iniciado para {id_analisis}. SOBREESCRIBIENDO análisis original.")
-    return {"id": id_analisis, "mensaje": "Reanálisis global iniciado (sobreescribiendo análisis original)"}
+    return {
+        "id": id_analisis,
+        "mensaje": "Reanálisis global iniciado (sobreescribiendo análisis original)",
+        "eta": eta,
+    }
+
+def _leer_snapshot_estado(id_analisis: str) -> dict:
+    """Resumen ligero del progreso (sin resultados) para abrir un canal de eventos."""
+    path = PROGRESO_DIR / f"{id_analisis}.json"
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return {"estado": "no_iniciado", "version": bus_eventos.version(id_analisis)}
+
+    if not isinstance(data, dict):
+        return {"estado": "en_progreso", "version": bus_eventos.version(id_analisis)}
+
+    return {
+        "estado": data.get("estado", "desconocido"),
+        "progreso": data.get("progreso", 0),
+        "total_preguntas": data.get("total_preguntas"),
+        "version": data.get("version", 0),
+        "error": data.get("error"),
+        "uso_tokens": data.get("uso_tokens"),
+    }
+
+
+def _formatear_sse(tipo: str, datos: dict, id_evento=None) -> str:
+    lineas = [f"event: {tipo}"]
+    if id_evento is not None:
+        lineas.append(f"id: {id_evento}")
+    lineas.append(f"data: {json.dumps(datos, ensure_ascii=False)}")
+    return "\n".join(lineas) + "\n\n"
+
+
+async def _stream_eventos(request: Request, clave: str, snapshot: dict, cerrar_en_final: bool):
+    cola = bus_eventos.suscribir(clave)
+    try:
+        # Estado inicial: el cliente sabe desde qué versión está escuchando
+        yield _formatear_sse("conectado", snapshot)
+        if cerrar_en_final and snapshot.get("estado") in ESTADOS_FINALES:
+            return
+
+        while True:
+            if await request.is_disconnected():
+                break
+            try:
+                evento = await asyncio.wait_for(cola.get(), timeout=SSE_KEEPALIVE_S)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+
+            yield _formatear_sse(evento["tipo"], evento, evento.get("version"))
+
+            if cerrar_en_final and evento["datos"].get("estado") in ESTADOS_FINALES:
+                break
+    finally:
+        bus_eventos.cancelar(clave, cola)
+
+
+def _respuesta_sse(generador) -> StreamingResponse:
+    return StreamingResponse(
+        generador,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@app.get("/eventos/{id_analisis}")
+async def eventos_analisis(id_analisis: str, request: Request):
+    """Canal SSE con los eventos de un análisis: pregunta_completada, estado y error."""
+    logger.info(f"📡 Cliente suscrito a eventos del análisis: {id_analisis}")
+    snapshot = await asyncio.to_thread(_leer_snapshot_estado, id_analisis)
+    return _respuesta_sse(_stream_eventos(request, id_analisis, snapshot, cerrar_en_final=True))
+
+
+@app.get("/eventos")
+async def eventos_globales(request: Request, ids: str = ""):
+    """Canal SSE con los eventos de todos los análisis (usado por Procesos en Curso).
+
+    El evento inicial incluye la versión actual de los análisis indicados en ``ids``
+    para que el cliente detecte cambios ocurridos antes de conectarse.
+    """
+    id_list = [i for i in ids.split(",") if i]
+    snapshots = await asyncio.to_thread(lambda: {i: _leer_snapshot_estado(i) for i in id_list})
+    snapshot = {"versiones": {i: snap.get("version", 0) for i, snap in snapshots.items()}}
+    return _respuesta_sse(_stream_eventos(request, TODOS, snapshot, cerrar_en_final=False))
+
+
+@app.get("/metricas/tiempos")
+def metricas_tiempos():
+    """
+    Tiempos medidos por el worker (EWMA, p50 y p90) por pregunta, extracción por página,
+    espera en cola y análisis completo, agrupados por modo, modelo y tramo de páginas.
+    """
+    return {
+        "series": predictor_tiempos.resumen(),
+        "segundos_por_pregunta": round(predictor_tiempos.segundos_por_pregunta(), 2),
+        "segundos_por_pagina": round(predictor_tiempos.segundos_por_pagina(), 4),
+    }
+
 
 @app.get("/health")
 def health_check():
@@ -447,6 +1306,21 @@ def health_check():
         "length": len(api_key) if api_key else 0
     }
     
+    # Latencia del event loop: detecta endpoints async que bloquean (p.ej. subidas grandes)
+    status["checks"]["event_loop"] = monitor_event_loop.resumen()
+
+    # Llamadas al LLM en curso y cuántas se han ahorrado agrupando peticiones idénticas
+    status["checks"]["llamadas_llm"] = llamadas_en_vuelo.resumen()
+
+    # Backends del LLM: reparto de llamadas, cupo, errores y los que están en enfriamiento
+    status["checks"]["proveedores_llm"] = pool_llm.resumen()
+
+    # PDFs adjuntos preparados una sola vez y reutilizados entre preguntas
+    status["checks"]["adjuntos_llm"] = almacen_adjuntos.resumen()
+
+    # Ocupación de la cola de análisis (admisión y ETA)
+    status["checks"]["cola_analisis"] = cola_analisis.resumen()
+
     # Verificar dependencias
     try:
         from langchain_google_genai import ChatGoogleGenerativeAI
@@ -474,7 +1348,11 @@ async def cancelar_proceso(id_analisis: str):
     try:
         # Verificar si el proceso existe
         progreso_path = PROGRESO_DIR / f"{id_analisis}.json"
-        contrato_paths = _obtener_paths_contrato(id_analisis)
+        try:
+            contrato_paths = _obtener_paths_contrato(id_analisis)
+        except DocumentosIncompletos:
+            # Con manifiesto se borra el directorio del análisis, no los blobs
+            contrato_paths = []
         contratos_dir = BASE_DIR / "contratos"
         analisis_dir = contratos_dir / id_analisis
         
@@ -503,6 +1381,10 @@ async def cancelar_proceso(id_analisis: str):
                 content={"error": "No se puede cancelar un proceso ya completado"}
             )
         
+        # Retirar el trabajo si aún no ha empezado; si ya está activo, el worker se detiene
+        # al ver que su archivo de progreso ya no existe
+        retirado_de_cola = cola_analisis.cancelar(id_analisis)
+
         # Eliminar archivo de progreso
         if progreso_path.exists():
             progreso_path.unlink()
@@ -535,6 +1417,7 @@ async def cancelar_proceso(id_analisis: str):
             "mensaje": f"Proceso {id_analisis} cancelado exitosamente",
             "id": id_analisis,
             "estado_anterior": estado_actual,
+            "retirado_de_cola": retirado_de_cola,
             "archivos_eliminados": {
                 "progreso": str(progreso_path) if progreso_path.exists() else None,
                 "contratos": eliminados,
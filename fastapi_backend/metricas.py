@@ -0,0 +1,263 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _percentil(valores, q: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    idx = min(len(ordenados) - 1, max(0, int(round(q * (len(ordenados) - 1)))))
+    return ordenados[idx]
+
+
+class MonitorEventLoop:
+    """Mide el retraso del event loop: cuánto tarda en despertar un ``sleep`` respecto a lo pedido.
+
+    Un retraso sostenido indica trabajo bloqueante dentro de un endpoint ``async``.
+    """
+
+    def __init__(self, intervalo: float = 0.05, ventana: int = 1200):
+        self.intervalo = intervalo
+        self._muestras = deque(maxlen=ventana)
+        self._max = 0.0
+        self._tarea: Optional[asyncio.Task] = None
+
+    async def _medir(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            inicio = loop.time()
+            await asyncio.sleep(self.intervalo)
+            retraso = max(0.0, loop.time() - inicio - self.intervalo)
+            self._muestras.append(retraso)
+            if retraso > self._max:
+                self._max = retraso
+            if retraso > 0.5:
+                logger.warning(f"⚠️ Event loop bloqueado {retraso * 1000:.0f} ms")
+
+    def iniciar(self):
+        if self._tarea is None:
+            self._tarea = asyncio.get_running_loop().create_task(self._medir())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    def resumen(self) -> Dict[str, float]:
+        muestras = list(self._muestras)
+        return {
+            "intervalo_ms": round(self.intervalo * 1000, 1),
+            "ultimo_ms": round((muestras[-1] if muestras else 0.0) * 1000, 2),
+            "p50_ms": round(_percentil(muestras, 0.5) * 1000, 2),
+            "p99_ms": round(_percentil(muestras, 0.99) * 1000, 2),
+            "max_ventana_ms": round(max(muestras, default=0.0) * 1000, 2),
+            "max_ms": round(self._max * 1000, 2),
+            "muestras": len(muestras),
+        }
+
+
+def _bucket_paginas(paginas: Optional[int]) -> str:
+    if not paginas:
+        return "?"
+    for limite in (10, 50, 200):
+        if paginas <= limite:
+            return f"<={limite}"
+    return ">200"
+
+
+class _Serie:
+    """Media móvil exponencial más una ventana de muestras para cuantiles."""
+
+    def __init__(self, alfa: float, ventana: int):
+        self.alfa = alfa
+        self.ewma: Optional[float] = None
+        self.muestras: deque = deque(maxlen=ventana)
+        self.total = 0
+
+    def registrar(self, valor: float):
+        self.ewma = valor if self.ewma is None else self.alfa * valor + (1 - self.alfa) * self.ewma
+        self.muestras.append(valor)
+        self.total += 1
+
+    def resumen(self) -> Dict[str, Any]:
+        muestras = list(self.muestras)
+        return {
+            "ewma": round(self.ewma, 3) if self.ewma is not None else None,
+            "p50": round(_percentil(muestras, 0.5), 3),
+            "p90": round(_percentil(muestras, 0.9), 3),
+            "muestras": self.total,
+        }
+
+
+class PredictorTiempos:
+    """
+    Tiempos medidos por el worker y predicción del tiempo restante de cada análisis.
+
+    Los segundos por pregunta se agrupan por (modo, modelo, tramo de páginas); si un grupo
+    tiene pocas muestras se recurre a (modo, modelo) y después al global. La extracción se
+    mide en segundos por página. Las series se guardan en ``ruta`` para sobrevivir reinicios.
+    """
+
+    def __init__(
+        self,
+        ruta: Optional[Path] = None,
+        segundos_por_pregunta_inicial: float = 30.0,
+        segundos_por_pagina_inicial: float = 0.05,
+        alfa: float = 0.2,
+        ventana: int = 200,
+        min_muestras: int = 3,
+    ):
+        self.ruta = Path(ruta) if ruta else None
+        self.segundos_por_pregunta_inicial = segundos_por_pregunta_inicial
+        self.segundos_por_pagina_inicial = segundos_por_pagina_inicial
+        self.alfa = alfa
+        self.ventana = ventana
+        self.min_muestras = min_muestras
+        self._lock = threading.Lock()
+        self._series: Dict[str, _Serie] = {}
+        self._cargar()
+
+    def _serie(self, clave: str) -> _Serie:
+        serie = self._series.get(clave)
+        if serie is None:
+            serie = self._series[clave] = _Serie(self.alfa, self.ventana)
+        return serie
+
+    @staticmethod
+    def _claves_pregunta(modo: str, modelo: Optional[str], paginas: Optional[int]) -> List[str]:
+        return [
+            f"pregunta|{modo}|{modelo}|{_bucket_paginas(paginas)}",
+            f"pregunta|{modo}|{modelo}|*",
+            "pregunta|*",
+        ]
+
+    def registrar_pregunta(self, modo: str, modelo: Optional[str], paginas: Optional[int], segundos: float):
+        if segundos <= 0:
+            return
+        with self._lock:
+            for clave in self._claves_pregunta(modo, modelo, paginas):
+                self._serie(clave).registrar(segundos)
+
+    def registrar_extraccion(self, paginas: int, segundos: float):
+        if paginas > 0 and segundos > 0:
+            with self._lock:
+                self._serie("extraccion_pagina").registrar(segundos / paginas)
+
+    def registrar_espera_cola(self, segundos: float):
+        with self._lock:
+            self._serie("espera_cola").registrar(max(0.0, segundos))
+
+    def registrar_analisis(self, modo: str, modelo: Optional[str], paginas: Optional[int], segundos: float):
+        with self._lock:
+            self._serie(f"analisis|{modo}|{modelo}|{_bucket_paginas(paginas)}").registrar(segundos)
+            self._serie("analisis|*").registrar(segundos)
+
+    def registrar_escalado(self, modelo_barato: Optional[str], escalada: bool):
+        """Una pregunta de la cascada: 1 si el modelo principal tuvo que repetirla, 0 si no."""
+        with self._lock:
+            self._serie(f"cascada|{modelo_barato}").registrar(1.0 if escalada else 0.0)
+
+    def tasa_escalado(self, modelo_barato: Optional[str]) -> Optional[float]:
+        """Fracción (EWMA) de preguntas de la cascada escaladas al modelo principal, o None sin muestras."""
+        with self._lock:
+            serie = self._series.get(f"cascada|{modelo_barato}")
+            if serie is None or serie.total < self.min_muestras:
+                return None
+            return serie.ewma
+
+    def segundos_por_pregunta(
+        self,
+        modo: str = "texto",
+        modelo: Optional[str] = None,
+        paginas: Optional[int] = None,
+        cuantil: Optional[float] = None,
+    ) -> float:
+        """EWMA (o el cuantil pedido) del grupo más específico con suficientes muestras."""
+        with self._lock:
+            for clave in self._claves_pregunta(modo, modelo, paginas):
+                serie = self._series.get(clave)
+                if serie is not None and serie.total >= self.min_muestras:
+                    if cuantil is not None:
+                        return _percentil(list(serie.muestras), cuantil)
+                    return serie.ewma
+        return self.segundos_por_pregunta_inicial
+
+    def segundos_por_pagina(self) -> float:
+        with self._lock:
+            serie = self._series.get("extraccion_pagina")
+            return serie.ewma if serie is not None and serie.ewma is not None else self.segundos_por_pagina_inicial
+
+    def predecir_restante(
+        self,
+        modo: str,
+        modelo: Optional[str],
+        paginas: Optional[int],
+        preguntas_restantes: int,
+        extraccion_pendiente: bool = False,
+    ) -> Dict[str, float]:
+        """Segundos restantes estimados (EWMA) y pesimista (p90) para un análisis."""
+        extraccion = (paginas or 0) * self.segundos_por_pagina() if extraccion_pendiente else 0.0
+        restantes = max(0, preguntas_restantes)
+        return {
+            "restante_s": extraccion + restantes * self.segundos_por_pregunta(modo, modelo, paginas),
+            "restante_p90_s": extraccion + restantes * self.segundos_por_pregunta(modo, modelo, paginas, cuantil=0.9),
+        }
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._lock:
+            return {clave: serie.resumen() for clave, serie in sorted(self._series.items())}
+
+    def guardar(self):
+        if self.ruta is None:
+            return
+        # Varios hilos del worker guardan a la vez: se serializan con el lock y cada escritura
+        # usa su propio temporal, así el archivo publicado siempre está completo
+        with self._lock:
+            datos = {
+                clave: {"ewma": serie.ewma, "muestras": list(serie.muestras), "total": serie.total}
+                for clave, serie in self._series.items()
+            }
+            tmp = None
+            try:
+                self.ruta.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    "w", encoding="utf-8", dir=self.ruta.parent, prefix=f"{self.ruta.stem}.", suffix=".tmp", delete=False
+                ) as f:
+                    tmp = Path(f.name)
+                    json.dump(datos, f)
+                os.replace(tmp, self.ruta)
+            except Exception as e:
+                if tmp is not None:
+                    tmp.unlink(missing_ok=True)
+                logger.warning(f"⚠️ No se pudieron guardar las métricas de tiempos: {e}")
+
+    def _cargar(self):
+        if self.ruta is None or not self.ruta.exists():
+            return
+        try:
+            with open(self.ruta, "r", encoding="utf-8") as f:
+                datos = json.load(f)
+            for clave, valores in datos.items():
+                serie = self._serie(clave)
+                serie.ewma = valores.get("ewma")
+                serie.muestras.extend(valores.get("muestras") or [])
+                serie.total = int(valores.get("total") or len(serie.muestras))
+        except Exception as e:
+            logger.warning(f"⚠️ Métricas de tiempos ilegibles, se empieza de cero: {e}")
+
+
+monitor_event_loop = MonitorEventLoop()
+predictor_tiempos = PredictorTiempos(Path(__file__).resolve().parent / "cache" / "tiempos.json")
@@ -0,0 +1,108 @@
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+# Incrementar al cambiar la normalización: invalida el texto extraído en caché
+VERSION_NORMALIZACION = "1"
+
+# Líneas del principio y del final de cada página donde se buscan cabeceras y pies
+LINEAS_ZONA_CABECERA = 2
+# Una línea es cabecera/pie si se repite en esta fracción de las páginas (y en al menos MIN_PAGINAS_CABECERA)
+FRACCION_CABECERA = 0.5
+MIN_PAGINAS_CABECERA = 3
+
+_NUMERO_PAGINA_RE = re.compile(
+    r"^[\s\-–—|]*(?:p[aá]g(?:ina)?\.?|page|p\.)?\s*\d{1,4}\s*(?:(?:de|of|/)\s*\d{1,4})?[\s\-–—|]*$",
+    re.IGNORECASE,
+)
+_GUION_FINAL_RE = re.compile(r"(\w)[-\u2010]\n[ \t]*(?=[a-záéíóúüñ])")
+_ESPACIOS_RE = re.compile(r"[ \t\u00a0\u2000-\u200a\u202f\u3000]+")
+# Guiones blandos y caracteres de ancho cero que deja la extracción
+_INVISIBLES_RE = re.compile(r"[\u00ad\u200b-\u200d\ufeff]")
+_LINEAS_VACIAS_RE = re.compile(r"\n{3,}")
+_DIGITOS_RE = re.compile(r"\d+")
+
+
+def _firma(linea: str) -> str:
+    """Forma de la línea sin números, para reconocer "Contrato X - Página 3" y "... Página 4" como iguales."""
+    return _DIGITOS_RE.sub("#", _ESPACIOS_RE.sub(" ", linea).strip().lower())
+
+
+def _zonas(lineas: List[str]) -> List[int]:
+    """Índices de las primeras y últimas líneas no vacías de la página."""
+    no_vacias = [i for i, linea in enumerate(lineas) if linea.strip()]
+    return sorted(set(no_vacias[:LINEAS_ZONA_CABECERA] + no_vacias[-LINEAS_ZONA_CABECERA:]))
+
+
+def _cabeceras_repetidas(paginas: List[List[str]]) -> set:
+    """Firmas de las líneas que aparecen en la cabecera o el pie de muchas páginas."""
+    if len(paginas) < MIN_PAGINAS_CABECERA:
+        return set()
+    apariciones = Counter()
+    for lineas in paginas:
+        apariciones.update({_firma(lineas[i]) for i in _zonas(lineas)})
+    umbral = max(MIN_PAGINAS_CABECERA, math.ceil(len(paginas) * FRACCION_CABECERA))
+    return {firma for firma, n in apariciones.items() if firma and n >= umbral}
+
+
+def _limpiar_pagina(lineas: List[str], cabeceras: set) -> str:
+    zonas = set(_zonas(lineas))
+    conservadas = [
+        linea
+        for i, linea in enumerate(lineas)
+        if not (i in zonas and (_firma(linea) in cabeceras or _NUMERO_PAGINA_RE.match(linea)))
+    ]
+    texto = "\n".join(conservadas)
+    texto = _INVISIBLES_RE.sub("", texto)
+    texto = _GUION_FINAL_RE.sub(r"\1", texto)
+    texto = _ESPACIOS_RE.sub(" ", texto)
+    texto = "\n".join(linea.strip() for linea in texto.split("\n"))
+    return _LINEAS_VACIAS_RE.sub("\n\n", texto).strip()
+
+
+def normalizar_paginas(paginas: List[Tuple[int, str]]) -> Dict[str, Any]:
+    """
+    Limpia el texto extraído página a página para no gastar tokens en ruido.
+
+    Quita las cabeceras y pies que se repiten entre páginas y los números de página,
+    une las palabras partidas con guion a final de línea y colapsa los espacios.
+    Devuelve el texto y ``mapa_paginas``: el desplazamiento (en caracteres) donde
+    empieza cada página dentro del texto, para localizar citas.
+    """
+    lineas_paginas = [texto.split("\n") for _, texto in paginas]
+    cabeceras = _cabeceras_repetidas(lineas_paginas)
+
+    partes: List[str] = []
+    mapa_paginas: List[Dict[str, int]] = []
+    desplazamiento = 0
+    for (numero, _), lineas in zip(paginas, lineas_paginas):
+        texto = _limpiar_pagina(lineas, cabeceras)
+        if not texto:
+            continue
+        if partes:
+            desplazamiento += 2  # separador "\n\n"
+        mapa_paginas.append({"pagina": numero, "inicio": desplazamiento})
+        partes.append(texto)
+        desplazamiento += len(texto)
+
+    return {
+        "texto": "\n\n".join(partes),
+        "mapa_paginas": mapa_paginas,
+        "cabeceras_eliminadas": len(cabeceras),
+    }
+
+
+def desplazar_mapa(mapa_paginas: List[Dict[str, int]], desplazamiento: int) -> List[Dict[str, int]]:
+    """El mismo mapa para el texto precedido de ``desplazamiento`` caracteres (p. ej. el nombre del archivo)."""
+    return [{**entrada, "inicio": entrada["inicio"] + desplazamiento} for entrada in mapa_paginas]
+
+
+def pagina_en(mapa_paginas: List[Dict[str, int]], posicion: int) -> int:
+    """Número de página del carácter ``posicion`` del texto normalizado."""
+    pagina = mapa_paginas[0]["pagina"] if mapa_paginas else 1
+    for entrada in mapa_paginas:
+        if entrada["inicio"] > posicion:
+            break
+        pagina = entrada["pagina"]
+    return pagina
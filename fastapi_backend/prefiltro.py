@@ -0,0 +1,159 @@
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from clausulas import recorrer
+
+# Puntuar cada pregunta contra las cláusulas del contrato antes de llamar al LLM
+PREFILTRO_BM25 = os.getenv("PREFILTRO_BM25", "false").strip().lower() in {"1", "true", "si", "sí", "yes"}
+# Cobertura mínima (0-1) de los términos de la pregunta en la mejor cláusula
+UMBRAL_PREFILTRO = float(os.getenv("UMBRAL_PREFILTRO", "0.25") or 0.25)
+# Qué hacer con las preguntas por debajo del umbral: sin_evaluar (sin llamar al LLM) o modelo_barato
+ACCION_PREFILTRO = os.getenv("ACCION_PREFILTRO", "sin_evaluar").strip().lower()
+
+# Incrementar al cambiar la tokenización, las equivalencias o la puntuación: cambia qué
+# preguntas se filtran e invalida la reutilización de análisis anteriores
+VERSION_PREFILTRO = "2"
+
+# Parámetros habituales de BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Raíz de las palabras: los primeros caracteres tras quitar tildes y plurales ("facturas" -> "factur")
+LONGITUD_RAIZ = 6
+
+_PALABRA_RE = re.compile(r"[a-z0-9ñ]*[a-zñ][a-z0-9ñ]*")
+_VACIAS = set("""
+a al algo algun alguna algunas alguno algunos ante antes aquel aquella asi aun bajo cada como con contra cual
+cuales cuando de del desde donde dos durante el ella ellas ellos en entre era es esa esas ese eso esos esta estas
+este esto estos fue ha han hay hasta la las le les lo los mas me mi mientras muy nada ni no nos o otra otras otro
+otros para pero poco por porque que quien se sea sean segun ser si sin sobre solo su sus tal tambien tanto te
+tiene tienen todo todos tras tu un una unas uno unos y ya
+existe existen cualquier debe deben dicho dicha establece establecen indica preve preven regula contempla
+incluye dispone relativa relativo respecto caso forma parte misma mismo
+contrato presente clausula clausulas acuerdo partes parte documento
+the of and or to in on at by for from with without as is are was were be been being it its this that these those
+which who whom whose what when where why how any all some each no not nor only own same so than too very can will
+just should would could may might must shall do does did has have had there their they them such into over under
+about against between through during before after above below up down out off again further then once here both
+few more most other
+contract agreement clause clauses party parties document include includes provide provides state states
+exist exists regarding whether
+""".split())
+
+
+# Equivalencias inglés -> español de términos habituales en contratos, para que una pregunta
+# en un idioma encuentre las cláusulas del otro (se comparan raíces)
+_EQUIVALENCIAS = {
+    "paymen": "pago", "pay": "pago", "invoic": "factur", "price": "precio", "fee": "honora",
+    "term": "plazo", "deadli": "plazo", "delay": "retras", "late": "retras", "penalt": "penali",
+    "guaran": "garant", "warran": "garant", "bond": "aval", "insura": "seguro", "liabil": "respon",
+    "termin": "resolu", "damage": "dano", "indemn": "indemn", "confid": "confid", "law": "ley",
+    "jurisd": "jurisd", "arbitr": "arbitr", "disput": "contro", "force": "fuerza", "majeur": "mayor",
+    "subcon": "subcon", "assign": "cesion", "owner": "propie", "intell": "intele", "proper": "propie",
+    "tax": "impues", "durati": "duraci", "renewa": "renova", "notice": "notifi", "amendm": "modifi",
+    "accept": "recepc", "delive": "entreg", "work": "obra", "servic": "servic", "suppli": "sumini",
+    "advanc": "antici", "retent": "retenc", "curren": "moneda", "exchan": "cambio",
+    "permit": "permis", "licens": "licenc", "safety": "seguri", "enviro": "ambien",
+}
+# Se comparan raíces, que nunca superan LONGITUD_RAIZ: una clave o valor más largo no coincidiría
+_LARGAS = sorted(t for par in _EQUIVALENCIAS.items() for t in par if len(t) > LONGITUD_RAIZ)
+if _LARGAS:
+    raise ValueError(f"Equivalencias más largas que LONGITUD_RAIZ ({LONGITUD_RAIZ}): {', '.join(_LARGAS)}")
+
+
+def _sin_tildes(texto: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", texto) if unicodedata.category(c) != "Mn")
+
+
+def _raiz(palabra: str) -> str:
+    if len(palabra) > 4 and palabra.endswith("es") and palabra[-3] not in "aeiou":
+        palabra = palabra[:-2]
+    elif len(palabra) > 3 and palabra.endswith("s"):
+        palabra = palabra[:-1]
+    return palabra[:LONGITUD_RAIZ]
+
+
+def tokenizar(texto: str) -> List[str]:
+    """Raíces de las palabras del texto en español o inglés, sin tildes ni palabras vacías."""
+    palabras = _PALABRA_RE.findall(_sin_tildes((texto or "").lower()))
+    return [_raiz(p) for p in palabras if len(p) > 2 and p not in _VACIAS]
+
+
+def unidades_clausulas(texto: str, arbol: List[Dict[str, Any]], desplazamiento: int = 0) -> List[Tuple[str, str]]:
+    """
+    Texto propio de cada cláusula del árbol (sin el de sus subcláusulas, con los encabezados
+    de las que la contienen: "5. GARANTÍAS" da sentido a "5.1 El contratista constituirá un
+    aval...") y el preámbulo. ``desplazamiento`` es dónde empieza en ``texto`` el texto sobre
+    el que se segmentó.
+    """
+    if not arbol:
+        return [("documento", texto)] if texto.strip() else []
+    unidades = [("preambulo", texto[:desplazamiento + arbol[0]["inicio"]])]
+
+    def agregar(nodos: List[Dict[str, Any]], encabezados: str):
+        for nodo in nodos:
+            fin = nodo["hijos"][0]["inicio"] if nodo["hijos"] else nodo["fin"]
+            propio = texto[desplazamiento + nodo["inicio"]:desplazamiento + fin]
+            unidades.append((nodo["id"], f"{encabezados}{propio}"))
+            agregar(nodo["hijos"], f"{encabezados}{nodo['encabezado']}\n")
+
+    agregar(arbol, "")
+    return [(identificador, parte) for identificador, parte in unidades if parte.strip()]
+
+
+class IndiceBM25:
+    """Índice invertido BM25 en memoria sobre fragmentos de texto (las cláusulas del contrato)."""
+
+    def __init__(self, unidades: List[Tuple[str, str]]):
+        self.ids: List[str] = []
+        self.longitudes: List[int] = []
+        self.invertido: Dict[str, List[Tuple[int, int]]] = {}
+        for posicion, (identificador, texto) in enumerate(unidades):
+            terminos = Counter(tokenizar(texto))
+            self.ids.append(identificador)
+            self.longitudes.append(sum(terminos.values()))
+            for termino, frecuencia in terminos.items():
+                self.invertido.setdefault(termino, []).append((posicion, frecuencia))
+        self.media_longitud = sum(self.longitudes) / max(1, len(self.longitudes))
+
+    def _frecuencias(self, termino: str) -> Dict[int, int]:
+        """Apariciones del término (o de su equivalente en el otro idioma) por fragmento."""
+        frecuencias: Counter = Counter()
+        for variante in {termino, _EQUIVALENCIAS.get(termino, termino)}:
+            for posicion, frecuencia in self.invertido.get(variante, ()):
+                frecuencias[posicion] += frecuencia
+        return frecuencias
+
+    def _idf(self, df: int) -> float:
+        n = len(self.ids)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def puntuar(self, consulta: str) -> Dict[str, Any]:
+        """
+        Mejor fragmento para la consulta y su ``cobertura``: la puntuación BM25 dividida
+        entre la de un fragmento de longitud media con cada término una vez (hasta 1). Los
+        términos que no aparecen en ningún fragmento son los que más restan.
+        """
+        terminos = sorted(set(tokenizar(consulta)))
+        puntuaciones: Counter = Counter()
+        maxima = 0.0
+        ausentes = []
+        for termino in terminos:
+            frecuencias = self._frecuencias(termino)
+            idf = self._idf(len(frecuencias))
+            maxima += idf
+            if not frecuencias:
+                ausentes.append(termino)
+            for posicion, frecuencia in frecuencias.items():
+                normalizacion = 1 - BM25_B + BM25_B * self.longitudes[posicion] / max(1.0, self.media_longitud)
+                puntuaciones[posicion] += idf * frecuencia * (BM25_K1 + 1) / (frecuencia + BM25_K1 * normalizacion)
+
+        mejor: Optional[Tuple[int, float]] = puntuaciones.most_common(1)[0] if puntuaciones else None
+        return {
+            "cobertura": round(min(1.0, mejor[1] / maxima), 3) if mejor and maxima else 0.0,
+            "mejor_fragmento": self.ids[mejor[0]] if mejor else None,
+            "terminos_ausentes": ausentes,
+        }
@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Espera sin respuesta de un backend que ha fallado: se dobla con cada fallo seguido hasta el máximo
+ENFRIAMIENTO_S = 30
+ENFRIAMIENTO_MAX_S = 300
+# Tiempo máximo esperando a que algún backend tenga cupo libre
+ESPERA_MAX_BACKEND_S = 120
+
+# Errores de la petición en sí (p. ej. prompt demasiado largo): otro backend fallaría igual
+_ESTADOS_SIN_REINTENTO = {400, 413, 422}
+
+
+class SinBackendsDisponibles(RuntimeError):
+    """Ningún backend del pool puede atender la llamada."""
+
+
+def _estado_http(error: Exception) -> Optional[int]:
+    for atributo in ("status_code", "code"):
+        valor = getattr(error, atributo, None)
+        if isinstance(valor, int):
+            return valor
+    respuesta = getattr(error, "response", None)
+    valor = getattr(respuesta, "status_code", None)
+    return valor if isinstance(valor, int) else None
+
+
+class Backend:
+    """Un deployment de Azure o un modelo de Gemini del pool, con su cuota y su salud."""
+
+    def __init__(
+        self,
+        nombre: str,
+        proveedor: str,
+        modelo: str,
+        peso: float = 1.0,
+        max_en_vuelo: int = 0,
+        rpm: int = 0,
+        grupo: str = "principal",
+        opciones: Optional[Dict[str, Any]] = None,
+    ):
+        self.nombre = nombre
+        self.proveedor = proveedor
+        self.modelo = modelo
+        self.peso = max(0.01, float(peso))
+        self.max_en_vuelo = max(0, int(max_en_vuelo))
+        self.rpm = max(0, int(rpm))
+        self.grupo = grupo
+        self.opciones = opciones or {}
+        self.en_vuelo = 0
+        self.llamadas = 0
+        self.errores = 0
+        self.fallos_seguidos = 0
+        self.enfriado_hasta = 0.0
+        self.duracion_total_s = 0.0
+        self._inicios: deque = deque()
+
+    def _limpiar_ventana(self, ahora: float):
+        while self._inicios and ahora - self._inicios[0] >= 60:
+            self._inicios.popleft()
+
+    def sano(self, ahora: float) -> bool:
+        return ahora >= self.enfriado_hasta
+
+    def espera_cupo(self, ahora: float) -> float:
+        """Segundos hasta que admita otra llamada por su cuota (0 si la admite ya)."""
+        if self.max_en_vuelo and self.en_vuelo >= self.max_en_vuelo:
+            return float("inf")
+        self._limpiar_ventana(ahora)
+        if self.rpm and len(self._inicios) >= self.rpm:
+            return 60 - (ahora - self._inicios[0])
+        return 0.0
+
+    def resumen(self, ahora: float) -> Dict[str, Any]:
+        self._limpiar_ventana(ahora)
+        return {
+            "proveedor": self.proveedor,
+            "modelo": self.modelo,
+            "grupo": self.grupo,
+            "peso": self.peso,
+            "sano": self.sano(ahora),
+            "en_vuelo": self.en_vuelo,
+            "llamadas_ultimo_minuto": len(self._inicios),
+            "llamadas": self.llamadas,
+            "errores": self.errores,
+            "duracion_media_s": round(self.duracion_total_s / self.llamadas, 2) if self.llamadas else None,
+        }
+
+
+class PoolProveedores:
+    """
+    Reparte las llamadas al LLM entre varios backends (deployments de Azure y modelos de
+    Gemini) del mismo ``grupo``.
+
+    Se elige el backend sano con menos llamadas en curso en proporción a su ``peso`` y con
+    cupo (``max_en_vuelo`` simultáneas, ``rpm`` por minuto). Si un backend falla se deja
+    en enfriamiento y la llamada se repite en el siguiente; los errores de la propia
+    petición (400, prompt demasiado largo...) no cambian de backend.
+    """
+
+    def __init__(self, backends: List[Backend], crear_llm: Callable[[Backend], Any]):
+        self.backends = backends
+        self.crear_llm = crear_llm
+        self._condicion = threading.Condition()
+        self.reintentos = 0
+
+    def _candidatos(self, grupo: str, proveedores: Optional[Set[str]]) -> List[Backend]:
+        return [
+            b for b in self.backends
+            if b.grupo == grupo and (proveedores is None or b.proveedor in proveedores)
+        ]
+
+    def _reservar(self, candidatos: List[Backend], excluidos: Set[str]) -> Backend:
+        limite = time.monotonic() + ESPERA_MAX_BACKEND_S
+        with self._condicion:
+            while True:
+                ahora = time.monotonic()
+                disponibles = [b for b in candidatos if b.nombre not in excluidos]
+                if not disponibles:
+                    raise SinBackendsDisponibles("Todos los backends del pool han fallado para esta llamada")
+                sanos = [b for b in disponibles if b.sano(ahora)]
+                # Si todos están en enfriamiento se prueba el que antes sale de él
+                if not sanos:
+                    sanos = [min(disponibles, key=lambda b: b.enfriado_hasta)]
+                con_cupo = [b for b in sanos if b.espera_cupo(ahora) <= 0]
+                if con_cupo:
+                    backend = min(con_cupo, key=lambda b: ((b.en_vuelo + 1) / b.peso, b.llamadas))
+                    backend.en_vuelo += 1
+                    backend.llamadas += 1
+                    backend._inicios.append(ahora)
+                    return backend
+                espera = min(min(b.espera_cupo(ahora) for b in sanos), limite - ahora)
+                if espera <= 0:
+                    raise SinBackendsDisponibles(f"Ningún backend con cupo libre en {ESPERA_MAX_BACKEND_S} s")
+                self._condicion.wait(espera)
+
+    def _liberar(self, backend: Backend, duracion: float, error: Optional[Exception]):
+        with self._condicion:
+            backend.en_vuelo -= 1
+            backend.duracion_total_s += duracion
+            if error is None:
+                backend.fallos_seguidos = 0
+            else:
+                backend.errores += 1
+                backend.fallos_seguidos += 1
+                enfriamiento = min(ENFRIAMIENTO_MAX_S, ENFRIAMIENTO_S * 2 ** (backend.fallos_seguidos - 1))
+                backend.enfriado_hasta = time.monotonic() + enfriamiento
+            self._condicion.notify_all()
+
+    def ejecutar(
+        self,
+        invocar: Callable[[Any, Backend], Any],
+        grupo: str = "principal",
+        proveedores: Optional[Set[str]] = None,
+    ) -> Tuple[Any, Backend]:
+        """
+        ``invocar(llm, backend)`` en un backend del ``grupo`` (y de ``proveedores``, si se
+        indica), pasando al siguiente si falla. Devuelve su resultado y el backend que respondió.
+        """
+        candidatos = self._candidatos(grupo, proveedores)
+        if not candidatos:
+            raise SinBackendsDisponibles(f"No hay backends configurados para '{grupo}'")
+
+        excluidos: Set[str] = set()
+        while True:
+            backend = self._reservar(candidatos, excluidos)
+            inicio = time.monotonic()
+            try:
+                resultado = invocar(self.crear_llm(backend), backend)
+            except Exception as e:
+                if _estado_http(e) in _ESTADOS_SIN_REINTENTO:
+                    self._liberar(backend, time.monotonic() - inicio, None)
+                    raise
+                self._liberar(backend, time.monotonic() - inicio, e)
+                excluidos.add(backend.nombre)
+                if len(excluidos) >= len(candidatos):
+                    raise
+                self.reintentos += 1
+                logger.warning(f"🔀 Backend {backend.nombre} no disponible, se reintenta en otro: {e}")
+                continue
+            self._liberar(backend, time.monotonic() - inicio, None)
+            return resultado, backend
+
+    def grupos(self) -> Set[str]:
+        return {b.grupo for b in self.backends}
+
+    def resumen(self) -> Dict[str, Any]:
+        with self._condicion:
+            ahora = time.monotonic()
+            return {
+                "backends": {b.nombre: b.resumen(ahora) for b in self.backends},
+                "reintentos": self.reintentos,
+            }
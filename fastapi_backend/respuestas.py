@@ -0,0 +1,118 @@
+import json
+import math
+from numbers import Real
+from typing import Any
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependencia opcional
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dependencia opcional
+    brotli = None
+
+
+def _sanitize_json_for_response(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _sanitize_json_for_response(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_sanitize_json_for_response(item) for item in value]
+    if isinstance(value, Real):
+        if math.isnan(value) or math.isinf(value):
+            return None
+    return value
+
+
+class RespuestaJSON(JSONResponse):
+    """Respuesta JSON serializada con orjson.
+
+    orjson convierte NaN/Inf en ``null`` al escribir, por lo que no hace falta recorrer
+    la respuesta para sanearla. Sin orjson se usa el encoder estándar y solo se sanea
+    si el contenido lo requiere (ficheros de progreso antiguos).
+    """
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(
+                content,
+                default=str,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+            )
+        try:
+            return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        except ValueError:
+            return json.dumps(
+                _sanitize_json_for_response(content), ensure_ascii=False, separators=(",", ":")
+            ).encode("utf-8")
+
+
+def _codificaciones_aceptadas(scope) -> set:
+    cabecera = Headers(scope=scope).get("accept-encoding", "")
+    return {parte.split(";")[0].strip().lower() for parte in cabecera.split(",") if parte.strip()}
+
+
+class CompresionMiddleware:
+    """Comprime con brotli o gzip, según negocie el cliente, las respuestas grandes.
+
+    Los streams (SSE, respuestas en varios bloques) se envían sin comprimir para no
+    retener eventos en el buffer del compresor.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, brotli_quality: int = 5, gzip_level: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.brotli_quality = brotli_quality
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if brotli is not None and "br" in _codificaciones_aceptadas(scope):
+            await self._responder_brotli(scope, receive, send)
+            return
+
+        await self.gzip(scope, receive, send)
+
+    async def _responder_brotli(self, scope, receive, send):
+        inicio = None
+
+        async def enviar(message):
+            nonlocal inicio
+
+            if message["type"] == "http.response.start":
+                inicio = message
+                return
+
+            if message["type"] == "http.response.body" and inicio is not None:
+                mensaje_inicio, inicio = inicio, None
+                cuerpo = message.get("body", b"")
+                cabeceras = MutableHeaders(scope=mensaje_inicio)
+
+                if (
+                    message.get("more_body", False)
+                    or len(cuerpo) < self.minimum_size
+                    or "content-encoding" in cabeceras
+                ):
+                    await send(mensaje_inicio)
+                    await send(message)
+                    return
+
+                comprimido = brotli.compress(cuerpo, quality=self.brotli_quality)
+                cabeceras["Content-Encoding"] = "br"
+                cabeceras["Content-Length"] = str(len(comprimido))
+                cabeceras.add_vary_header("Accept-Encoding")
+                await send(mensaje_inicio)
+                await send({"type": "http.response.body", "body": comprimido})
+                return
+
+            await send(message)
+
+        await self.app(scope, receive, enviar)
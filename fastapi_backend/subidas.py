@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SubidaNoEncontrada(Exception):
+    pass
+
+
+class OffsetInvalido(Exception):
+    """El bloque no continúa donde termina lo recibido; ``offset`` indica desde dónde reanudar."""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Offset inválido, se esperaba {offset}")
+        self.offset = offset
+
+
+class AlmacenSubidas:
+    """Subidas reanudables por bloques: ``<id>.part`` con los datos y ``<id>.json`` con metadatos.
+
+    El SHA-256 se va calculando en memoria con cada bloque contiguo; si el proceso se
+    reinicia a mitad de una subida se recalcula al completarla. Una subida completada
+    conserva sus metadatos (``completada``) hasta caducar: un reintento de la misma
+    petición la resuelve por su hash en lugar de recibir 404.
+    """
+
+    def __init__(self, directorio: Path, ttl_horas: float = 24):
+        self.directorio = Path(directorio)
+        self.ttl_s = ttl_horas * 3600
+        self._lock = threading.Lock()
+        self._locks: Dict[str, threading.Lock] = {}
+        self._digests: Dict[str, Any] = {}
+
+    def _rutas(self, id_subida: str):
+        if not id_subida or "/" in id_subida or "\\" in id_subida or id_subida.startswith("."):
+            raise SubidaNoEncontrada(id_subida)
+        return self.directorio / f"{id_subida}.part", self.directorio / f"{id_subida}.json"
+
+    def _lock_de(self, id_subida: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(id_subida, threading.Lock())
+
+    def _leer_meta(self, id_subida: str) -> Dict[str, Any]:
+        _, meta_path = self._rutas(id_subida)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise SubidaNoEncontrada(id_subida)
+
+    def crear(self, nombre: str, tamano: int, sha256: Optional[str] = None) -> Dict[str, Any]:
+        self.directorio.mkdir(parents=True, exist_ok=True)
+        self.purgar_caducadas()
+
+        id_subida = str(uuid.uuid4())
+        part_path, meta_path = self._rutas(id_subida)
+        meta = {
+            "id_subida": id_subida,
+            "nombre": Path(nombre or "documento").name,
+            "tamano": int(tamano),
+            "sha256": (sha256 or "").lower() or None,
+            "creada": time.time(),
+        }
+        part_path.touch()
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        self._digests[id_subida] = hashlib.sha256()
+
+        logger.info("📤 Subida reanudable creada: %s (%s, %d bytes)", id_subida, meta["nombre"], meta["tamano"])
+        return {**meta, "offset": 0}
+
+    def estado(self, id_subida: str) -> Dict[str, Any]:
+        meta = self._leer_meta(id_subida)
+        if meta.get("completada"):
+            return {**meta, "offset": meta["tamano"], "completa": True}
+        part_path, _ = self._rutas(id_subida)
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        return {**meta, "offset": offset, "completa": offset >= meta["tamano"]}
+
+    def escribir_bloque(self, id_subida: str, offset: int, bloque: bytes) -> Dict[str, Any]:
+        """Añade ``bloque`` en ``offset``. Los reenvíos de un bloque ya recibido se ignoran."""
+        with self._lock_de(id_subida):
+            estado = self.estado(id_subida)
+            actual = estado["offset"]
+
+            if offset + len(bloque) <= actual:
+                # Reintento de un bloque que ya llegó entero
+                return estado
+            if offset != actual:
+                raise OffsetInvalido(actual)
+            if actual + len(bloque) > estado["tamano"]:
+                raise ValueError("El bloque excede el tamaño declarado de la subida")
+
+            part_path, _ = self._rutas(id_subida)
+            with open(part_path, "ab") as f:
+                f.write(bloque)
+
+            digest = self._digests.get(id_subida)
+            if digest is not None:
+                digest.update(bloque)
+
+            actual += len(bloque)
+            return {**estado, "offset": actual, "completa": actual >= estado["tamano"]}
+
+    def _verificar(self, id_subida: str) -> Dict[str, Any]:
+        estado = self.estado(id_subida)
+        if estado.get("completada"):
+            return estado
+        if not estado["completa"]:
+            raise ValueError(
+                f"Subida {id_subida} incompleta: {estado['offset']}/{estado['tamano']} bytes"
+            )
+
+        part_path, _ = self._rutas(id_subida)
+        digest = self._digests.get(id_subida)
+        if digest is None:
+            digest = hashlib.sha256()
+            with open(part_path, "rb") as f:
+                for bloque in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(bloque)
+            self._digests[id_subida] = digest
+        sha256 = digest.hexdigest()
+
+        if estado["sha256"] and estado["sha256"] != sha256:
+            raise ValueError(f"SHA-256 de la subida {id_subida} no coincide con el declarado")
+        return {**estado, "sha256": sha256}
+
+    def verificar(self, id_subida: str) -> Dict[str, Any]:
+        """Comprueba que la subida está completa y su hash, sin consumirla. Devuelve nombre, tamaño y SHA-256."""
+        with self._lock_de(id_subida):
+            estado = self._verificar(id_subida)
+        return {"nombre": estado["nombre"], "tamano": estado["tamano"], "sha256": estado["sha256"]}
+
+    def completar(self, id_subida: str, destino: Path) -> Optional[Dict[str, Any]]:
+        """
+        Verifica la subida y la mueve a ``destino``. Devuelve nombre, tamaño y SHA-256, o
+        ``None`` si ya se había completado antes (sus datos están en el almacén de blobs).
+        """
+        with self._lock_de(id_subida):
+            estado = self._verificar(id_subida)
+            if estado.get("completada"):
+                return None
+
+            part_path, meta_path = self._rutas(id_subida)
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(part_path, destino)
+            self._digests.pop(id_subida, None)
+
+            meta = {k: v for k, v in estado.items() if k not in ("offset", "completa")}
+            meta["completada"] = time.time()
+            tmp_path = meta_path.with_suffix(".json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+
+        return {"nombre": estado["nombre"], "tamano": estado["tamano"], "sha256": estado["sha256"]}
+
+    def purgar_caducadas(self):
+        """Elimina las subidas abandonadas hace más de ``ttl_horas``."""
+        limite = time.time() - self.ttl_s
+        for meta_path in self.directorio.glob("*.json"):
+            try:
+                if meta_path.stat().st_mtime >= limite:
+                    continue
+                id_subida = meta_path.stem
+                part_path, _ = self._rutas(id_subida)
+                if part_path.exists() and part_path.stat().st_mtime >= limite:
+                    continue
+                part_path.unlink(missing_ok=True)
+                meta_path.unlink(missing_ok=True)
+                self._digests.pop(id_subida, None)
+                with self._lock:
+                    self._locks.pop(id_subida, None)
+                logger.info("🧹 Subida caducada eliminada: %s", id_subida)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo purgar la subida {meta_path.name}: {e}")
@@ -1,19 +1,85 @@
 import time
 import json
+import copy
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 import pandas as pd
 from pathlib import Path
 import logging
-from typing import Dict, Optional, List, Tuple, Any
+from typing import Dict, Optional, List, Tuple, Any, Callable, Union
 import math
 from numbers import Real
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-import base64
 import os
 from io import BytesIO
 from langchain_openai import AzureChatOpenAI
 from langchain_core.messages import HumanMessage
 
+from eventos import (
+    bus_eventos,
+    EVENTO_ERROR,
+    EVENTO_ESTADO,
+    EVENTO_PREGUNTA_COMPLETADA,
+)
+from adjuntos_llm import (
+    ADELGAZAR_PDF,
+    ADJUNTOS_CACHE_MB,
+    CALIDAD_IMAGENES_ADJUNTOS,
+    DPI_IMAGENES_ADJUNTOS,
+    MODO_ADJUNTOS,
+    AdelgazadorPdf,
+    AlmacenAdjuntos,
+    recortar_pdf,
+)
+from clausulas import (
+    VERSION_CLAUSULAS,
+    buscar_clausula,
+    contar_clausulas,
+    referencias_en,
+    segmentar_clausulas,
+)
+from contexto_llm import (
+    ESTRATEGIA_CONTEXTO,
+    MARGEN_RESPUESTA_TOKENS,
+    MAX_TOKENS_CONTEXTO,
+    TOKENS_POR_FRAGMENTO,
+    TOKENS_POR_VENTANA_MAPA,
+    VENTANA_CONTEXTO_TOKENS,
+    ajustar_contexto,
+    contar_tokens,
+    dividir_en_ventanas,
+    elegir_paginas,
+    indexar,
+    paginas_definiciones,
+    presupuesto_contexto,
+    tokens_adjuntos,
+    ventana_contexto,
+)
+from metricas import predictor_tiempos
+from proveedores_llm import Backend, PoolProveedores
+from prefiltro import (
+    ACCION_PREFILTRO,
+    PREFILTRO_BM25,
+    UMBRAL_PREFILTRO,
+    VERSION_PREFILTRO,
+    IndiceBM25,
+    unidades_clausulas,
+)
+from normalizacion import VERSION_NORMALIZACION, desplazar_mapa, normalizar_paginas
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependencia opcional
+    orjson = None
+
+try:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+except ImportError:  # pragma: no cover - solo hace falta con backends de Gemini
+    ChatGoogleGenerativeAI = None
+
 # Cargar variables de entorno desde .env si existe
 try:
     from dotenv import load_dotenv
@@ -29,6 +95,174 @@ logger = logging.getLogger(__name__)
 
 DEFAULT_GEMINI_MODEL = "gemini-2.5-flash-preview-05-20"
 AZURE_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-12-01-preview").strip() or "2024-12-01-preview"
+# Deployment económico del mismo recurso de Azure para las preguntas que no necesitan el principal
+AZURE_DEPLOYMENT_NAME_BARATO = os.getenv("AZURE_DEPLOYMENT_NAME_BARATO", "").strip()
+# Pool de backends del LLM (JSON): [{"nombre", "proveedor": "azure"|"gemini", "modelo", "peso",
+# "max_en_vuelo", "rpm", "grupo": "principal"|"barato", "endpoint", "api_key_env"}]. Vacío: el
+# deployment de AZURE_DEPLOYMENT_NAME (o Gemini si no hay Azure) y AZURE_DEPLOYMENT_NAME_BARATO
+PROVEEDORES_LLM = os.getenv("PROVEEDORES_LLM", "").strip()
+# Cascada: responde primero el deployment barato y se repite en el principal si hace falta
+CASCADA_MODELOS = os.getenv("CASCADA_MODELOS", "false").strip().lower() in {"1", "true", "si", "sí", "yes"}
+# Texto extraído de cada PDF, indexado por el SHA-256 del documento
+EXTRACCION_CACHE_DIR = Path(__file__).resolve().parent / "cache" / "extraccion"
+# Índice huella -> análisis completado, para reutilizar resultados de análisis idénticos
+HUELLAS_CACHE_DIR = Path(__file__).resolve().parent / "cache" / "huellas"
+# Versión adelgazada de cada PDF adjunto (ADELGAZAR_PDF), por SHA-256 del original, DPI y calidad de las imágenes
+PDF_ADELGAZADO_CACHE_DIR = Path(__file__).resolve().parent / "cache" / "pdf_adelgazado"
+# Hallazgos del paso map del map-reduce por ventana, pregunta y modelo
+MAPAS_CACHE_DIR = Path(__file__).resolve().parent / "cache" / "mapas"
+# Árbol de cláusulas y anexos de cada documento, por SHA-256
+CLAUSULAS_CACHE_DIR = Path(__file__).resolve().parent / "cache" / "clausulas"
+# Ventanas que se consultan a la vez en el paso map
+MAPREDUCE_PARALELISMO = max(1, int(os.getenv("MAPREDUCE_PARALELISMO", "4") or 1))
+# Incrementar al cambiar los prompts: invalida la reutilización de análisis anteriores
+VERSION_PROMPTS = "2"
+# Tokens (entrada + salida) que puede gastar un análisis; 0 = sin límite. Cada análisis puede fijar el suyo
+PRESUPUESTO_TOKENS_ANALISIS = int(os.getenv("PRESUPUESTO_TOKENS_ANALISIS", "0") or 0)
+# Al agotarlo: "pausar" (se reanuda con /reanudar) o "degradar" (el resto de preguntas en modo texto
+# con la estrategia ``fragmentos`` y un contexto menor; se pausa si no queda un modo más barato)
+ACCION_PRESUPUESTO = os.getenv("ACCION_PRESUPUESTO", "pausar").strip().lower()
+# Tokens de documento por pregunta en un análisis degradado (0 = solo se pasa de adjuntos a texto)
+TOKENS_CONTEXTO_DEGRADADO = int(os.getenv("TOKENS_CONTEXTO_DEGRADADO", "8000") or 0)
+# En modo adjuntos, enviar en cada pregunta solo las páginas relacionadas (índice de texto local)
+# y las de definiciones en lugar de los PDF completos
+ADJUNTOS_POR_PAGINAS = os.getenv("ADJUNTOS_POR_PAGINAS", "false").strip().lower() in {"1", "true", "si", "sí", "yes"}
+PAGINAS_POR_PREGUNTA = int(os.getenv("PAGINAS_POR_PREGUNTA", "6") or 6)
+PAGINAS_DEFINICIONES = int(os.getenv("PAGINAS_DEFINICIONES", "2") or 0)
+# Instrucciones y documento antes que la pregunta: el prefijo del prompt es idéntico en todas las
+# preguntas del análisis y la caché de prompts del proveedor lo cobra como tokens en caché
+PROMPT_PREFIJO_ESTABLE = os.getenv("PROMPT_PREFIJO_ESTABLE", "true").strip().lower() not in {"0", "false", "no"}
+
+# Prompts del análisis (modo adjuntos PDF y modo texto); también los usa el estimador de tokens
+PROMPT_SISTEMA_ADJUNTOS = """You are a legal assistant specialized in contract analysis. Answer the user's question clearly and precisely, using the attached document(s) as context.
+
+Your answer must be written in Markdown format, suitable for inclusion in a DOCX document (use clear sections, bullet points, or numbered lists donde cada punto sea muy breve).
+
+Haz la respuesta lo más concisa posible: máximo tres puntos o frases cortas y alrededor de 70 palabras en total.
+
+Incluye únicamente los datos imprescindibles para justificar la respuesta, citando cláusulas, apartados o anexos relevantes cuando proceda.
+
+Responde siempre en español neutro.
+
+At the end of your answer, assess the legal risk level based on the following criteria:
+- HIGH: Clauses that may create significant liabilities, unilateral termination, severe penalties, ambiguous terms favoring the other party, or lack of important protections.
+- MEDIUM: Terms that require attention but do not pose immediate risks, standard clauses that could be improved.
+- LOW: Favorable or neutral terms, standard industry clauses, or adequate protections.
+- NOT EVALUATED: If you do not have enough information to assess the risk, or the question is not applicable, finish your answer with "RISK: NOT EVALUATED".
+
+Finish your answer with a line that clearly states: "RISK: [HIGH/MEDIUM/LOW/NOT EVALUATED]"""  # noqa: E501
+
+PROMPT_HUMANO_ADJUNTOS = (
+    "Section: {seccion}\n"
+    "Question: {pregunta}\n\n"
+    "Please analyze the attached PDF contract(s) and answer the question."
+)
+
+PROMPT_SISTEMA_TEXTO = """
+            You are a legal assistant specialized in contract analysis. Answer based only on the attached document.
+
+Instructions:
+
+Write in Markdown, suitable for DOCX.
+
+Use clear headings and max 3 bullet points or short sentences.
+
+Limit to ~70 words total.
+
+Reference specific clauses/sections when possible.
+
+Be concise, professional, neutral, and precise.
+
+Risk Assessment:
+At the end, assign a legal risk level:
+
+HIGH – major liabilities, penalties, unilateral rights, missing protections.
+
+MEDIUM – terms need attention but not critical.
+
+LOW – neutral or protective terms.
+
+NOT EVALUATED – insufficient info.
+
+Final line:
+RISK: [HIGH/MEDIUM/LOW/NOT EVALUATED]
+
+Sample Answers
+Termination Clause
+
+Either party may terminate with 30 days’ notice (Clause 12.2).
+
+No penalty or compensation for early exit.
+
+Potential exposure to sudden termination.
+
+RISK: HIGH
+
+Payment Terms
+
+Payment due within 45 days after invoice (Clause 5.1).
+
+No interest defined for late payment.
+
+Standard but enforcement could be weak.
+
+RISK: MEDIUM
+
+Confidentiality
+
+Mutual non-disclosure obligations (Clause 8.3).
+
+Duration: 2 years post-termination.
+
+Adequate and aligned with industry standards.
+
+RISK: LOW
+
+Liability
+
+Liability capped at total contract value (Clause 9.4).
+
+Excludes gross negligence and willful misconduct.
+
+Balanced and protective framework.
+
+RISK: LOW
+"""
+
+PROMPT_HUMANO_TEXTO = """
+            Section: {seccion}
+            Question: {pregunta}
+            Document to analyze:{texto_contrato}"""
+
+# Variante con prefijo estable (PROMPT_PREFIJO_ESTABLE): el documento va antes de la pregunta
+PROMPT_HUMANO_TEXTO_ESTABLE = """Document to analyze:
+{texto_contrato}
+
+Section: {seccion}
+Question: {pregunta}"""
+
+# Map-reduce: cada ventana del documento extrae hallazgos y la reducción responde con PROMPT_SISTEMA_TEXTO
+SIN_HALLAZGOS = "NONE"
+
+PROMPT_SISTEMA_MAPA = """You are a legal assistant reviewing one excerpt of a long contract that does not fit in a single request.
+
+Extract only the facts in this excerpt that help answer the question: short bullet points, quoting clause, section, annex or page references when present, and keeping figures, deadlines and amounts verbatim.
+
+Do not answer the question or assess risk; another step will combine the findings of all excerpts.
+
+If the excerpt contains nothing relevant to the question, answer exactly: NONE"""
+
+# La ventana va antes de la pregunta: todas las preguntas comparten el prefijo de cada ventana
+PROMPT_HUMANO_MAPA = (
+    "Excerpt {indice} of {total}:\n{fragmento}\n\n"
+    "Section: {seccion}\n"
+    "Question: {pregunta}"
+)
+
+PROMPT_HUMANO_REDUCCION = """
+            Section: {seccion}
+            Question: {pregunta}
+            The document was too long to send at once. These are the relevant findings extracted from each of its excerpts:{hallazgos}"""
 
 
 def _sanitize_azure_endpoint(raw_endpoint: str) -> str:
@@ -61,14 +295,14 @@ def _calcular_total_paginas(pdf_bytes: bytes) -> Optional[int]:
         return None
 
 
-def _extraer_texto_pdf(pdf_bytes: bytes) -> str:
-    """Extrae texto de un PDF en bloques por página."""
+def _extraer_paginas_pdf(pdf_bytes: bytes) -> List[Tuple[int, str]]:
+    """Extrae el texto en bruto de cada página con texto de un PDF."""
     try:
         import PyPDF2
     except ImportError as exc:
         raise RuntimeError("PyPDF2 es requerido para extraer texto de PDF") from exc
 
-    texto_paginas: List[str] = []
+    texto_paginas: List[Tuple[int, str]] = []
 
     pdf_reader = PyPDF2.PdfReader(BytesIO(pdf_bytes))
     for num_pagina, page in enumerate(pdf_reader.pages, start=1):
@@ -79,9 +313,25 @@ def _extraer_texto_pdf(pdf_bytes: bytes) -> str:
             continue
 
         if texto.strip():
-            texto_paginas.append(f"--- Página {num_pagina} ---\n{texto}")
+            texto_paginas.append((num_pagina, texto))
 
-    return "\n\n".join(texto_paginas).strip()
+    return texto_paginas
+
+
+def _extraer_texto_pdf(pdf_bytes: bytes) -> str:
+    """Extrae el texto normalizado de un PDF (sin cabeceras, pies ni números de página)."""
+    return normalizar_paginas(_extraer_paginas_pdf(pdf_bytes))["texto"]
+
+
+def _serializar_progreso(progreso_data: Dict[str, Any]) -> bytes:
+    """Serializa el progreso; NaN/Inf se escriben como null para que la API no tenga que sanearlo."""
+    if orjson is not None:
+        return orjson.dumps(
+            progreso_data,
+            default=str,
+            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
+    return json.dumps(_sanitize_json(progreso_data), indent=2, ensure_ascii=False).encode("utf-8")
 
 
 def _sanitize_json(value: Any) -> Any:
@@ -95,39 +345,259 @@ def _sanitize_json(value: Any) -> Any:
     return value
 
 
-def _preparar_contexto_documentos(contratos_paths: List[Path]) -> Dict[str, Any]:
+def guardar_progreso(
+    progreso_path: Path,
+    progreso_data: Dict[str, Any],
+    evento: str = EVENTO_ESTADO,
+    datos_evento: Optional[Dict[str, Any]] = None,
+    indices_modificados: Optional[List[int]] = None,
+    reiniciar_resultados: bool = False,
+) -> int:
+    """Persiste el progreso con una nueva versión y notifica el cambio a los suscriptores.
+
+    Los resultados en ``indices_modificados`` quedan marcados con la nueva versión para
+    que ``/resultados`` pueda servir solo lo cambiado. ``reiniciar_resultados`` indica
+    que la lista se ha sustituido y los clientes deben descartar su copia.
+    """
+    progreso_path = Path(progreso_path)
+    id_analisis = progreso_path.stem
+
+    version = bus_eventos.siguiente_version(id_analisis, progreso_data.get("version"))
+    progreso_data["version"] = version
+
+    resultados = progreso_data.get("resultados") or []
+    for indice in indices_modificados or []:
+        if 0 <= indice < len(resultados) and isinstance(resultados[indice], dict):
+            resultados[indice]["version"] = version
+    if reiniciar_resultados:
+        progreso_data["version_reinicio_resultados"] = version
+
+    # Escritura atómica: los clientes releen el fichero en cuanto reciben el evento. Cada
+    # escritor usa su propio temporal (la API y el worker pueden guardar el mismo análisis)
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=progreso_path.parent, prefix=f"{id_analisis}.", suffix=".json.tmp", delete=False
+    ) as f:
+        tmp_path = Path(f.name)
+        f.write(_serializar_progreso(progreso_data))
+    try:
+        os.replace(tmp_path, progreso_path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    datos = {
+        "estado": progreso_data.get("estado"),
+        "progreso": progreso_data.get("progreso"),
+        "total_preguntas": progreso_data.get("total_preguntas"),
+        "total_paginas": progreso_data.get("total_paginas"),
+        "uso_tokens": progreso_data.get("uso_tokens"),
+    }
+    if progreso_data.get("error"):
+        datos["error"] = progreso_data["error"]
+    datos.update(datos_evento or {})
+
+    bus_eventos.publicar(id_analisis, evento, datos, version)
+    return version
+
+
+def _guardar_json_cache(cache_path: Path, datos: Any):
+    """
+    Escribe una entrada de caché en disco de forma atómica. Dos análisis del mismo documento
+    pueden escribirla a la vez: cada uno usa su propio temporal y publica con ``os.replace``.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=cache_path.parent, prefix=f"{cache_path.stem}.", suffix=".json.tmp", delete=False
+    ) as f:
+        tmp_path = Path(f.name)
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(datos, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _normalizar_documentos(contratos_paths) -> List[Dict[str, Any]]:
+    """Acepta rutas sueltas (análisis antiguos) o entradas del manifiesto con ``path``, ``nombre`` y ``sha256``.
+
+    Los documentos del almacén de blobs se guardan por hash, así que el nombre y la
+    extensión visibles vienen del manifiesto y no de la ruta.
+    """
+    documentos = []
+    for entrada in contratos_paths:
+        if isinstance(entrada, dict):
+            path = Path(entrada["path"])
+            documentos.append({
+                "path": path,
+                "nombre": entrada.get("nombre") or path.name,
+                "sha256": entrada.get("sha256"),
+            })
+        else:
+            path = Path(entrada)
+            documentos.append({"path": path, "nombre": path.name, "sha256": None})
+    return documentos
+
+
+def _extraer_texto_pdf_cacheado(contenido: bytes, sha256: Optional[str]) -> Dict[str, Any]:
+    """
+    Texto normalizado, páginas, mapa de páginas y tokens antes/después de normalizar de un
+    PDF, reutilizando la extracción previa del mismo contenido.
+    """
+    cache_path = EXTRACCION_CACHE_DIR / f"{sha256}.json" if sha256 else None
+    if cache_path is not None and cache_path.exists():
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            # Las extracciones de una normalización anterior se rehacen
+            if cache.get("version_normalizacion") == VERSION_NORMALIZACION:
+                logger.info(f"♻️ Texto extraído reutilizado de caché ({sha256[:12]})")
+                return cache
+        except Exception as e:
+            logger.warning(f"⚠️ Caché de extracción ilegible ({cache_path.name}): {e}")
+
+    inicio = time.monotonic()
+    paginas = _calcular_total_paginas(contenido) or 0
+    texto_paginas = _extraer_paginas_pdf(contenido)
+    normalizado = normalizar_paginas(texto_paginas)
+    predictor_tiempos.registrar_extraccion(paginas, time.monotonic() - inicio)
+
+    extraccion = {
+        "texto": normalizado["texto"],
+        "paginas": paginas,
+        "mapa_paginas": normalizado["mapa_paginas"],
+        # Lo que se enviaba antes de normalizar: el texto en bruto con un marcador por página
+        "tokens_original": contar_tokens(
+            "\n\n".join(f"--- Página {n} ---\n{t}" for n, t in texto_paginas).strip()
+        ),
+        "tokens_texto": contar_tokens(normalizado["texto"]),
+        "version_normalizacion": VERSION_NORMALIZACION,
+    }
+    if extraccion["tokens_original"]:
+        logger.info(
+            f"🧹 Texto normalizado ({sha256[:12] if sha256 else 'sin hash'}): "
+            f"{extraccion['tokens_original']} → {extraccion['tokens_texto']} tokens, "
+            f"{normalizado['cabeceras_eliminadas']} cabeceras/pies repetidos eliminados"
+        )
+
+    if cache_path is not None:
+        try:
+            _guardar_json_cache(cache_path, extraccion)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo guardar la extracción en caché: {e}")
+
+    return extraccion
+
+
+def _clausulas_cacheadas(extraccion: Dict[str, Any], sha256: str) -> List[Dict[str, Any]]:
+    """
+    Árbol de cláusulas del texto normalizado del documento (desplazamientos relativos a
+    ``extraccion["texto"]``), segmentado una vez por contenido y guardado en disco.
+    """
+    cache_path = CLAUSULAS_CACHE_DIR / f"{sha256}.json"
+    if cache_path.exists():
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if (cache.get("version_clausulas"), cache.get("version_normalizacion")) == (
+                VERSION_CLAUSULAS, VERSION_NORMALIZACION
+            ):
+                return cache["clausulas"]
+        except Exception as e:
+            logger.warning(f"⚠️ Caché de cláusulas ilegible ({cache_path.name}): {e}")
+
+    clausulas = segmentar_clausulas(extraccion["texto"], extraccion.get("mapa_paginas"))
+    logger.info(f"📑 Cláusulas segmentadas ({sha256[:12]}): {contar_clausulas(clausulas)}")
+    try:
+        _guardar_json_cache(cache_path, {
+            "version_clausulas": VERSION_CLAUSULAS,
+            "version_normalizacion": VERSION_NORMALIZACION,
+            "clausulas": clausulas,
+        })
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudieron guardar las cláusulas en caché: {e}")
+    return clausulas
+
+
+def _clausulas_citadas(respuesta: str, contexto: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Cláusulas y anexos que cita la respuesta, localizados en el índice de cada documento."""
+    citadas = []
+    for referencia in referencias_en(respuesta):
+        for doc in contexto.get("documentos", []):
+            nodo = buscar_clausula(doc.get("clausulas") or [], referencia)
+            if nodo is None:
+                continue
+            citadas.append({
+                "referencia": referencia,
+                "documento": doc["name"],
+                "id": nodo["id"],
+                "titulo": nodo["titulo"],
+                "pagina_inicio": nodo.get("pagina_inicio"),
+                "pagina_fin": nodo.get("pagina_fin"),
+            })
+            break
+    return citadas
+
+
+def _preparar_contexto_documentos(contratos_paths) -> Dict[str, Any]:
     """Carga los archivos del análisis y prepara el contexto para el LLM."""
+    inicio = time.monotonic()
     documentos_cargados = []
     total_paginas = 0
 
-    for path in contratos_paths:
+    for documento in _normalizar_documentos(contratos_paths):
+        path = documento["path"]
+        nombre = documento["nombre"]
         with open(path, "rb") as f:
             contenido = f.read()
+        sha256 = documento["sha256"] or hashlib.sha256(contenido).hexdigest()
 
-        extension = path.suffix.lower()
+        extension = Path(nombre).suffix.lower()
         texto = ""
+        paginas = None
+        extraccion: Dict[str, Any] = {}
 
         if extension == ".pdf":
-            paginas = _calcular_total_paginas(contenido) or 0
+            extraccion = _extraer_texto_pdf_cacheado(contenido, sha256)
+            paginas = extraccion["paginas"]
             total_paginas += paginas
-            texto_pdf = _extraer_texto_pdf(contenido)
-            if texto_pdf:
-                texto = f"--- Archivo {path.name} ---\n{texto_pdf}"
         elif extension in {".txt", ".md"}:
             try:
                 texto_decodificado = contenido.decode("utf-8", errors="ignore")
-                texto = f"--- Archivo {path.name} ---\n{texto_decodificado}"
+                extraccion = {
+                    **normalizar_paginas([(1, texto_decodificado)]),
+                    "tokens_original": contar_tokens(texto_decodificado),
+                }
+                extraccion["tokens_texto"] = contar_tokens(extraccion["texto"])
             except Exception as e:
-                logger.warning(f"⚠️ No se pudo decodificar el archivo de texto {path.name}: {e}")
+                logger.warning(f"⚠️ No se pudo decodificar el archivo de texto {nombre}: {e}")
         else:
             logger.warning(f"⚠️ Formato no soportado (%s), se omitirá del contexto textual", extension)
 
+        mapa_paginas = []
+        clausulas = []
+        if extraccion.get("texto"):
+            clausulas = _clausulas_cacheadas(extraccion, sha256)
+            cabecera = f"--- Archivo {nombre} ---\n"
+            texto = cabecera + extraccion["texto"]
+            # Desplazamientos relativos a ``texto``, que empieza con el nombre del archivo
+            mapa_paginas = desplazar_mapa(extraccion.get("mapa_paginas") or [], len(cabecera))
+
         documentos_cargados.append({
             "path": path,
-            "name": path.name,
+            "name": nombre,
             "bytes": contenido,
             "extension": extension,
             "texto": texto,
+            "paginas": paginas,
+            "sha256": sha256,
+            "mapa_paginas": mapa_paginas,
+            "tokens_original": extraccion.get("tokens_original"),
+            "tokens_texto": extraccion.get("tokens_texto"),
+            "clausulas": clausulas,
+            # Dónde empieza en ``texto`` el texto normalizado (tras el nombre del archivo)
+            "desplazamiento_texto": len(texto) - len(extraccion.get("texto") or ""),
         })
 
     pdf_documentos = [doc for doc in documentos_cargados if doc["extension"] == ".pdf"]
@@ -151,6 +621,11 @@ def _preparar_contexto_documentos(contratos_paths: List[Path]) -> Dict[str, Any]
         doc["texto"] for doc in documentos_cargados if doc.get("texto")
     ]).strip() or None
 
+    # Por separado para poder recortarlos uno a uno si no caben en la ventana del modelo
+    textos_anexos = [
+        doc["texto"] for doc in documentos_cargados if doc.get("texto") and doc is not doc_principal
+    ]
+
     pdf_principal = (doc_principal["name"], doc_principal["bytes"]) if doc_principal else None
 
     documentos_info = []
@@ -158,28 +633,519 @@ def _preparar_contexto_documentos(contratos_paths: List[Path]) -> Dict[str, Any]
         documentos_info.append({
             "nombre": doc["name"],
             "extension": doc["extension"],
-            "paginas": _calcular_total_paginas(doc["bytes"]) if doc["extension"] == ".pdf" else None,
+            "paginas": doc["paginas"] or None,
+            "sha256": doc["sha256"],
+            # Reducción de tokens de la normalización del texto
+            "tokens_original": doc["tokens_original"],
+            "tokens_texto": doc["tokens_texto"],
+            **contar_clausulas(doc["clausulas"]),
         })
 
     return {
         "documentos": documentos_cargados,
         "documentos_info": documentos_info,
+        "clave_contexto": calcular_clave_contexto(
+            pdf_principal, texto_principal, archivos_pdf_adjuntos, texto_contexto or texto_total_fallback
+        ),
         "total_paginas": total_paginas or None,
         "pdf_principal": pdf_principal,
         "texto_principal": texto_principal,
         "archivos_pdf_adjuntos": archivos_pdf_adjuntos,
         "texto_contexto": texto_contexto,
         "texto_fallback": texto_total_fallback,
+        "textos_anexos": textos_anexos,
+        "tiempo_preparacion_s": round(time.monotonic() - inicio, 3),
     }
 
 
+def indice_clausulas(contratos_paths) -> List[Dict[str, Any]]:
+    """Árbol de cláusulas de cada documento del análisis (con la extracción en caché apenas cuesta)."""
+    contexto = _preparar_contexto_documentos(contratos_paths)
+    return [
+        {
+            "nombre": doc["name"],
+            "sha256": doc["sha256"],
+            **contar_clausulas(doc["clausulas"]),
+            "arbol": doc["clausulas"],
+        }
+        for doc in contexto["documentos"]
+    ]
+
+
+def _parametros_huella(usar_adjuntos_pdf: bool) -> Dict[str, Any]:
+    """
+    Configuración que cambia lo que se envía al LLM (texto normalizado, recorte del contexto,
+    orden del prompt, PDF adjuntos). Toda opción o versión nueva que lo cambie va aquí.
+    """
+    parametros: Dict[str, Any] = {
+        "version_normalizacion": VERSION_NORMALIZACION,
+        "contexto": {
+            "estrategia": ESTRATEGIA_CONTEXTO,
+            "max_tokens": MAX_TOKENS_CONTEXTO,
+            "ventana_tokens": VENTANA_CONTEXTO_TOKENS,
+            "margen_respuesta": MARGEN_RESPUESTA_TOKENS,
+            "tokens_por_fragmento": TOKENS_POR_FRAGMENTO,
+            "tokens_por_ventana_mapa": TOKENS_POR_VENTANA_MAPA,
+        },
+        "prompt_prefijo_estable": PROMPT_PREFIJO_ESTABLE,
+    }
+    if usar_adjuntos_pdf:
+        parametros["adelgazar_pdf"] = (
+            {"dpi": DPI_IMAGENES_ADJUNTOS, "calidad": CALIDAD_IMAGENES_ADJUNTOS} if ADELGAZAR_PDF else False
+        )
+        parametros["adjuntos_por_paginas"] = (
+            {"paginas": PAGINAS_POR_PREGUNTA, "definiciones": PAGINAS_DEFINICIONES} if ADJUNTOS_POR_PAGINAS else False
+        )
+    # El prefiltro responde "Sin evaluar" en local o manda preguntas al modelo barato
+    parametros["prefiltro"] = {
+        "version": VERSION_PREFILTRO,
+        "version_clausulas": VERSION_CLAUSULAS,
+        "umbral": UMBRAL_PREFILTRO,
+        "accion": ACCION_PREFILTRO,
+        "modelo_barato": _modelo_barato() if ACCION_PREFILTRO == "modelo_barato" else None,
+    } if PREFILTRO_BM25 else False
+    # Con la cascada parte de las respuestas las da el modelo barato
+    parametros["cascada"] = {"modelo_barato": _modelo_barato()} if CASCADA_MODELOS and _modelo_barato() else False
+    return parametros
+
+
+def calcular_huella_analisis(
+    hashes_documentos: List[str],
+    preguntas: List[Dict[str, Any]],
+    llm_metadata: Dict[str, str],
+    usar_adjuntos_pdf: bool,
+) -> str:
+    """
+    SHA-256 de todo lo que determina el resultado: documentos, preguntas, prompts, modelo,
+    modo y la configuración que cambia lo enviado al LLM (``_parametros_huella``).
+    """
+    contenido = json.dumps(
+        {
+            "documentos": hashes_documentos,
+            "preguntas": [
+                {"Pregunta": p.get("Pregunta", ""), "Sección": p.get("Sección", "Sin sección")}
+                for p in preguntas
+            ],
+            "version_prompts": VERSION_PROMPTS,
+            "modelo_llm": llm_metadata.get("modelo_llm"),
+            "proveedor_llm": llm_metadata.get("proveedor_llm"),
+            "usar_adjuntos_pdf": bool(usar_adjuntos_pdf),
+            "parametros": _parametros_huella(usar_adjuntos_pdf),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+def _registrar_huella(huella: str, progreso_path: Path):
+    try:
+        HUELLAS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(HUELLAS_CACHE_DIR / f"{huella}.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "id_analisis": Path(progreso_path).stem,
+                "progreso_path": str(progreso_path),
+                "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }, f)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo registrar la huella del análisis: {e}")
+
+
+def _buscar_analisis_memorizado(huella: str, progreso_path: Path) -> Optional[Dict[str, Any]]:
+    """Progreso de un análisis completado con la misma huella, o None.
+
+    El índice puede quedar obsoleto (análisis borrado o reanalizado); por eso se comprueba
+    que el análisis de origen siga completado y con la misma huella.
+    """
+    indice_path = HUELLAS_CACHE_DIR / f"{huella}.json"
+    if not indice_path.exists():
+        return None
+    try:
+        with open(indice_path, "r", encoding="utf-8") as f:
+            origen_path = Path(json.load(f)["progreso_path"])
+        if origen_path.resolve() == Path(progreso_path).resolve() or not origen_path.exists():
+            return None
+        with open(origen_path, "r", encoding="utf-8") as f:
+            origen = json.load(f)
+    except Exception as e:
+        logger.warning(f"⚠️ Índice de huella ilegible ({indice_path.name}): {e}")
+        return None
+
+    if origen.get("estado") != "completado" or origen.get("huella_analisis") != huella:
+        return None
+    origen["id_analisis"] = origen_path.stem
+    return origen
+
+
+def _clonar_analisis(
+    origen: Dict[str, Any],
+    progreso_data: Dict[str, Any],
+    progreso_path: Path,
+):
+    # Clonar no gasta tokens: el uso del análisis original no se copia
+    resultados = [
+        {k: v for k, v in r.items() if k not in ("version", "uso_tokens")}
+        for r in origen.get("resultados") or []
+    ]
+    progreso_data.update({
+        "estado": "completado",
+        "progreso": len(resultados),
+        "resultados": resultados,
+        "num_resultados": len(resultados),
+        "total_paginas": progreso_data.get("total_paginas") or origen.get("total_paginas"),
+        "fecha_finalizacion": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "clonado_de": {
+            "id_analisis": origen["id_analisis"],
+            "nombre_analisis": origen.get("nombre_analisis"),
+            "fecha_finalizacion": origen.get("fecha_finalizacion"),
+        },
+    })
+    guardar_progreso(
+        progreso_path,
+        progreso_data,
+        indices_modificados=range(len(resultados)),
+        reiniciar_resultados=True,
+    )
+    logger.info(
+        f"♻️ ANÁLISIS REUTILIZADO - {len(resultados)} resultados clonados de {origen['id_analisis']}"
+    )
+
+
+def _modo_analisis(usar_adjuntos_pdf: bool) -> str:
+    """Modo con el que se agrupan los tiempos medidos: los adjuntos PDF son bastante más lentos."""
+    return "adjuntos" if usar_adjuntos_pdf else "texto"
+
+
+def _tokens_fijos(pregunta: str, seccion: str, usar_adjuntos_pdf: bool) -> int:
+    """Tokens del prompt sin los documentos: instrucciones, sección y pregunta."""
+    if usar_adjuntos_pdf:
+        return contar_tokens(PROMPT_SISTEMA_ADJUNTOS) + contar_tokens(
+            PROMPT_HUMANO_ADJUNTOS.format(seccion=seccion, pregunta=pregunta)
+        )
+    return contar_tokens(PROMPT_SISTEMA_TEXTO) + contar_tokens(
+        _plantilla_humano_texto().format(seccion=seccion, pregunta=pregunta, texto_contrato="")
+    )
+
+
+def _plantilla_humano_texto() -> str:
+    return PROMPT_HUMANO_TEXTO_ESTABLE if PROMPT_PREFIJO_ESTABLE else PROMPT_HUMANO_TEXTO
+
+
+def _tokens_adjuntos_contexto(contexto: Dict[str, Any]) -> int:
+    documentos_pdf = [doc for doc in contexto.get("documentos", []) if doc["extension"] == ".pdf"]
+    return tokens_adjuntos(
+        [doc["texto"] for doc in documentos_pdf],
+        sum(doc["paginas"] or 0 for doc in documentos_pdf),
+    )
+
+
+def _textos_paginas(doc: Dict[str, Any]) -> List[Tuple[int, str]]:
+    """Texto de cada página del documento, cortando su texto por ``mapa_paginas``."""
+    mapa = doc.get("mapa_paginas") or []
+    texto = doc.get("texto") or ""
+    return [
+        (entrada["pagina"], texto[entrada["inicio"]:mapa[i + 1]["inicio"] if i + 1 < len(mapa) else len(texto)])
+        for i, entrada in enumerate(mapa)
+    ]
+
+
+def _paginas_por_pregunta(pregunta: str, seccion: str, contexto: Dict[str, Any]) -> Dict[str, List[int]]:
+    """
+    Páginas de cada PDF relacionadas con la pregunta más las de definiciones (sha256 -> páginas).
+    El índice de cada documento se construye la primera vez y queda en el contexto del análisis.
+    """
+    seleccion = {}
+    for doc in contexto.get("documentos", []):
+        if doc["extension"] != ".pdf" or not doc.get("mapa_paginas"):
+            continue
+        if "indice_paginas" not in doc:
+            textos = _textos_paginas(doc)
+            doc["textos_paginas"] = dict(textos)
+            doc["indice_paginas"] = [(numero, indexar(texto)) for numero, texto in textos]
+            doc["paginas_definiciones"] = paginas_definiciones(textos, PAGINAS_DEFINICIONES) if PAGINAS_DEFINICIONES else []
+        paginas = elegir_paginas(doc["indice_paginas"], f"{seccion}\n{pregunta}", PAGINAS_POR_PREGUNTA)
+        if paginas:
+            seleccion[doc["sha256"]] = sorted(set(paginas) | set(doc["paginas_definiciones"]))
+    return seleccion
+
+
+def _tokens_paginas(seleccion: Dict[str, List[int]], contexto: Dict[str, Any]) -> int:
+    documentos = {doc["sha256"]: doc for doc in contexto.get("documentos", [])}
+    return tokens_adjuntos(
+        [documentos[sha]["textos_paginas"].get(n, "") for sha, paginas in seleccion.items() for n in paginas],
+        sum(len(paginas) for paginas in seleccion.values()),
+    )
+
+
+def _rangos_paginas(paginas: List[int]) -> str:
+    """[3, 4, 5, 12] -> "3-5, 12"."""
+    rangos: List[List[int]] = []
+    for pagina in paginas:
+        if rangos and pagina == rangos[-1][1] + 1:
+            rangos[-1][1] = pagina
+        else:
+            rangos.append([pagina, pagina])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in rangos)
+
+
+def _adjuntos_por_paginas(seleccion: Dict[str, List[int]], contexto: Dict[str, Any]) -> List[Tuple[str, bytes]]:
+    """Un PDF por documento con solo las páginas elegidas; el nombre indica las páginas originales."""
+    return [
+        (
+            f"{Path(doc['name']).stem} (páginas {_rangos_paginas(seleccion[doc['sha256']])}).pdf",
+            recortar_pdf(doc["sha256"], doc["bytes"], tuple(seleccion[doc["sha256"]])),
+        )
+        for doc in contexto.get("documentos", [])
+        if doc["sha256"] in seleccion
+    ]
+
+
+def _motivo_escalado(resultado: Dict[str, Any]) -> Optional[str]:
+    """Por qué la respuesta del deployment barato no vale y hay que repetirla en el principal."""
+    if resultado.get("riesgo_por_defecto") or not (resultado.get("Respuesta") or "").strip():
+        return "formato"
+    if resultado.get("Riesgo") == "Alto":
+        return "riesgo_alto"
+    if resultado.get("Riesgo") == "Sin evaluar":
+        return "sin_evaluar"
+    return None
+
+
+def _analizar_en_cascada(llamar, modelo_principal: Optional[str]) -> Dict[str, Any]:
+    """
+    Responde con el modelo barato y repite la pregunta en el deployment
+    principal si el barato ve riesgo alto, no la evalúa o su respuesta no tiene el formato
+    esperado (línea RISK reconocible). El resultado suma los tokens de ambos niveles y
+    guarda en ``cascada`` la latencia, los tokens y el riesgo de cada uno.
+    """
+    niveles = []
+    motivo = None
+    for nivel, modelo_nivel in (("barato", _modelo_barato()), ("principal", None)):
+        inicio = time.monotonic()
+        resultado = llamar(modelo_nivel)
+        niveles.append({
+            "nivel": nivel,
+            "modelo": modelo_nivel or modelo_principal,
+            "duracion_s": round(time.monotonic() - inicio, 2),
+            "uso_tokens": resultado.get("uso_tokens") or _uso_vacio(),
+            "Riesgo": resultado.get("Riesgo"),
+            "backend": resultado.get("backend_llm"),
+        })
+        if nivel == "principal":
+            break
+        motivo = _motivo_escalado(resultado)
+        if motivo is None:
+            break
+        logger.info(f"⬆️ Cascada: se escala al deployment principal ({motivo})")
+
+    uso_tokens = _uso_vacio()
+    for registro in niveles:
+        uso_tokens = _sumar_uso(uso_tokens, registro)
+    resultado["uso_tokens"] = uso_tokens
+    resultado["cascada"] = {"niveles": niveles, "escalada": len(niveles) > 1, "motivo": motivo}
+    return resultado
+
+
+def _acumular_cascada(acumulado: Optional[Dict[str, Any]], cascada: Dict[str, Any]) -> Dict[str, Any]:
+    """Estadísticas de la cascada del análisis: tasa de escalado y latencia y tokens por nivel."""
+    acumulado = acumulado or {"preguntas": 0, "escaladas": 0, "motivos": {}, "niveles": {}}
+    acumulado["preguntas"] += 1
+    if cascada.get("escalada"):
+        acumulado["escaladas"] += 1
+        acumulado["motivos"][cascada["motivo"]] = acumulado["motivos"].get(cascada["motivo"], 0) + 1
+    acumulado["tasa_escalado"] = round(acumulado["escaladas"] / acumulado["preguntas"], 3)
+    for registro in cascada.get("niveles", []):
+        nivel = acumulado["niveles"].setdefault(
+            registro["nivel"], {"modelo": registro["modelo"], "llamadas": 0, "duracion_s": 0.0, "tokens": 0}
+        )
+        nivel["llamadas"] += 1
+        nivel["duracion_s"] = round(nivel["duracion_s"] + registro["duracion_s"], 2)
+        nivel["tokens"] += int((registro.get("uso_tokens") or {}).get("total") or 0)
+        nivel["duracion_media_s"] = round(nivel["duracion_s"] / nivel["llamadas"], 2)
+    return acumulado
+
+
+def _indice_bm25(contexto: Dict[str, Any]) -> IndiceBM25:
+    """Índice BM25 de las cláusulas de todos los documentos, construido la primera vez que se pide."""
+    if "indice_bm25" not in contexto:
+        unidades = []
+        for doc in contexto.get("documentos", []):
+            if doc.get("texto"):
+                unidades.extend(
+                    (f"{doc['name']} § {identificador}", texto)
+                    for identificador, texto in unidades_clausulas(
+                        doc["texto"], doc.get("clausulas") or [], doc.get("desplazamiento_texto", 0)
+                    )
+                )
+        contexto["indice_bm25"] = IndiceBM25(unidades)
+    return contexto["indice_bm25"]
+
+
+def _prefiltrar(pregunta: str, contexto: Dict[str, Any], registrar: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Decisión del prefiltro léxico para la pregunta: ``llm``, ``sin_evaluar`` (se responde
+    sin llamar al LLM) o ``modelo_barato``. None si está desactivado o no hay texto indexado
+    (p. ej. un PDF escaneado), porque entonces no se puede descartar nada. ``registrar``
+    deja la decisión en el log de auditoría (no se hace al estimar).
+    """
+    if not PREFILTRO_BM25:
+        return None
+    indice = _indice_bm25(contexto)
+    if not indice.ids:
+        return None
+
+    prefiltro = {**indice.puntuar(pregunta), "umbral": UMBRAL_PREFILTRO, "decision": "llm"}
+    if prefiltro["cobertura"] < UMBRAL_PREFILTRO:
+        if ACCION_PREFILTRO != "modelo_barato":
+            prefiltro["decision"] = "sin_evaluar"
+        elif _modelo_barato():
+            prefiltro["decision"] = "modelo_barato"
+        elif registrar:
+            logger.warning("⚠️ ACCION_PREFILTRO=modelo_barato sin backend barato: se usa el modelo principal")
+    if not registrar:
+        return prefiltro
+    # Registro de auditoría: por qué se respondió (o no) cada pregunta con el LLM
+    logger.info(
+        f"🔎 Prefiltro BM25 → {prefiltro['decision']} | cobertura {prefiltro['cobertura']} "
+        f"(umbral {UMBRAL_PREFILTRO}) | mejor: {prefiltro['mejor_fragmento']} | "
+        f"términos ausentes: {', '.join(prefiltro['terminos_ausentes']) or '-'} | '{pregunta[:80]}'"
+    )
+    return prefiltro
+
+
+def _analizar_pregunta_medida(
+    pregunta: str,
+    seccion: str,
+    contexto: Dict[str, Any],
+    usar_adjuntos_pdf: bool,
+    modelo: Optional[str],
+    max_tokens_contexto: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    ``analizar_pregunta`` con el contexto preparado, registrando su duración en el predictor.
+    ``max_tokens_contexto`` limita el documento enviado (análisis degradado por presupuesto).
+
+    Con ``PREFILTRO_BM25`` las preguntas sin cláusulas relacionadas se responden como
+    "Sin evaluar" sin llamar al LLM (o con el deployment barato). Con ``ADJUNTOS_POR_PAGINAS``
+    se adjuntan solo las páginas relacionadas con la pregunta. Si los PDF adjuntos no caben
+    en la ventana del modelo la pregunta se responde en modo texto, donde los documentos se
+    recortan al presupuesto de tokens.
+    """
+    prefiltro = _prefiltrar(pregunta, contexto)
+    if prefiltro and prefiltro["decision"] == "sin_evaluar":
+        return {
+            "Respuesta": (
+                "El contrato no contiene cláusulas relacionadas con esta pregunta según el prefiltro "
+                "léxico, por lo que no se ha consultado al modelo."
+            ),
+            "Riesgo": "Sin evaluar",
+            "prefiltro": prefiltro,
+            "duracion_s": 0.0,
+        }
+    modelo_llamada = None
+    if prefiltro and prefiltro["decision"] == "modelo_barato":
+        modelo = modelo_llamada = _modelo_barato()
+
+    pdf_principal = contexto.get("pdf_principal")
+    archivos_pdf_adjuntos = contexto.get("archivos_pdf_adjuntos")
+    clave_contexto = contexto.get("clave_contexto")
+
+    info_adjuntos = None
+    if usar_adjuntos_pdf and pdf_principal:
+        presupuesto = presupuesto_contexto(modelo, _tokens_fijos(pregunta, seccion, True))
+        info_adjuntos = {
+            "estrategia": "adjuntos",
+            "tokens_original": _tokens_adjuntos_contexto(contexto),
+            "presupuesto": presupuesto,
+        }
+        seleccion = _paginas_por_pregunta(pregunta, seccion, contexto) if ADJUNTOS_POR_PAGINAS else {}
+        if seleccion:
+            try:
+                recortes = _adjuntos_por_paginas(seleccion, contexto)
+                pdf_principal, archivos_pdf_adjuntos = recortes[0], recortes[1:]
+                # La clave de agrupación se calcula con los recortes de esta pregunta
+                clave_contexto = None
+                info_adjuntos.update({
+                    "estrategia": "adjuntos_paginas",
+                    "tokens_original": _tokens_paginas(seleccion, contexto),
+                    "paginas": [nombre for nombre, _ in recortes],
+                })
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudieron recortar los PDF por páginas, se adjuntan completos: {e}")
+        if info_adjuntos["tokens_original"] > presupuesto:
+            logger.warning(
+                f"✂️ Los adjuntos (~{info_adjuntos['tokens_original']} tokens) no caben en el "
+                f"presupuesto de {presupuesto}: la pregunta se analiza en modo texto"
+            )
+            usar_adjuntos_pdf = False
+
+    def llamar(modelo_nivel: Optional[str]) -> Dict[str, Any]:
+        return analizar_pregunta(
+            pregunta,
+            seccion,
+            pdf_principal=pdf_principal,
+            texto_principal=contexto.get("texto_principal"),
+            usar_adjuntos_pdf=usar_adjuntos_pdf,
+            archivos_pdf_adjuntos=archivos_pdf_adjuntos,
+            # El texto de respaldo ya incluye el principal: solo se usa si este no tiene texto
+            texto_contexto=(
+                contexto.get("texto_contexto") if contexto.get("texto_principal") else contexto.get("texto_fallback")
+            ),
+            textos_anexos=contexto.get("textos_anexos"),
+            clave_contexto=clave_contexto,
+            modelo=modelo_nivel,
+            max_tokens_contexto=max_tokens_contexto,
+        )
+
+    inicio = time.monotonic()
+    if CASCADA_MODELOS and _modelo_barato() and modelo_llamada is None:
+        resultado = _analizar_en_cascada(llamar, modelo)
+        modelo_llamada = resultado["cascada"]["niveles"][-1]["modelo"]
+        predictor_tiempos.registrar_escalado(_modelo_barato(), resultado["cascada"]["escalada"])
+    else:
+        resultado = llamar(modelo_llamada)
+    duracion = time.monotonic() - inicio
+    predictor_tiempos.registrar_pregunta(
+        _modo_analisis(usar_adjuntos_pdf), modelo, contexto.get("total_paginas"), duracion
+    )
+    resultado["duracion_s"] = round(duracion, 2)
+    if prefiltro:
+        resultado["prefiltro"] = prefiltro
+    if modelo_llamada:
+        resultado["modelo_llm"] = modelo_llamada
+    citadas = _clausulas_citadas(resultado.get("Respuesta", ""), contexto)
+    if citadas:
+        resultado["clausulas_citadas"] = citadas
+    if info_adjuntos is not None:
+        if usar_adjuntos_pdf:
+            resultado.setdefault("contexto", info_adjuntos)
+        elif resultado.get("contexto"):
+            resultado["contexto"]["adjuntos_omitidos"] = True
+    return resultado
+
+
+def _analisis_cancelado(progreso_path) -> bool:
+    """
+    True si el análisis se ha cancelado: ``DELETE /proceso`` borra su archivo de progreso,
+    que la API crea antes de encolarlo. El worker se detiene sin volver a crearlo.
+    """
+    if Path(progreso_path).exists():
+        return False
+    logger.info(f"🛑 Análisis {Path(progreso_path).stem} cancelado: se detiene sin escribir su progreso")
+    return True
+
+
 def _procesar_preguntas(
     preguntas: List[Dict[str, Any]],
     progreso_path: Path,
     contexto: Dict[str, Any],
     usar_adjuntos_pdf: bool,
     llm_metadata: Dict[str, str],
+    reutilizar_resultados: bool = False,
 ):
+    if _analisis_cancelado(progreso_path):
+        return
     base_data: Dict[str, Any] = {}
     if Path(progreso_path).exists():
         try:
@@ -187,6 +1153,15 @@ def _procesar_preguntas(
                 base_data = json.load(f) or {}
         except Exception:
             base_data = {}
+    for campo in ("clonado_de", "motivo_pausa", "degradado_por_presupuesto", "cascada"):
+        base_data.pop(campo, None)
+
+    huella = calcular_huella_analisis(
+        [doc["sha256"] for doc in contexto.get("documentos", [])],
+        preguntas,
+        llm_metadata,
+        usar_adjuntos_pdf,
+    )
 
     documentos_info = contexto.get("documentos_info") or base_data.get("documentos_info")
 
@@ -197,6 +1172,7 @@ def _procesar_preguntas(
         )
         total_paginas = paginas_sum or None
 
+    inicio = time.monotonic()
     progreso_data = {
         **base_data,
         "estado": "en_progreso",
@@ -210,30 +1186,100 @@ def _procesar_preguntas(
         "proveedor_llm": llm_metadata.get("proveedor_llm"),
         "usar_adjuntos_pdf": usar_adjuntos_pdf,
         "documentos_info": documentos_info,
+        "huella_analisis": huella,
+        "tiempo_preparacion_s": contexto.get("tiempo_preparacion_s"),
+        "uso_tokens": _uso_vacio(),
+        "estrategias_contexto": {},
+        "prefiltro": {},
+        "backends_llm": {},
+        "prompt_prefijo_estable": PROMPT_PREFIJO_ESTABLE,
+        "presupuesto_tokens": base_data.get("presupuesto_tokens", PRESUPUESTO_TOKENS_ANALISIS or None),
     }
 
-    with open(progreso_path, "w", encoding="utf-8") as f:
-        json.dump(_sanitize_json(progreso_data), f, indent=2, ensure_ascii=False)
+    if reutilizar_resultados:
+        origen = _buscar_analisis_memorizado(huella, progreso_path)
+        if origen is not None:
+            _clonar_analisis(origen, progreso_data, progreso_path)
+            return
+
+    guardar_progreso(progreso_path, progreso_data, reiniciar_resultados=True)
     logger.info("✅ Archivo de progreso inicializado")
 
-    resultados = []
-    documentos_cargados = contexto.get("documentos", [])
+    _ejecutar_preguntas(preguntas, progreso_path, progreso_data, contexto, llm_metadata, inicio)
+
+
+def _presupuesto_agotado(progreso_data: Dict[str, Any]) -> bool:
+    presupuesto = progreso_data.get("presupuesto_tokens")
+    return bool(presupuesto) and (progreso_data.get("uso_tokens") or {}).get("total", 0) >= presupuesto
+
+
+def _ejecutar_preguntas(
+    preguntas: List[Dict[str, Any]],
+    progreso_path: Path,
+    progreso_data: Dict[str, Any],
+    contexto: Dict[str, Any],
+    llm_metadata: Dict[str, str],
+    inicio: float,
+    registrar_duracion: bool = True,
+):
+    """
+    Responde las preguntas que faltan (desde ``len(resultados)``) acumulando el uso de tokens.
+
+    Si el análisis agota su presupuesto se pausa o, con ``ACCION_PRESUPUESTO=degradar``, sigue
+    en modo texto con la estrategia ``fragmentos`` limitada a ``TOKENS_CONTEXTO_DEGRADADO``
+    (se pausa igualmente si ya estaba en modo texto y no hay un contexto menor). ``registrar_duracion`` es False al reanudar, porque
+    la duración ya no es la de un análisis completo.
+    """
+    resultados = progreso_data["resultados"]
+    degradado = progreso_data.get("degradado_por_presupuesto")
+    usar_adjuntos_pdf = progreso_data.get("usar_adjuntos_pdf", False) and not degradado
+    max_tokens_contexto = (degradado or {}).get("max_tokens_contexto")
+    total_paginas = progreso_data.get("total_paginas")
+
+    for idx in range(len(resultados), len(preguntas)):
+        if _analisis_cancelado(progreso_path):
+            return
+        if _presupuesto_agotado(progreso_data) and not progreso_data.get("degradado_por_presupuesto"):
+            if ACCION_PRESUPUESTO == "degradar" and (usar_adjuntos_pdf or TOKENS_CONTEXTO_DEGRADADO):
+                usar_adjuntos_pdf = False
+                max_tokens_contexto = TOKENS_CONTEXTO_DEGRADADO or None
+                progreso_data["degradado_por_presupuesto"] = {
+                    "desde_pregunta": idx,
+                    "modo": "texto",
+                    "estrategia": "fragmentos" if max_tokens_contexto else None,
+                    "max_tokens_contexto": max_tokens_contexto,
+                }
+                # Los resultados mezclan modos: ya no corresponden a la huella
+                progreso_data.pop("huella_analisis", None)
+                logger.warning(
+                    f"💸 Presupuesto de {progreso_data['presupuesto_tokens']} tokens agotado: "
+                    f"las preguntas restantes se analizan en modo texto"
+                    + (f" con fragmentos de hasta {max_tokens_contexto} tokens" if max_tokens_contexto else "")
+                )
+            else:
+                progreso_data.update({
+                    "estado": "pausado",
+                    "motivo_pausa": "presupuesto_tokens",
+                    "fecha_modificacion": time.strftime("%Y-%m-%d %H:%M:%S"),
+                })
+                guardar_progreso(progreso_path, progreso_data)
+                logger.warning(
+                    f"⏸️ ANÁLISIS PAUSADO - presupuesto de {progreso_data['presupuesto_tokens']} tokens "
+                    f"agotado tras {idx}/{len(preguntas)} preguntas"
+                )
+                return
 
-    for idx, pregunta_data in enumerate(preguntas):
         logger.info(f"📝 Procesando pregunta {idx + 1}/{len(preguntas)}")
 
+        pregunta_data = preguntas[idx]
         pregunta = pregunta_data.get("Pregunta", "")
         seccion = pregunta_data.get("Sección", "Sin sección")
-
-        resultado = analizar_pregunta(
-            pregunta,
-            seccion,
-            pdf_principal=contexto.get("pdf_principal"),
-            texto_principal=contexto.get("texto_principal"),
-            usar_adjuntos_pdf=usar_adjuntos_pdf,
-            archivos_pdf_adjuntos=contexto.get("archivos_pdf_adjuntos"),
-            texto_contexto=contexto.get("texto_contexto") or contexto.get("texto_fallback"),
+
+        resultado = _analizar_pregunta_medida(
+            pregunta, seccion, contexto, usar_adjuntos_pdf, llm_metadata.get("modelo_llm"), max_tokens_contexto
         )
+        if _analisis_cancelado(progreso_path):
+            return
 
         resultado.update({
             "Pregunta": pregunta,
@@ -244,27 +1290,69 @@ def _procesar_preguntas(
 
         progreso_data["progreso"] = idx + 1
         progreso_data["resultados"] = resultados
+        progreso_data["uso_tokens"] = _sumar_uso(progreso_data.get("uso_tokens"), resultado)
+        estrategia = (resultado.get("contexto") or {}).get("estrategia")
+        if estrategia:
+            estrategias = progreso_data.setdefault("estrategias_contexto", {})
+            estrategias[estrategia] = estrategias.get(estrategia, 0) + 1
+        if resultado.get("cascada"):
+            progreso_data["cascada"] = _acumular_cascada(progreso_data.get("cascada"), resultado["cascada"])
+        backend = resultado.get("backend_llm")
+        if backend:
+            backends = progreso_data.setdefault("backends_llm", {})
+            backends[backend] = backends.get(backend, 0) + 1
+        decision = (resultado.get("prefiltro") or {}).get("decision")
+        if decision:
+            decisiones = progreso_data.setdefault("prefiltro", {})
+            decisiones[decision] = decisiones.get(decision, 0) + 1
         progreso_data["fecha_modificacion"] = time.strftime("%Y-%m-%d %H:%M:%S")
 
-        with open(progreso_path, "w", encoding="utf-8") as f:
-            json.dump(_sanitize_json(progreso_data), f, indent=2, ensure_ascii=False)
+        guardar_progreso(
+            progreso_path,
+            progreso_data,
+            EVENTO_PREGUNTA_COMPLETADA,
+            {"indice": idx, "Riesgo": resultado.get("Riesgo")},
+            indices_modificados=[idx],
+        )
 
         logger.info(f"✅ Pregunta {idx + 1} completada")
 
+    duracion_total = (contexto.get("tiempo_preparacion_s") or 0) + time.monotonic() - inicio
     progreso_data.update({
         "estado": "completado",
         "num_resultados": len(resultados),
         "fecha_finalizacion": time.strftime("%Y-%m-%d %H:%M:%S"),
     })
+    if registrar_duracion:
+        progreso_data["duracion_s"] = round(duracion_total, 1)
+
+    guardar_progreso(progreso_path, progreso_data)
+    if progreso_data.get("huella_analisis"):
+        _registrar_huella(progreso_data["huella_analisis"], progreso_path)
+    if registrar_duracion and not progreso_data.get("degradado_por_presupuesto"):
+        predictor_tiempos.registrar_analisis(
+            _modo_analisis(usar_adjuntos_pdf), llm_metadata.get("modelo_llm"), total_paginas, duracion_total
+        )
+    predictor_tiempos.guardar()
 
-    with open(progreso_path, "w", encoding="utf-8") as f:
-        json.dump(_sanitize_json(progreso_data), f, indent=2, ensure_ascii=False)
-
-    logger.info(f"🎉 ANÁLISIS COMPLETADO EXITOSAMENTE - {len(resultados)} preguntas procesadas")
+    uso = progreso_data.get("uso_tokens") or {}
+    logger.info(
+        f"🎉 ANÁLISIS COMPLETADO EXITOSAMENTE - {len(resultados)} preguntas procesadas, "
+        f"{uso.get('total', 0)} tokens en {uso.get('llamadas', 0)} llamadas "
+        f"({uso.get('cache', 0)} de entrada en caché del proveedor)"
+    )
 
 
 def _obtener_metadata_llm() -> Dict[str, str]:
     """Obtiene información básica del LLM configurado en el entorno."""
+    principales = [b for b in pool_llm.backends if b.grupo == "principal"]
+    if PROVEEDORES_LLM and principales:
+        # Una pregunta puede ir a cualquier backend: el contexto se ajusta a la ventana más pequeña
+        return {
+            "modelo_llm": min(principales, key=lambda b: ventana_contexto(b.modelo)).modelo,
+            "proveedor_llm": "Pool: " + ", ".join(b.nombre for b in principales),
+        }
+
     azure_deployment = os.getenv("AZURE_DEPLOYMENT_NAME", "").strip()
     azure_endpoint = _get_azure_endpoint()
     azure_key = os.getenv("AZURE_OPENAI_API_KEY", "").strip()
@@ -288,11 +1376,51 @@ def _obtener_metadata_llm() -> Dict[str, str]:
     }
 
 
-def _crear_llm_chat() -> AzureChatOpenAI:
-    """Crea una instancia del modelo configurado para análisis de contratos."""
-    azure_endpoint = _get_azure_endpoint()
-    api_key = os.getenv("AZURE_OPENAI_API_KEY", "").strip()
-    azure_deployment = os.getenv("AZURE_DEPLOYMENT_NAME", "").strip()
+def _backends_configurados() -> List[Backend]:
+    """Backends del pool según ``PROVEEDORES_LLM`` o, sin él, la configuración de un solo deployment."""
+    backends: List[Backend] = []
+    if PROVEEDORES_LLM:
+        try:
+            for i, entrada in enumerate(json.loads(PROVEEDORES_LLM), start=1):
+                proveedor = str(entrada.get("proveedor", "azure")).lower()
+                backends.append(Backend(
+                    nombre=entrada.get("nombre") or f"{proveedor}-{i}",
+                    proveedor=proveedor,
+                    modelo=entrada["modelo"],
+                    peso=entrada.get("peso", 1),
+                    max_en_vuelo=entrada.get("max_en_vuelo", 0),
+                    rpm=entrada.get("rpm", 0),
+                    grupo=entrada.get("grupo", "principal"),
+                    opciones={k: entrada[k] for k in ("endpoint", "api_key_env", "api_version") if entrada.get(k)},
+                ))
+        except Exception as e:
+            logger.error(f"❌ PROVEEDORES_LLM no es válido, se usa la configuración de un solo deployment: {e}")
+            backends = []
+
+    if not backends:
+        azure_deployment = os.getenv("AZURE_DEPLOYMENT_NAME", "").strip()
+        if azure_deployment:
+            backends.append(Backend("azure", "azure", azure_deployment))
+        elif os.getenv("GOOGLE_API_KEY", "").strip():
+            backends.append(Backend("gemini", "gemini", DEFAULT_GEMINI_MODEL))
+    if AZURE_DEPLOYMENT_NAME_BARATO and not any(b.grupo == "barato" for b in backends):
+        backends.append(Backend("azure-barato", "azure", AZURE_DEPLOYMENT_NAME_BARATO, grupo="barato"))
+    return backends
+
+
+def _crear_llm_chat(backend: Backend):
+    """Crea el cliente de chat de un backend del pool: deployment de Azure OpenAI o modelo de Gemini."""
+    if backend.proveedor == "gemini":
+        if ChatGoogleGenerativeAI is None:
+            raise RuntimeError("langchain_google_genai es requerido para los backends de Gemini")
+        api_key = os.getenv(backend.opciones.get("api_key_env") or "GOOGLE_API_KEY", "").strip()
+        if not api_key:
+            raise ValueError(f"Configuración de Gemini incompleta ({backend.nombre})")
+        return ChatGoogleGenerativeAI(model=backend.modelo, google_api_key=api_key)
+
+    azure_endpoint, api_key_env, api_version = _recurso_azure(backend)
+    api_key = os.getenv(api_key_env, "").strip()
+    azure_deployment = backend.modelo
 
     if not (azure_endpoint and api_key and azure_deployment):
         raise ValueError("Configuración de Azure OpenAI incompleta")
@@ -309,13 +1437,46 @@ def _crear_llm_chat() -> AzureChatOpenAI:
         azure_endpoint=azure_endpoint,
         api_key=api_key,
         azure_deployment=azure_deployment,
-        api_version=AZURE_API_VERSION,
+        api_version=api_version,
+    )
+
+
+def _recurso_azure(backend: Backend) -> Tuple[Optional[str], str, str]:
+    """Endpoint, variable de la API key y versión de la API del recurso de Azure de un backend."""
+    azure_endpoint = (
+        _sanitize_azure_endpoint(backend.opciones["endpoint"]) if backend.opciones.get("endpoint")
+        else _get_azure_endpoint()
     )
+    return (
+        azure_endpoint,
+        backend.opciones.get("api_key_env") or "AZURE_OPENAI_API_KEY",
+        backend.opciones.get("api_version") or AZURE_API_VERSION,
+    )
+
+
+# El cliente se busca en el módulo en cada llamada: así se puede sustituir en pruebas
+pool_llm = PoolProveedores(_backends_configurados(), lambda backend: _crear_llm_chat(backend))
+
+
+def _modelo_barato() -> Optional[str]:
+    """Modelo del grupo barato del pool (``AZURE_DEPLOYMENT_NAME_BARATO`` o el configurado)."""
+    return next((b.modelo for b in pool_llm.backends if b.grupo == "barato"), None)
+
+
+def _grupo_modelo(modelo: Optional[str]) -> str:
+    """Grupo de backends que atiende las llamadas pedidas para ``modelo`` (None: el principal)."""
+    if modelo is None:
+        return "principal"
+    return next((b.grupo for b in pool_llm.backends if b.modelo == modelo), "principal")
 
 
 def _normalizar_respuesta_llm(respuesta_llm: str) -> Dict[str, str]:
-    """Extrae el texto sin la línea de riesgo y el nivel de riesgo informado."""
+    """
+    Extrae el texto sin la línea de riesgo y el nivel de riesgo informado. Si la respuesta
+    no trae un nivel reconocible se marca ``riesgo_por_defecto``.
+    """
     riesgo = "Medio"  # Valor por defecto
+    informado = False
 
     if "RISK:" in respuesta_llm.upper() or "RIESGO:" in respuesta_llm.upper():
         lineas = respuesta_llm.split('\n')
@@ -330,6 +1491,9 @@ def _normalizar_respuesta_llm(respuesta_llm: str) -> Dict[str, str]:
                     riesgo = "Medio"
                 elif any(word in linea_upper for word in ["NOT EVALUATED", "NO EVALUADO", "SIN EVALUAR"]):
                     riesgo = "Sin evaluar"
+                else:
+                    break
+                informado = True
                 break
 
     lineas_respuesta = respuesta_llm.split('\n')
@@ -338,7 +1502,170 @@ def _normalizar_respuesta_llm(respuesta_llm: str) -> Dict[str, str]:
         if not any(word in linea.upper() for word in ["RISK:", "RIESGO:"])
     ]).strip()
 
-    return {"Respuesta": respuesta_final, "Riesgo": riesgo}
+    resultado = {"Respuesta": respuesta_final, "Riesgo": riesgo}
+    if not informado:
+        resultado["riesgo_por_defecto"] = True
+    return resultado
+
+def _uso_vacio() -> Dict[str, int]:
+    return {"entrada": 0, "salida": 0, "total": 0, "cache": 0, "llamadas": 0}
+
+
+def _uso_tokens(mensaje: Any) -> Dict[str, int]:
+    """
+    Tokens de entrada y salida que informa el proveedor en la respuesta del LLM.
+    ``cache`` son los tokens de entrada servidos desde su caché de prompts (incluidos en ``entrada``).
+    """
+    uso = getattr(mensaje, "usage_metadata", None) or {}
+    entrada = uso.get("input_tokens")
+    salida = uso.get("output_tokens")
+    cache = (uso.get("input_token_details") or {}).get("cache_read")
+    if entrada is None or cache is None:
+        # Versiones antiguas de langchain solo lo dejan en response_metadata
+        token_usage = (getattr(mensaje, "response_metadata", None) or {}).get("token_usage") or {}
+        if entrada is None:
+            entrada = token_usage.get("prompt_tokens")
+            salida = token_usage.get("completion_tokens")
+        if cache is None:
+            cache = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    entrada, salida = int(entrada or 0), int(salida or 0)
+    return {"entrada": entrada, "salida": salida, "total": entrada + salida, "cache": int(cache or 0)}
+
+
+def _invocar_llm(
+    prompt,
+    variables: Union[Dict[str, Any], Callable[[Backend], Dict[str, Any]]],
+    modelo: Optional[str] = None,
+    proveedores: Optional[set] = None,
+) -> Tuple[str, Dict[str, int], str]:
+    """
+    Invoca ``prompt | llm`` en un backend del pool (con reintento en otro si falla) y devuelve
+    el texto de la respuesta, su uso de tokens y el nombre del backend que respondió.
+    ``variables`` puede ser una función del backend elegido (p. ej. adjuntos subidos a su recurso).
+    """
+    mensaje, backend = pool_llm.ejecutar(
+        lambda llm, backend: (prompt | llm).invoke(variables(backend) if callable(variables) else variables),
+        grupo=_grupo_modelo(modelo),
+        proveedores=proveedores,
+    )
+    return StrOutputParser().invoke(mensaje), _uso_tokens(mensaje), backend.nombre
+
+
+def _sumar_uso(acumulado: Optional[Dict[str, int]], resultado: Dict[str, Any]) -> Dict[str, int]:
+    """Añade al total del análisis los tokens de una pregunta (si hubo llamada al LLM)."""
+    acumulado = {**_uso_vacio(), **(acumulado or {})}
+    uso = resultado.get("uso_tokens")
+    if uso:
+        for campo in ("entrada", "salida", "total", "cache"):
+            acumulado[campo] += int(uso.get(campo) or 0)
+        if not uso.get("compartida"):
+            # Una pregunta map-reduce hace varias llamadas
+            acumulado["llamadas"] += int(uso.get("llamadas", 1))
+    return acumulado
+
+
+class _SingleFlight:
+    """Agrupa llamadas idénticas concurrentes: la primera ejecuta y las demás esperan su resultado.
+
+    Solo deduplica lo que está en vuelo; al terminar la llamada la clave se libera.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_vuelo: Dict[str, Future] = {}
+        self.ejecutadas = 0
+        self.compartidas = 0
+
+    def ejecutar(self, clave: str, funcion, al_compartir=None):
+        """``al_compartir`` ajusta la copia del resultado que reciben los que esperaban."""
+        with self._lock:
+            futuro = self._en_vuelo.get(clave)
+            lider = futuro is None
+            if lider:
+                futuro = Future()
+                self._en_vuelo[clave] = futuro
+                self.ejecutadas += 1
+            else:
+                self.compartidas += 1
+
+        if not lider:
+            logger.info(f"🔗 Llamada idéntica en curso, se comparte su resultado ({clave[:12]})")
+            # Copia: cada llamante añade sus propios campos al resultado
+            resultado = copy.deepcopy(futuro.result())
+            return al_compartir(resultado) if al_compartir else resultado
+
+        try:
+            resultado = funcion()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            futuro.set_result(copy.deepcopy(resultado))
+            return resultado
+        finally:
+            with self._lock:
+                self._en_vuelo.pop(clave, None)
+
+    def resumen(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "en_vuelo": len(self._en_vuelo),
+                "ejecutadas": self.ejecutadas,
+                "compartidas": self.compartidas,
+            }
+
+
+llamadas_en_vuelo = _SingleFlight()
+
+
+def _subir_archivo_azure(nombre: str, contenido: bytes, recurso: Tuple[Optional[str], str, str]) -> str:
+    """
+    Sube un PDF a la API de archivos del recurso de Azure OpenAI indicado (ver ``_recurso_azure``)
+    y devuelve su id, que solo es válido en ese recurso.
+    """
+    from openai import AzureOpenAI
+
+    azure_endpoint, api_key_env, api_version = recurso
+    cliente = AzureOpenAI(
+        azure_endpoint=azure_endpoint,
+        api_key=os.getenv(api_key_env, "").strip(),
+        api_version=api_version,
+    )
+    return cliente.files.create(file=(nombre, contenido, "application/pdf"), purpose="user_data").id
+
+
+def _subidor_adjuntos():
+    if MODO_ADJUNTOS == "azure_files":
+        return _subir_archivo_azure
+    if MODO_ADJUNTOS != "base64":
+        logger.warning(f"⚠️ MODO_ADJUNTOS desconocido ({MODO_ADJUNTOS}), se usa base64")
+    return None
+
+
+# PDFs adjuntos preparados (base64 o id del proveedor) compartidos por todas las preguntas
+almacen_adjuntos = AlmacenAdjuntos(
+    _subidor_adjuntos(),
+    ADJUNTOS_CACHE_MB * 1024 * 1024,
+    adelgazar=AdelgazadorPdf(PDF_ADELGAZADO_CACHE_DIR) if ADELGAZAR_PDF else None,
+)
+
+
+def calcular_clave_contexto(
+    pdf_principal: Optional[Tuple[str, bytes]] = None,
+    texto_principal: Optional[str] = None,
+    archivos_pdf_adjuntos: Optional[List[Tuple[str, bytes]]] = None,
+    texto_contexto: Optional[str] = None,
+) -> str:
+    """SHA-256 del contexto que recibe el LLM (documentos y texto) para agrupar llamadas idénticas."""
+    digest = hashlib.sha256()
+    for nombre, contenido in ([pdf_principal] if pdf_principal else []) + list(archivos_pdf_adjuntos or []):
+        digest.update(nombre.encode("utf-8"))
+        digest.update(hashlib.sha256(contenido).digest())
+    for texto in (texto_principal, texto_contexto):
+        digest.update(b"\x00")
+        digest.update((texto or "").encode("utf-8"))
+    return digest.hexdigest()
+
 
 def analizar_pregunta(
     pregunta: str,
@@ -348,8 +1675,73 @@ def analizar_pregunta(
     usar_adjuntos_pdf: bool = False,
     archivos_pdf_adjuntos: Optional[List[Tuple[str, bytes]]] = None,
     texto_contexto: Optional[str] = None,
+    clave_contexto: Optional[str] = None,
+    textos_anexos: Optional[List[str]] = None,
+    modelo: Optional[str] = None,
+    max_tokens_contexto: Optional[int] = None,
+):
+    """
+    Analiza una pregunta combinando múltiples documentos como contexto.
+
+    Si otro hilo está haciendo ya la misma llamada (mismo contexto, pregunta, sección,
+    modo y modelo) se espera a su resultado en lugar de repetirla. ``clave_contexto``
+    evita rehashear los documentos en cada pregunta. ``textos_anexos`` separa por
+    documento el ``texto_contexto`` para ajustarlo a la ventana del modelo. ``modelo`` usa
+    otro deployment en lugar del configurado. Con ``max_tokens_contexto`` los documentos se
+    limitan a esos tokens con la estrategia ``fragmentos`` (sin map-reduce).
+    """
+    if clave_contexto is None:
+        clave_contexto = calcular_clave_contexto(
+            pdf_principal, texto_principal, archivos_pdf_adjuntos, texto_contexto
+        )
+    clave = hashlib.sha256(
+        json.dumps(
+            [
+                clave_contexto, pregunta, seccion, bool(usar_adjuntos_pdf), _obtener_metadata_llm(), modelo,
+                max_tokens_contexto,
+            ],
+            ensure_ascii=False,
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+    return llamadas_en_vuelo.ejecutar(
+        clave,
+        lambda: _analizar_pregunta(
+            pregunta,
+            seccion,
+            pdf_principal,
+            texto_principal,
+            usar_adjuntos_pdf,
+            archivos_pdf_adjuntos,
+            texto_contexto,
+            textos_anexos,
+            modelo,
+            max_tokens_contexto,
+        ),
+        al_compartir=_marcar_compartida,
+    )
+
+
+def _marcar_compartida(resultado: Dict[str, Any]) -> Dict[str, Any]:
+    """Quien comparte una llamada ajena no ha gastado tokens."""
+    if resultado.get("uso_tokens"):
+        resultado["uso_tokens"] = {"entrada": 0, "salida": 0, "total": 0, "cache": 0, "compartida": True}
+    return resultado
+
+
+def _analizar_pregunta(
+    pregunta: str,
+    seccion: str,
+    pdf_principal: Optional[Tuple[str, bytes]],
+    texto_principal: Optional[str],
+    usar_adjuntos_pdf: bool,
+    archivos_pdf_adjuntos: Optional[List[Tuple[str, bytes]]],
+    texto_contexto: Optional[str],
+    textos_anexos: Optional[List[str]] = None,
+    modelo: Optional[str] = None,
+    max_tokens_contexto: Optional[int] = None,
 ):
-    """Analiza una pregunta combinando múltiples documentos como contexto."""
     archivos_pdf_adjuntos = archivos_pdf_adjuntos or []
     nombre_principal = pdf_principal[0] if pdf_principal else "N/A"
 
@@ -370,7 +1762,7 @@ def analizar_pregunta(
         if usar_adjuntos_pdf and adjuntos_disponibles:
             logger.info("📎 Enviando pregunta con %d adjunto(s) PDF al LLM", len(adjuntos_disponibles))
             try:
-                return analizar_pregunta_con_adjuntos(pregunta, seccion, adjuntos_disponibles)
+                return analizar_pregunta_con_adjuntos(pregunta, seccion, adjuntos_disponibles, modelo)
             except Exception as adjuntos_error:
                 logger.warning(
                     "⚠️ Error utilizando adjuntos PDF, se intentará con texto plano: %s",
@@ -386,11 +1778,34 @@ def analizar_pregunta(
             except Exception as e:
                 logger.error(f"❌ Error extrayendo texto del PDF principal: {e}")
 
-        if texto_contexto:
-            texto_total = (f"{texto_total}\n\n{texto_contexto}" if texto_total else texto_contexto).strip()
+        if textos_anexos is None:
+            textos_anexos = [texto_contexto] if texto_contexto else []
+
+        presupuesto = presupuesto_contexto(
+            modelo or _obtener_metadata_llm().get("modelo_llm"), _tokens_fijos(pregunta, seccion, False)
+        )
+        if max_tokens_contexto:
+            presupuesto = min(presupuesto, max_tokens_contexto)
+        documentos = [t for t in [texto_total, *textos_anexos] if t]
+        if (
+            ESTRATEGIA_CONTEXTO == "mapreduce"
+            and not max_tokens_contexto
+            and sum(contar_tokens(t) for t in documentos) > presupuesto
+        ):
+            return analizar_pregunta_mapreduce(pregunta, seccion, documentos, presupuesto, modelo)
+
+        texto_total, info_contexto = ajustar_contexto(
+            texto_total,
+            textos_anexos,
+            presupuesto,
+            consulta=f"{seccion}\n{pregunta}",
+            estrategia="fragmentos" if max_tokens_contexto else None,
+        )
 
         if texto_total:
-            return analizar_pregunta_texto(pregunta, seccion, texto_total)
+            resultado = analizar_pregunta_texto(pregunta, seccion, texto_total, modelo)
+            resultado["contexto"] = info_contexto
+            return resultado
 
         logger.error("❌ No se pudo obtener contexto para la pregunta")
         return {
@@ -409,9 +1824,13 @@ def analizar_pregunta(
 def analizar_pregunta_con_adjuntos(
     pregunta: str,
     seccion: str,
-    archivos_pdf: List[Tuple[str, bytes]]
+    archivos_pdf: List[Tuple[str, bytes]],
+    modelo: Optional[str] = None,
 ) -> Dict[str, str]:
-    """Envía la pregunta al LLM adjuntando los PDFs codificados en base64."""
+    """
+    Envía la pregunta al LLM adjuntando los PDFs. Cada PDF se codifica en base64 (o se sube
+    al proveedor, según ``MODO_ADJUNTOS``) una sola vez y se reutiliza en todas las preguntas.
+    """
     logger.info(
         "📎 Preparando mensaje con adjuntos",
         extra={"pregunta_preview": pregunta[:80], "total_adjuntos": len(archivos_pdf)},
@@ -420,79 +1839,210 @@ def analizar_pregunta_con_adjuntos(
     if not archivos_pdf:
         raise ValueError("Se requiere al menos un PDF para adjuntar")
 
-    llm = _crear_llm_chat()
+    input_text = PROMPT_HUMANO_ADJUNTOS.format(seccion=seccion, pregunta=pregunta)
 
-    system_prompt = """You are a legal assistant specialized in contract analysis. Answer the user's question clearly and precisely, using the attached document(s) as context.
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", PROMPT_SISTEMA_ADJUNTOS),
+        MessagesPlaceholder("user_messages"),
+    ])
 
-Your answer must be written in Markdown format, suitable for inclusion in a DOCX document (use clear sections, bullet points, or numbered lists donde cada punto sea muy breve).
+    def mensajes(backend: Backend) -> Dict[str, Any]:
+        # Un id de archivo solo existe en el recurso de Azure donde se subió: se sube (una vez)
+        # al del backend que atiende esta llamada
+        destino = _recurso_azure(backend) if almacen_adjuntos.subir is not None else None
+        human_content: List[Dict[str, str]] = [
+            {
+                "type": "text",
+                "text": input_text,
+            }
+        ]
 
-Haz la respuesta lo más concisa posible: máximo tres puntos o frases cortas y alrededor de 70 palabras en total.
+        for idx, (filename, contenido) in enumerate(archivos_pdf, start=1):
+            nombre_archivo = filename or f"documento_{idx}.pdf"
+            human_content.append(almacen_adjuntos.bloque(nombre_archivo, contenido, destino))
 
-Incluye únicamente los datos imprescindibles para justificar la respuesta, citando cláusulas, apartados o anexos relevantes cuando proceda.
+        if PROMPT_PREFIJO_ESTABLE:
+            # Los PDF primero: mismo prefijo en todas las preguntas del análisis
+            human_content.append(human_content.pop(0))
 
-Responde siempre en español neutro.
+        return {"user_messages": [HumanMessage(content=human_content)]}
 
-At the end of your answer, assess the legal risk level based on the following criteria:
-- HIGH: Clauses that may create significant liabilities, unilateral termination, severe penalties, ambiguous terms favoring the other party, or lack of important protections.
-- MEDIUM: Terms that require attention but do not pose immediate risks, standard clauses that could be improved.
-- LOW: Favorable or neutral terms, standard industry clauses, or adequate protections.
-- NOT EVALUATED: If you do not have enough information to assess the risk, or the question is not applicable, finish your answer with "RISK: NOT EVALUATED".
+    try:
+        # Los PDF referenciados por id solo existen en la API de archivos de Azure
+        respuesta_llm, uso_tokens, backend = _invocar_llm(
+            prompt,
+            mensajes,
+            modelo,
+            proveedores={"azure"} if almacen_adjuntos.subir is not None else None,
+        )
+    except Exception:
+        # Un id caducado o borrado en el proveedor no debe quedarse en memoria: se vuelve a subir
+        if almacen_adjuntos.subir is not None:
+            for _, contenido in archivos_pdf:
+                almacen_adjuntos.olvidar(contenido)
+        raise
 
-Finish your answer with a line that clearly states: "RISK: [HIGH/MEDIUM/LOW/NOT EVALUATED]"""  # noqa: E501
+    logger.info(f"✅ Respuesta recibida con adjuntos (longitud: {len(respuesta_llm)} caracteres)")
+    resultado = _normalizar_respuesta_llm(respuesta_llm)
+    resultado["uso_tokens"] = uso_tokens
+    resultado["backend_llm"] = backend
+    logger.info(f"🎯 Riesgo evaluado (adjuntos): {resultado['Riesgo']}")
+    return resultado
 
-    input_text = (
-        f"Section: {seccion}\n"
-        f"Question: {pregunta}\n\n"
-        "Please analyze the attached PDF contract(s) and answer the question."
+def _tokens_fijos_mapa(pregunta: str, seccion: str) -> int:
+    return contar_tokens(PROMPT_SISTEMA_MAPA) + contar_tokens(
+        PROMPT_HUMANO_MAPA.format(seccion=seccion, pregunta=pregunta, indice=0, total=0, fragmento="")
     )
 
-    human_content: List[Dict[str, str]] = [
-        {
-            "type": "text",
-            "text": input_text,
-        }
-    ]
 
-    for idx, (filename, contenido) in enumerate(archivos_pdf, start=1):
-        nombre_archivo = filename or f"documento_{idx}.pdf"
-        pdf_base64 = base64.b64encode(contenido).decode("utf-8")
+def _ventanas_mapa(pregunta: str, seccion: str, textos: List[str], modelo: Optional[str]) -> List[str]:
+    """Ventanas del documento que caben, cada una, en una llamada del paso map."""
+    return dividir_en_ventanas(textos, presupuesto_contexto(modelo, _tokens_fijos_mapa(pregunta, seccion)))
 
-        human_content.append(
-            {
-                "type": "file",
-                "source_type": "base64",
-                "data": pdf_base64,
-                "mime_type": "application/pdf",
-                "filename": nombre_archivo,
-            }
-        )
+
+def _mapa_cache_path(ventana: str, pregunta: str, seccion: str, modelo: Optional[str]) -> Path:
+    clave = hashlib.sha256(
+        json.dumps(
+            [VERSION_PROMPTS, modelo, seccion, pregunta, hashlib.sha256(ventana.encode("utf-8")).hexdigest()],
+            ensure_ascii=False,
+        ).encode("utf-8")
+    ).hexdigest()
+    return MAPAS_CACHE_DIR / f"{clave}.json"
+
+
+def _extraer_hallazgos(
+    pregunta: str,
+    seccion: str,
+    ventana: str,
+    indice: int,
+    total: int,
+    modelo: Optional[str],
+) -> Dict[str, Any]:
+    """Paso map sobre una ventana; el resultado se guarda en caché para los re-análisis."""
+    cache_path = _mapa_cache_path(ventana, pregunta, seccion, modelo)
+    if cache_path.exists():
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return {"hallazgos": json.load(f)["hallazgos"], "en_cache": True}
+        except Exception as e:
+            logger.warning(f"⚠️ Caché de map-reduce ilegible ({cache_path.name}): {e}")
 
     prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        MessagesPlaceholder("user_messages"),
+        ("system", PROMPT_SISTEMA_MAPA),
+        ("human", PROMPT_HUMANO_MAPA),
     ])
+    respuesta_llm, uso_tokens, _ = _invocar_llm(prompt, {
+        "seccion": seccion,
+        "pregunta": pregunta,
+        "indice": indice,
+        "total": total,
+        "fragmento": ventana,
+    }, modelo)
+    hallazgos = respuesta_llm.strip()
 
-    human_message = HumanMessage(content=human_content)
-    chain = prompt | llm | StrOutputParser()
+    try:
+        _guardar_json_cache(cache_path, {"hallazgos": hallazgos})
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudieron guardar los hallazgos en caché: {e}")
 
-    respuesta_llm = chain.invoke({
-        "user_messages": [human_message],
-    })
+    return {"hallazgos": hallazgos, "uso_tokens": uso_tokens, "en_cache": False}
+
+
+def analizar_pregunta_mapreduce(
+    pregunta: str,
+    seccion: str,
+    textos: List[str],
+    presupuesto: int,
+    modelo: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Responde una pregunta sobre documentos que no caben en la ventana del modelo.
+
+    Map: cada ventana del documento extrae en paralelo los hallazgos relevantes (en caché
+    por ventana, pregunta y modelo, así un re-análisis solo repite la reducción).
+    Reduce: una llamada sintetiza los hallazgos en la respuesta habitual con su línea RISK.
+    """
+    modelo = modelo or _obtener_metadata_llm().get("modelo_llm")
+    ventanas = _ventanas_mapa(pregunta, seccion, textos, modelo)
+    logger.info(f"🗺️ Map-reduce: '{pregunta[:50]}...' sobre {len(ventanas)} ventanas")
+
+    with ThreadPoolExecutor(
+        max_workers=min(MAPREDUCE_PARALELISMO, len(ventanas)) or 1, thread_name_prefix="mapa"
+    ) as executor:
+        mapas = list(executor.map(
+            lambda args: _extraer_hallazgos(pregunta, seccion, args[1], args[0], len(ventanas), modelo),
+            enumerate(ventanas, start=1),
+        ))
+
+    uso_tokens = _uso_vacio()
+    for mapa in mapas:
+        if mapa.get("uso_tokens"):
+            uso_tokens = _sumar_uso(uso_tokens, mapa)
+
+    hallazgos = [
+        f"[Excerpt {i}/{len(mapas)}]\n{mapa['hallazgos']}"
+        for i, mapa in enumerate(mapas, start=1)
+        if mapa["hallazgos"] and not mapa["hallazgos"].upper().startswith(SIN_HALLAZGOS)
+    ]
+    texto_hallazgos, _ = ajustar_contexto(
+        "\n\n".join(hallazgos) or "No excerpt contains information relevant to the question.",
+        [],
+        presupuesto_contexto(modelo, contar_tokens(PROMPT_SISTEMA_TEXTO) + contar_tokens(
+            PROMPT_HUMANO_REDUCCION.format(seccion=seccion, pregunta=pregunta, hallazgos="")
+        )),
+        estrategia="priorizar_principal",
+    )
+
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", PROMPT_SISTEMA_TEXTO),
+        ("human", PROMPT_HUMANO_REDUCCION),
+    ])
+    respuesta_llm, uso_reduccion, backend = _invocar_llm(prompt, {
+        "seccion": seccion,
+        "pregunta": pregunta,
+        "hallazgos": texto_hallazgos,
+    }, modelo)
+    uso_tokens = _sumar_uso(uso_tokens, {"uso_tokens": uso_reduccion})
 
-    logger.info(f"✅ Respuesta recibida con adjuntos (longitud: {len(respuesta_llm)} caracteres)")
     resultado = _normalizar_respuesta_llm(respuesta_llm)
-    logger.info(f"🎯 Riesgo evaluado (adjuntos): {resultado['Riesgo']}")
+    resultado["uso_tokens"] = uso_tokens
+    resultado["backend_llm"] = backend
+    resultado["contexto"] = {
+        "estrategia": "mapreduce",
+        "tokens_original": sum(contar_tokens(t) for t in textos),
+        "presupuesto": presupuesto,
+        "ventanas": len(ventanas),
+        "ventanas_en_cache": sum(1 for mapa in mapas if mapa["en_cache"]),
+        "ventanas_con_hallazgos": len(hallazgos),
+    }
+    logger.info(
+        f"🎯 Riesgo evaluado (map-reduce, {len(hallazgos)}/{len(ventanas)} ventanas con hallazgos): "
+        f"{resultado['Riesgo']}"
+    )
     return resultado
 
-def analizar_documento(contratos_paths, preguntas_path, progreso_path, usar_adjuntos_pdf=False):
-    """Función principal que analiza un conjunto de documentos con todas las preguntas."""
+
+def analizar_documento(
+    contratos_paths,
+    preguntas_path,
+    progreso_path,
+    usar_adjuntos_pdf=False,
+    reutilizar_resultados=True,
+):
+    """
+    Función principal que analiza un conjunto de documentos con todas las preguntas.
+    Con ``reutilizar_resultados`` copia los resultados de un análisis completado idéntico
+    (mismos documentos, preguntas, prompts, modelo y modo) en lugar de volver a llamar al LLM.
+    """
     logger.info("🚀 INICIANDO ANÁLISIS ASÍNCRONO")
     logger.info(f"📁 Documentos: {contratos_paths}")
     logger.info(f"📋 Preguntas: {preguntas_path}")
     logger.info(f"📊 Progreso: {progreso_path}")
+    if _analisis_cancelado(progreso_path):
+        return
 
     try:
-        contratos_paths = [Path(p) for p in contratos_paths]
+        contratos_paths = _normalizar_documentos(contratos_paths)
 
         logger.info(f"📖 Leyendo preguntas desde: {preguntas_path}")
         df_preguntas = pd.read_excel(preguntas_path)
@@ -509,19 +2059,21 @@ def analizar_documento(contratos_paths, preguntas_path, progreso_path, usar_adju
             contexto,
             usar_adjuntos_pdf,
             llm_metadata,
+            reutilizar_resultados,
         )
 
     except Exception as e:
         logger.error(f"❌ ERROR EN ANÁLISIS: {str(e)}", exc_info=True)
+        if _analisis_cancelado(progreso_path):
+            return
         try:
-            with open(progreso_path, "w", encoding="utf-8") as f:
-                json.dump(_sanitize_json({
-                    "estado": "error",
-                    "resultados": [],
-                    "error": str(e),
-                    "fecha_error": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "usar_adjuntos_pdf": usar_adjuntos_pdf,
-                }), f, indent=2, ensure_ascii=False)
+            guardar_progreso(progreso_path, {
+                "estado": "error",
+                "resultados": [],
+                "error": str(e),
+                "fecha_error": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "usar_adjuntos_pdf": usar_adjuntos_pdf,
+            }, EVENTO_ERROR, reiniciar_resultados=True)
         except Exception as e2:
             logger.error(f"❌ ERROR AL GUARDAR ERROR: {str(e2)}")
 
@@ -530,12 +2082,13 @@ def analizar_documento_con_preguntas_custom(
     preguntas_custom,
     progreso_path,
     usar_adjuntos_pdf=False,
+    reutilizar_resultados=True,
 ):
     """Analiza documentos con preguntas personalizadas proporcionadas por el usuario."""
     logger.info(f"🚀 INICIANDO ANÁLISIS CON PREGUNTAS CUSTOM - {len(preguntas_custom)} preguntas")
 
     try:
-        contratos_paths = [Path(p) for p in contratos_paths]
+        contratos_paths = _normalizar_documentos(contratos_paths)
 
         preguntas = [
             {
@@ -554,19 +2107,19 @@ def analizar_documento_con_preguntas_custom(
             contexto,
             usar_adjuntos_pdf,
             llm_metadata,
+            reutilizar_resultados,
         )
 
     except Exception as e:
         logger.error(f"❌ ERROR EN ANÁLISIS CUSTOM: {str(e)}", exc_info=True)
         try:
-            with open(progreso_path, "w", encoding="utf-8") as f:
-                json.dump(_sanitize_json({
-                    "estado": "error",
-                    "resultados": [],
-                    "error": str(e),
-                    "fecha_error": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "usar_adjuntos_pdf": usar_adjuntos_pdf,
-                }), f, indent=2, ensure_ascii=False)
+            guardar_progreso(progreso_path, {
+                "estado": "error",
+                "resultados": [],
+                "error": str(e),
+                "fecha_error": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "usar_adjuntos_pdf": usar_adjuntos_pdf,
+            }, EVENTO_ERROR, reiniciar_resultados=True)
         except Exception as e2:
             logger.error(f"❌ ERROR AL GUARDAR ERROR: {str(e2)}")
 
@@ -591,7 +2144,7 @@ def reanalizar_pregunta_individual_sobreescribir(contratos_paths, pregunta_data,
         if "resultados" not in progreso_original or len(progreso_original["resultados"]) <= num_pregunta:
             raise Exception(f"No existe resultado para la pregunta {num_pregunta}")
 
-        contratos_paths = [Path(p) for p in contratos_paths]
+        contratos_paths = _normalizar_documentos(contratos_paths)
         contexto = _preparar_contexto_documentos(contratos_paths)
 
         llm_metadata = _obtener_metadata_llm()
@@ -601,26 +2154,29 @@ def reanalizar_pregunta_individual_sobreescribir(contratos_paths, pregunta_data,
 
         progreso_original["documentos_info"] = contexto.get("documentos_info")
 
-        resultado = analizar_pregunta(
+        resultado = _analizar_pregunta_medida(
             pregunta_data["pregunta"],
             pregunta_data.get("seccion", "Sin sección"),
-            pdf_principal=contexto.get("pdf_principal"),
-            texto_principal=contexto.get("texto_principal"),
-            usar_adjuntos_pdf=usar_adjuntos_pdf,
-            archivos_pdf_adjuntos=contexto.get("archivos_pdf_adjuntos"),
-            texto_contexto=contexto.get("texto_contexto") or contexto.get("texto_fallback"),
+            contexto,
+            usar_adjuntos_pdf,
+            llm_metadata.get("modelo_llm"),
         )
+        predictor_tiempos.guardar()
         
-        # Actualizar solo la pregunta específica en los resultados
-        progreso_original["resultados"][num_pregunta].update({
+        # Sustituir la pregunta específica en los resultados: del resultado anterior no se
+        # conserva nada (citas, backend, cascada, prefiltro o contexto de la respuesta vieja)
+        resultado.update({
             "Pregunta": pregunta_data["pregunta"],
-            "Sección": pregunta_data.get("seccion", "Sin sección"), 
-            "Respuesta": resultado["Respuesta"],
-            "Riesgo": resultado["Riesgo"],
+            "Sección": pregunta_data.get("seccion", "Sin sección"),
             "reanalizado_en": time.strftime("%Y-%m-%d %H:%M:%S"),
             "tipo_reanalisis": "individual"
         })
+        progreso_original["resultados"][num_pregunta] = resultado
         
+        # Los resultados ya no corresponden a la huella: no debe reutilizarse este análisis
+        progreso_original.pop("huella_analisis", None)
+        progreso_original["uso_tokens"] = _sumar_uso(progreso_original.get("uso_tokens"), resultado)
+
         # Actualizar metadatos del análisis
         progreso_original.update({
             "estado": "completado",
@@ -630,8 +2186,13 @@ def reanalizar_pregunta_individual_sobreescribir(contratos_paths, pregunta_data,
         })
         
         # Guardar el progreso actualizado
-        with open(progreso_path, "w", encoding="utf-8") as f:
-            json.dump(_sanitize_json(progreso_original), f, indent=2, ensure_ascii=False)
+        guardar_progreso(
+            progreso_path,
+            progreso_original,
+            EVENTO_PREGUNTA_COMPLETADA,
+            {"indice": num_pregunta, "Riesgo": resultado["Riesgo"]},
+            indices_modificados=[num_pregunta],
+        )
         
         logger.info(f"✅ RE-ANÁLISIS INDIVIDUAL (SOBREESCRIBIR) COMPLETADO - Pregunta {num_pregunta} actualizada")
         
@@ -648,8 +2209,60 @@ def reanalizar_pregunta_individual_sobreescribir(contratos_paths, pregunta_data,
                 "fecha_modificacion": time.strftime("%Y-%m-%d %H:%M:%S")
             })
             
-            with open(progreso_path, "w", encoding="utf-8") as f:
-                json.dump(_sanitize_json(progreso_actual), f, indent=2, ensure_ascii=False)
+            guardar_progreso(progreso_path, progreso_actual, EVENTO_ERROR)
+        except Exception as e2:
+            logger.error(f"❌ ERROR AL GUARDAR ERROR: {str(e2)}")
+
+
+def reanudar_analisis(contratos_paths, progreso_path):
+    """Continúa un análisis pausado por presupuesto desde la primera pregunta sin responder."""
+    logger.info(f"▶️ REANUDANDO ANÁLISIS PAUSADO - {Path(progreso_path).stem}")
+    if _analisis_cancelado(progreso_path):
+        return
+
+    try:
+        with open(progreso_path, "r", encoding="utf-8") as f:
+            progreso_data = json.load(f)
+
+        preguntas = progreso_data.get("preguntas_originales") or []
+        contexto = _preparar_contexto_documentos(_normalizar_documentos(contratos_paths))
+        llm_metadata = _obtener_metadata_llm()
+        if llm_metadata.get("modelo_llm") != progreso_data.get("modelo_llm"):
+            # Resultados de dos modelos: ya no corresponden a la huella
+            progreso_data.pop("huella_analisis", None)
+            progreso_data["modelo_llm"] = llm_metadata.get("modelo_llm")
+            progreso_data["proveedor_llm"] = llm_metadata.get("proveedor_llm")
+
+        progreso_data.pop("motivo_pausa", None)
+        progreso_data.update({
+            "estado": "en_progreso",
+            "fecha_modificacion": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+        guardar_progreso(progreso_path, progreso_data)
+
+        _ejecutar_preguntas(
+            preguntas,
+            progreso_path,
+            progreso_data,
+            contexto,
+            llm_metadata,
+            time.monotonic(),
+            registrar_duracion=False,
+        )
+
+    except Exception as e:
+        logger.error(f"❌ ERROR AL REANUDAR EL ANÁLISIS: {str(e)}", exc_info=True)
+        try:
+            with open(progreso_path, "r", encoding="utf-8") as f:
+                progreso_actual = json.load(f)
+
+            progreso_actual.update({
+                "estado": "error",
+                "error": f"Error al reanudar el análisis: {str(e)}",
+                "fecha_modificacion": time.strftime("%Y-%m-%d %H:%M:%S")
+            })
+
+            guardar_progreso(progreso_path, progreso_actual, EVENTO_ERROR)
         except Exception as e2:
             logger.error(f"❌ ERROR AL GUARDAR ERROR: {str(e2)}")
 
@@ -660,6 +2273,8 @@ def reanalizar_documento_global_sobreescribir(contratos_paths, preguntas_editada
     Mantiene el mismo ID y archivo de progreso.
     """
     logger.info(f"🔄 INICIANDO RE-ANÁLISIS GLOBAL (SOBREESCRIBIR) - {len(preguntas_editadas)} preguntas")
+    if _analisis_cancelado(progreso_path):
+        return
     
     try:
         with open(progreso_path, "r", encoding="utf-8") as f:
@@ -675,10 +2290,9 @@ def reanalizar_documento_global_sobreescribir(contratos_paths, preguntas_editada
 
         progreso_original["resultados"] = []
 
-        with open(progreso_path, "w", encoding="utf-8") as f:
-            json.dump(_sanitize_json(progreso_original), f, indent=2, ensure_ascii=False)
+        guardar_progreso(progreso_path, progreso_original, reiniciar_resultados=True)
 
-        contratos_paths = [Path(p) for p in contratos_paths]
+        contratos_paths = _normalizar_documentos(contratos_paths)
         contexto = _preparar_contexto_documentos(contratos_paths)
 
         llm_metadata = _obtener_metadata_llm()
@@ -704,14 +2318,15 @@ def reanalizar_documento_global_sobreescribir(contratos_paths, preguntas_editada
             usar_adjuntos_pdf,
             llm_metadata,
         )
+        if _analisis_cancelado(progreso_path):
+            return
 
         with open(progreso_path, "r", encoding="utf-8") as f:
             progreso_final = json.load(f)
 
         progreso_final["preguntas_originales"] = preguntas
 
-        with open(progreso_path, "w", encoding="utf-8") as f:
-            json.dump(_sanitize_json(progreso_final), f, indent=2, ensure_ascii=False)
+        guardar_progreso(progreso_path, progreso_final)
 
         logger.info(f"✅ RE-ANÁLISIS GLOBAL (SOBREESCRIBIR) COMPLETADO - {len(preguntas)} preguntas procesadas")
         
@@ -728,12 +2343,11 @@ def reanalizar_documento_global_sobreescribir(contratos_paths, preguntas_editada
                 "fecha_modificacion": time.strftime("%Y-%m-%d %H:%M:%S")
             })
             
-            with open(progreso_path, "w", encoding="utf-8") as f:
-                json.dump(_sanitize_json(progreso_actual), f, indent=2, ensure_ascii=False)
+            guardar_progreso(progreso_path, progreso_actual, EVENTO_ERROR)
         except Exception as e2:
             logger.error(f"❌ ERROR AL GUARDAR ERROR: {str(e2)}")
 
-def analizar_pregunta_texto(pregunta, seccion, texto_contrato):
+def analizar_pregunta_texto(pregunta, seccion, texto_contrato, modelo=None):
     """
     Analiza una pregunta usando Gemini LLM con texto plano como contexto.
     Usado para archivos que no son PDF.
@@ -742,97 +2356,23 @@ def analizar_pregunta_texto(pregunta, seccion, texto_contrato):
     logger.info(f"📝 ANALIZANDO PREGUNTA CON TEXTO: '{pregunta[:50]}...' | Sección: {seccion}")
     
     try:
-        llm = _crear_llm_chat()
-        logger.info("✅ Modelo inicializado correctamente para análisis con texto plano")
-
         logger.info(f"📄 Preparando texto para análisis (longitud: {len(texto_contrato)} caracteres)")
         prompt = ChatPromptTemplate.from_messages([
-            ("system", """
-            You are a legal assistant specialized in contract analysis. Answer based only on the attached document.
-
-Instructions:
-
-Write in Markdown, suitable for DOCX.
-
-Use clear headings and max 3 bullet points or short sentences.
-
-Limit to ~70 words total.
-
-Reference specific clauses/sections when possible.
-
-Be concise, professional, neutral, and precise.
-
-Risk Assessment:
-At the end, assign a legal risk level:
-
-HIGH – major liabilities, penalties, unilateral rights, missing protections.
-
-MEDIUM – terms need attention but not critical.
-
-LOW – neutral or protective terms.
-
-NOT EVALUATED – insufficient info.
-
-Final line:
-RISK: [HIGH/MEDIUM/LOW/NOT EVALUATED]
-
-Sample Answers
-Termination Clause
-
-Either party may terminate with 30 days’ notice (Clause 12.2).
-
-No penalty or compensation for early exit.
-
-Potential exposure to sudden termination.
-
-RISK: HIGH
-
-Payment Terms
-
-Payment due within 45 days after invoice (Clause 5.1).
-
-No interest defined for late payment.
-
-Standard but enforcement could be weak.
-
-RISK: MEDIUM
-
-Confidentiality
-
-Mutual non-disclosure obligations (Clause 8.3).
-
-Duration: 2 years post-termination.
-
-Adequate and aligned with industry standards.
-
-RISK: LOW
-
-Liability
-
-Liability capped at total contract value (Clause 9.4).
-
-Excludes gross negligence and willful misconduct.
-
-Balanced and protective framework.
-
-RISK: LOW
-"""),
-            ("human", f"""
-            Section: {{seccion}}
-            Question: {{pregunta}}
-            Document to analyze:{{texto_contrato}}""")
+            ("system", PROMPT_SISTEMA_TEXTO),
+            ("human", _plantilla_humano_texto()),
         ])
         
         logger.info(f"📝 Enviando consulta al LLM...")
-        chain = prompt | llm | StrOutputParser()
-        respuesta_llm = chain.invoke({
+        respuesta_llm, uso_tokens, backend = _invocar_llm(prompt, {
             "seccion": seccion,
             "pregunta": pregunta,
             "texto_contrato": texto_contrato
-        })
+        }, modelo)
         logger.info(f"✅ Respuesta recibida del LLM (longitud: {len(respuesta_llm)} caracteres)")
 
         resultado = _normalizar_respuesta_llm(respuesta_llm)
+        resultado["uso_tokens"] = uso_tokens
+        resultado["backend_llm"] = backend
         logger.info(f"🎯 Riesgo evaluado: {resultado['Riesgo']}")
         logger.info("✅ Análisis completado exitosamente")
         return resultado
@@ -3,6 +3,8 @@ import pandas as pd
 from pathlib import Path
 import json
 import requests
+from pages.modules.resultados_incrementales import obtener_progreso_incremental
+from pages.modules.idempotencia import post_idempotente
 
 # --- ESTILO MAXAM ---
 st.markdown("""
@@ -103,6 +105,11 @@ if not analisis_id:
 
 # --- FUNCIONES AUXILIARES ---
 def refrescar_progreso():
+    # Solo se descargan los resultados nuevos o reanalizados desde la última lectura
+    progreso_incremental = obtener_progreso_incremental(analisis_id)
+    if progreso_incremental is not None:
+        return progreso_incremental
+
     progreso_path = Path(__file__).parent.parent.parent / "fastapi_backend" / "progreso" / f"{analisis_id}.json"
     with open(progreso_path, "r", encoding="utf-8") as f:
         progreso_data = f.read()
@@ -168,7 +175,7 @@ for idx, preg in enumerate(preguntas):
             st.session_state["rean_progreso"] = {**rean_progreso, idx: True}
             payload = {"pregunta": nueva_pregunta, "seccion": seccion}
             with st.spinner("Re-analizando pregunta..."):
-                resp = requests.post(f"{API_URL}/reanalisar_pregunta/{analisis_id}/{idx}", json=payload)
+                resp = post_idempotente(f"{API_URL}/reanalisar_pregunta/{analisis_id}/{idx}", payload, json=payload)
             st.session_state["rean_progreso"][idx] = False
             if resp.status_code == 200:
                 st.success("Pregunta re-analizada. Refrescando...")
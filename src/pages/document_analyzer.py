@@ -7,6 +7,8 @@ from datetime import datetime
 import sqlite3
 import json
 import time
+import hashlib
+from pages.modules.idempotencia import post_idempotente
 
 API_URL = "http://localhost:8000"  # Cambiar en producción
 
@@ -107,8 +109,9 @@ def mostrar_detalle_dialog(analisis_id, filename):
                     
                     # Llamar al endpoint de reanálisis global
                     try:
-                        response = requests.post(
+                        response = post_idempotente(
                             f"{API_URL}/reanalisar_global/{analisis_id}",
+                            preguntas_para_reanalisar,
                             json={"preguntas": preguntas_para_reanalisar}
                         )
                         if response.status_code == 200:
@@ -211,7 +214,7 @@ def mostrar_detalle_dialog(analisis_id, filename):
                     
                     with st.spinner("🔄 Re-analizando pregunta..."):
                         try:
-                            resp = requests.post(f"{API_URL}/reanalisar_pregunta/{analisis_id}/{idx}", json=payload)
+                            resp = post_idempotente(f"{API_URL}/reanalisar_pregunta/{analisis_id}/{idx}", payload, json=payload)
                             if resp.status_code == 200:
                                 st.toast("✅ Pregunta re-analizada exitosamente!", icon="🎉")
                                 st.success("✅ Pregunta re-analizada exitosamente!")
@@ -1232,8 +1235,11 @@ with col_izq:
                     )
                     for file_info in processed_files
                 ]
-                response = requests.post(
+                response = post_idempotente(
                     f"{API_URL}/analizar",
+                    [
+                        [f["name"], hashlib.sha256(f["bytes"]).hexdigest()] for f in processed_files
+                    ] + [nombre_analisis, use_pdf_attachments],
                     files=files_payload,
                     data={
                         "use_pdf_attachments": str(use_pdf_attachments).lower(),
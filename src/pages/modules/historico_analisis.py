@@ -15,6 +15,8 @@ from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.oxml.shared import OxmlElement, qn
 import io
 import re
+from pages.modules.resultados_incrementales import obtener_progreso_incremental, descartar_cache_resultados
+from pages.modules.idempotencia import post_idempotente
 
 def obtener_analisis_completados_backend():
     """Obtiene análisis completados desde el backend FastAPI"""
@@ -196,6 +198,7 @@ def mostrar_detalle_dialog(analisis_id, filename):
             # Forzar recarga limpiando cualquier cache
             if f'progreso_data_{analisis_id}' in st.session_state:
                 del st.session_state[f'progreso_data_{analisis_id}']
+            descartar_cache_resultados(analisis_id)
             st.rerun()
     
     if progreso_path.exists():
@@ -227,9 +230,12 @@ def mostrar_detalle_dialog(analisis_id, filename):
                     </div>
                 """, unsafe_allow_html=True)
             
-            # Leer datos SIEMPRE fresco del archivo (no usar cache)
-            with open(progreso_path, "r", encoding="utf-8") as f:
-                progreso_data = json.load(f)
+            # Descargar solo los resultados cambiados desde la última lectura;
+            # si el backend no responde, leer el archivo de progreso completo
+            progreso_data = obtener_progreso_incremental(analisis_id)
+            if progreso_data is None:
+                with open(progreso_path, "r", encoding="utf-8") as f:
+                    progreso_data = json.load(f)
             
             # Detectar si hay reanalisis recientes y cambios
             fecha_modificacion = progreso_data.get('fecha_modificacion', '')
@@ -276,7 +282,15 @@ def mostrar_detalle_dialog(analisis_id, filename):
                 """, unsafe_allow_html=True)
             elif tipo_reanalisis and 'global' in tipo_reanalisis.lower():
                 st.info(f"🔄 **Reanalisis global detectado**: Todo el documento fue reprocesado. Última modificación: {fecha_modificacion}")
-            
+
+            clonado_de = progreso_data.get('clonado_de')
+            if isinstance(clonado_de, dict):
+                origen = clonado_de.get('nombre_analisis') or str(clonado_de.get('id_analisis', ''))[:8]
+                st.info(
+                    f"♻️ **Resultados reutilizados** del análisis idéntico '{origen}' "
+                    f"(completado el {clonado_de.get('fecha_finalizacion') or 'fecha desconocida'})"
+                )
+
             preguntas = progreso_data.get('preguntas_originales') or progreso_data.get('resultados', [])
             resultados = progreso_data.get('resultados', [])
             
@@ -337,6 +351,92 @@ def mostrar_detalle_dialog(analisis_id, filename):
             with col_stats6:
                 st.metric("⚪ Sin evaluar", riesgos['Sin evaluar'], delta=f"{riesgos['Sin evaluar']/total_preguntas*100:.0f}%" if total_preguntas > 0 else "0%")
             
+            # Consumo de tokens del análisis y preguntas más costosas
+            uso_tokens = progreso_data.get('uso_tokens') or {}
+            if uso_tokens.get('total'):
+                detalle_uso = (
+                    f"🔢 **Tokens:** {uso_tokens.get('entrada', 0):,} entrada · "
+                    f"{uso_tokens.get('salida', 0):,} salida · {uso_tokens.get('llamadas', 0)} llamadas al LLM"
+                )
+                if uso_tokens.get('cache'):
+                    detalle_uso += (
+                        f" · {uso_tokens['cache']:,} de entrada en caché del proveedor "
+                        f"({uso_tokens['cache'] / max(1, uso_tokens.get('entrada', 0)) * 100:.0f}%)"
+                    )
+                if progreso_data.get('presupuesto_tokens'):
+                    detalle_uso += f" · presupuesto {progreso_data['presupuesto_tokens']:,}"
+                if progreso_data.get('duracion_s'):
+                    detalle_uso += f" · {progreso_data['duracion_s'] / 60:.1f} min"
+                st.caption(detalle_uso)
+
+                costosas = sorted(
+                    ((r.get('uso_tokens') or {}).get('total', 0), i) for i, r in enumerate(resultados)
+                )[::-1][:3]
+                costosas = [(total, i) for total, i in costosas if total]
+                if costosas:
+                    st.caption("💸 Preguntas más costosas: " + ", ".join(
+                        f"P{i + 1} ({total / 1000:.1f}k tokens, {resultados[i].get('duracion_s', '?')} s)"
+                        for total, i in costosas
+                    ))
+            if progreso_data.get('estado') == 'pausado':
+                st.warning(
+                    f"⏸️ Análisis pausado al agotar su presupuesto de tokens "
+                    f"({progreso_data.get('progreso', 0)}/{total_preguntas} preguntas). "
+                    "Puedes reanudarlo desde 'En curso'."
+                )
+            elif progreso_data.get('degradado_por_presupuesto'):
+                degradado = progreso_data['degradado_por_presupuesto']
+                desde = degradado.get('desde_pregunta', 0)
+                detalle = (
+                    f" con los fragmentos más relevantes (hasta {degradado['max_tokens_contexto']} tokens)"
+                    if degradado.get('max_tokens_contexto') else ""
+                )
+                st.info(f"💸 Presupuesto agotado: desde la pregunta {desde + 1} se analizó en modo texto{detalle}")
+
+            # Preguntas cuyos documentos no cabían en la ventana del modelo
+            recortadas = {
+                estrategia: n
+                for estrategia, n in (progreso_data.get('estrategias_contexto') or {}).items()
+                if estrategia not in ('completo', 'adjuntos', 'adjuntos_paginas')
+            }
+            if recortadas:
+                st.info(
+                    "✂️ Documentos que no cabían en la ventana del modelo en "
+                    f"{sum(recortadas.values())} pregunta(s) ("
+                    + ", ".join(f"{estrategia}: {n}" for estrategia, n in recortadas.items()) + ")"
+                )
+
+            # Preguntas que el prefiltro léxico no envió al modelo principal
+            prefiltro = progreso_data.get('prefiltro') or {}
+            if prefiltro.get('sin_evaluar') or prefiltro.get('modelo_barato'):
+                st.info(
+                    f"🔎 Prefiltro de cláusulas: {prefiltro.get('sin_evaluar', 0)} pregunta(s) sin cláusulas "
+                    f"relacionadas respondidas como 'Sin evaluar' sin llamar al LLM, "
+                    f"{prefiltro.get('modelo_barato', 0)} con el modelo barato"
+                )
+
+            # Cascada de modelos: cuántas preguntas tuvo que repetir el deployment principal
+            cascada = progreso_data.get('cascada') or {}
+            if cascada.get('preguntas'):
+                niveles = cascada.get('niveles') or {}
+                st.caption(
+                    f"🪜 Cascada de modelos: {cascada.get('escaladas', 0)}/{cascada['preguntas']} pregunta(s) "
+                    f"escaladas ({cascada.get('tasa_escalado', 0) * 100:.0f}%) · "
+                    + " · ".join(
+                        f"{nombre} ({datos.get('modelo')}): {datos.get('llamadas', 0)} llamadas, "
+                        f"{datos.get('duracion_media_s', 0)} s de media, {datos.get('tokens', 0) / 1000:.1f}k tokens"
+                        for nombre, datos in niveles.items()
+                    )
+                )
+
+            # Reparto de las preguntas entre los backends del pool de proveedores
+            backends_llm = progreso_data.get('backends_llm') or {}
+            if len(backends_llm) > 1:
+                st.caption(
+                    "🔀 Backends del LLM: "
+                    + ", ".join(f"{nombre}: {n}" for nombre, n in sorted(backends_llm.items()))
+                )
+
             # Botón de debug para riesgos
             #if st.button("🔧 Debug Riesgos", help="Mostrar información detallada de evaluación de riesgos"):
             #    st.session_state['show_debug_riesgos'] = not st.session_state.get('show_debug_riesgos', False)
@@ -558,6 +658,17 @@ def mostrar_detalle_dialog(analisis_id, filename):
                     with tab1:
                         # Respuesta de forma compacta
                         st.write(respuesta)
+
+                        # Dónde están en el documento las cláusulas que cita la respuesta
+                        clausulas_citadas = respuesta_data.get('clausulas_citadas') or []
+                        if clausulas_citadas:
+                            st.caption("📍 " + " · ".join(
+                                f"{c['referencia']}"
+                                + (f" ({c['titulo']})" if c.get('titulo') else "")
+                                + (f": {c['documento']}, p. {c['pagina_inicio']}" if c.get('pagina_inicio') else "")
+                                + (f"-{c['pagina_fin']}" if c.get('pagina_fin') and c['pagina_fin'] != c.get('pagina_inicio') else "")
+                                for c in clausulas_citadas
+                            ))
                         
                         # Debug info como desplegable HTML (sin expander anidado)
                         pregunta_original = preg.get('Pregunta', 'N/A')
@@ -674,8 +785,9 @@ def mostrar_detalle_dialog(analisis_id, filename):
                                     
                                     # SEGUNDO: Enviar al backend
                                     with st.spinner("Enviando re-análisis al backend..."):
-                                        response = requests.post(
+                                        response = post_idempotente(
                                             f"{API_URL}/reanalisar_pregunta/{analisis_id}/{idx}",
+                                            payload,
                                             json=payload,
                                             timeout=10  # Timeout corto para envío
                                         )
@@ -796,8 +908,9 @@ def mostrar_detalle_dialog(analisis_id, filename):
                                     payload = {"preguntas": todas_preguntas}
                                     
                                     with st.spinner("Enviando re-análisis global al backend..."):
-                                        response = requests.post(
+                                        response = post_idempotente(
                                             f"{API_URL}/reanalisar_global/{analisis_id}",
+                                            payload,
                                             json=payload,
                                             timeout=15  # Timeout más largo para análisis global
                                         )
@@ -0,0 +1,41 @@
+import hashlib
+import json
+import time
+import uuid
+
+import requests
+import streamlit as st
+
+# Tras una respuesta correcta, la misma operación se sigue considerando un reintento durante
+# esta ventana (doble clic, rerun a mitad de petición); pasado ese tiempo es una operación nueva
+VENTANA_REINTENTO_S = 30
+
+
+def _estado_operacion(url, operacion):
+    huella = hashlib.sha256(
+        json.dumps([url, operacion], sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+    return f"idempotencia_{huella}"
+
+
+def post_idempotente(url, operacion, **kwargs):
+    """
+    ``requests.post`` con cabecera ``Idempotency-Key`` estable para ``operacion``.
+
+    ``operacion`` identifica lo que se pide (payload, hashes de archivos...): los reintentos
+    y clics repetidos reutilizan la misma clave y el backend devuelve el trabajo original
+    en lugar de lanzar otro.
+    """
+    clave_estado = _estado_operacion(url, operacion)
+    registro = st.session_state.get(clave_estado)
+    if registro is None or (
+        registro.get("completada") and time.time() - registro["completada"] > VENTANA_REINTENTO_S
+    ):
+        registro = {"clave": str(uuid.uuid4()), "completada": None}
+        st.session_state[clave_estado] = registro
+
+    headers = {**kwargs.pop("headers", {}), "Idempotency-Key": registro["clave"]}
+    response = requests.post(url, headers=headers, **kwargs)
+    if 200 <= response.status_code < 300 and not registro["completada"]:
+        registro["completada"] = time.time()
+    return response
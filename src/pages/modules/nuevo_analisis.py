@@ -1,11 +1,19 @@
 import streamlit as st
 import requests
+import hashlib
+import json
+import time
 from pathlib import Path
 from datetime import datetime
 from db.analisis_db import guardar_analisis
+from pages.modules.idempotencia import post_idempotente
 
 API_URL = "http://localhost:8000"  # Cambiar en producción
 
+# Subidas reanudables: tamaño de bloque y reintentos consecutivos antes de rendirse
+SUBIDA_BLOQUE_BYTES = 4 * 1024 * 1024
+SUBIDA_MAX_REINTENTOS = 5
+
 
 def _generar_nombre_default(nombres_archivos):
     if not nombres_archivos:
@@ -14,6 +22,221 @@ def _generar_nombre_default(nombres_archivos):
         base = Path(nombres_archivos[0]).stem or "Analisis"
     return f"{base}_{datetime.now().strftime('%Y%m%d')}"
 
+def _formatear_eta(eta):
+    """Texto corto con la posición en cola y el tiempo estimado que devuelve el backend."""
+    if not eta:
+        return ""
+    minutos = max(1, round(eta.get("eta_s", 0) / 60))
+    if eta.get("posicion_cola"):
+        return f"⏳ Queue position {eta['posicion_cola']} · ready in ~{minutos} min"
+    return f"⏳ Ready in ~{minutos} min"
+
+
+def _consultar_offset_subida(id_subida):
+    """Offset confirmado por el servidor, o None si la subida ya no existe."""
+    resp = requests.get(f"{API_URL}/subidas/{id_subida}", timeout=10)
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()["offset"]
+
+
+def _subir_archivo_reanudable(file_info, barra=None):
+    """
+    Sube un archivo por bloques al backend y devuelve el id de la subida.
+
+    El id se guarda en session_state por hash del contenido: si la subida falla (o el
+    usuario vuelve a pulsar el botón) se consulta el offset del servidor y se reanuda
+    desde ahí en lugar de empezar de cero.
+    """
+    datos = file_info["bytes"]
+    tamano = len(datos)
+    sha256 = file_info["sha256"]
+    clave = f"subida_reanudable_{sha256}"
+
+    id_subida = st.session_state.get(clave)
+    offset = _consultar_offset_subida(id_subida) if id_subida else None
+    if offset is None:
+        resp = requests.post(
+            f"{API_URL}/subidas",
+            json={"nombre": file_info["name"], "tamano": tamano, "sha256": sha256},
+            timeout=10,
+        )
+        resp.raise_for_status()
+        id_subida = resp.json()["id_subida"]
+        offset = 0
+        st.session_state[clave] = id_subida
+
+    fallos = 0
+    while offset < tamano:
+        bloque = datos[offset:offset + SUBIDA_BLOQUE_BYTES]
+        try:
+            resp = requests.put(
+                f"{API_URL}/subidas/{id_subida}",
+                params={"offset": offset},
+                data=bloque,
+                headers={"Content-Type": "application/octet-stream"},
+                timeout=30,
+            )
+            if resp.status_code == 409:
+                # El servidor tiene otra cantidad de bytes: continuar desde la suya
+                offset = resp.json()["offset"]
+                continue
+            resp.raise_for_status()
+            offset = resp.json()["offset"]
+            fallos = 0
+        except requests.exceptions.RequestException:
+            fallos += 1
+            if fallos > SUBIDA_MAX_REINTENTOS:
+                raise
+            time.sleep(min(2 ** fallos, 10))
+            try:
+                offset = _consultar_offset_subida(id_subida) or 0
+            except requests.exceptions.RequestException:
+                pass
+            continue
+
+        if barra is not None:
+            barra.progress(
+                min(1.0, offset / max(1, tamano)),
+                text=f"⬆️ {file_info['name']}: {offset / 1024 / 1024:.1f} / {tamano / 1024 / 1024:.1f} MB",
+            )
+
+    return id_subida
+
+
+def _consultar_blobs_existentes(processed_files):
+    """Hashes que el servidor ya tiene; si la consulta falla se suben todos los archivos."""
+    try:
+        resp = requests.post(
+            f"{API_URL}/blobs/consultar",
+            json={"sha256": [file_info["sha256"] for file_info in processed_files]},
+            timeout=10,
+        )
+        resp.raise_for_status()
+        return set(resp.json().get("existentes", []))
+    except requests.exceptions.RequestException:
+        return set()
+
+
+def _estimar_analisis(processed_files, use_pdf_attachments):
+    """
+    Pide al backend la estimación de tokens, coste y tiempo. Solo se envían los archivos
+    que el servidor no tiene; después quedan allí para el análisis.
+    """
+    existentes = _consultar_blobs_existentes(processed_files)
+    manifiesto = [{"nombre": f["name"], "sha256": f["sha256"]} for f in processed_files]
+    files = [
+        ("files", (f["name"], f["bytes"], f["mime"]))
+        for f in processed_files
+        if f["sha256"] not in existentes
+    ]
+    return requests.post(
+        f"{API_URL}/estimar",
+        data={"use_pdf_attachments": str(use_pdf_attachments).lower(), "manifiesto": json.dumps(manifiesto)},
+        files=files or None,
+        timeout=300,
+    )
+
+
+def _mostrar_estimacion(estimacion):
+    minutos = max(1, round(estimacion.get("total_s", 0) / 60))
+    minutos_p90 = max(minutos, round((estimacion.get("espera_cola_s", 0) + estimacion.get("analisis_p90_s", 0)) / 60))
+    coste = estimacion.get("coste_estimado")
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Pages", estimacion.get("total_paginas") or "-")
+    col2.metric("LLM calls", estimacion.get("llamadas_llm", 0))
+    col3.metric(
+        "Tokens (in / out)",
+        f"{estimacion.get('tokens_entrada', 0) / 1000:,.0f}k / {estimacion.get('tokens_salida', 0) / 1000:,.0f}k",
+    )
+    col4.metric("Time", f"~{minutos} min", help=f"Up to ~{minutos_p90} min (p90), queue included")
+    detalles = [f"Mode: {estimacion.get('modo')}", f"Model: {estimacion.get('modelo_llm')}"]
+    if coste is not None:
+        detalles.append(f"Estimated cost: {coste:.2f}")
+    tokens_original = sum(doc.get("tokens_original") or 0 for doc in estimacion.get("documentos", []))
+    tokens_texto = sum(doc.get("tokens_texto") or 0 for doc in estimacion.get("documentos", []))
+    if tokens_original > tokens_texto:
+        detalles.append(f"text cleanup saves {(1 - tokens_texto / tokens_original) * 100:.0f}% of document tokens")
+    omitidas = (estimacion.get("prefiltro") or {}).get("sin_evaluar")
+    if omitidas:
+        detalles.append(f"{omitidas} question(s) skipped by the clause prefilter")
+    cascada = estimacion.get("cascada")
+    if cascada:
+        origen = "measured" if cascada.get("tasa_medida") else "assumed"
+        detalles.append(
+            f"model cascade: {cascada.get('llamadas_barato', 0)} call(s) on {cascada.get('modelo_barato')}, "
+            f"~{cascada.get('llamadas_principal', 0)} re-asked on the main model "
+            f"({cascada.get('tasa_escalado', 0) * 100:.0f}% {origen} escalation rate)"
+        )
+    if estimacion.get("conteo_tokens") == "aproximado":
+        detalles.append("token counts approximated")
+    st.caption(" · ".join(detalles))
+
+
+def _iniciar_analisis_reanudable(
+    processed_files,
+    nombre_analisis,
+    use_pdf_attachments,
+    reutilizar_resultados=True,
+    presupuesto_tokens=None,
+):
+    """
+    Sube de forma reanudable solo los archivos que el servidor no tiene ya y pide al
+    backend que lance el análisis con todos ellos en orden.
+    """
+    existentes = _consultar_blobs_existentes(processed_files)
+    if existentes:
+        st.info(f"♻️ {len(existentes)} file(s) already on the server, skipping upload")
+
+    def _finalizar(existentes):
+        barra = st.progress(0.0, text="⬆️ Uploading files...")
+        documentos = []
+        for file_info in processed_files:
+            if file_info["sha256"] in existentes:
+                documentos.append({"nombre": file_info["name"], "sha256": file_info["sha256"]})
+            else:
+                documentos.append({
+                    "id_subida": _subir_archivo_reanudable(file_info, barra),
+                    "nombre": file_info["name"],
+                    "sha256": file_info["sha256"],
+                })
+        barra.empty()
+
+        # Misma operación = mismos documentos y opciones: un doble clic devuelve el análisis ya lanzado
+        operacion = {
+            "documentos": [[f["name"], f["sha256"]] for f in processed_files],
+            "analysis_name": nombre_analisis,
+            "use_pdf_attachments": use_pdf_attachments,
+            "reutilizar_resultados": reutilizar_resultados,
+            "presupuesto_tokens": presupuesto_tokens,
+        }
+        return post_idempotente(
+            f"{API_URL}/subidas/finalizar",
+            operacion,
+            json={
+                "documentos": documentos,
+                "analysis_name": nombre_analisis,
+                "use_pdf_attachments": use_pdf_attachments,
+                "reutilizar_resultados": reutilizar_resultados,
+                "presupuesto_tokens": presupuesto_tokens,
+            },
+            timeout=60,
+        )
+
+    response = _finalizar(existentes)
+    if response.status_code == 409 and "faltantes" in response.json():
+        # Algún documento desapareció del servidor entre la consulta y el envío: volver a
+        # consultar (lo ya subido en el intento anterior está en el almacén) y subir el resto
+        response = _finalizar(_consultar_blobs_existentes(processed_files))
+
+    if response.status_code == 200:
+        # Las subidas ya se consumieron: olvidar sus ids
+        for file_info in processed_files:
+            st.session_state.pop(f"subida_reanudable_{file_info['sha256']}", None)
+    return response
+
+
 def mostrar_nuevo_analisis():
     """Render the new analysis section."""
     st.markdown("""
@@ -118,6 +341,7 @@ def mostrar_nuevo_analisis():
                 "bytes": file_bytes,
                 "size_kb": file_size,
                 "mime": mime_type,
+                "sha256": hashlib.sha256(file_bytes).hexdigest(),
             })
 
             st.markdown(f"""
@@ -193,6 +417,53 @@ def mostrar_nuevo_analisis():
         )
         nombre_analisis = nombre_analisis_input.strip() or default_name
 
+        reutilizar_resultados = st.checkbox(
+            "♻️ Reutilizar resultados de un análisis idéntico",
+            value=True,
+            key="nuevo_analisis_reutilizar",
+            help=(
+                "Si ya se completó un análisis con los mismos documentos, preguntas, modelo y modo, "
+                "se copian sus resultados al instante. Desmárcalo para forzar un análisis nuevo."
+            ),
+        )
+
+        presupuesto_tokens = st.number_input(
+            "Token budget (optional)",
+            min_value=0,
+            value=None,
+            step=10000,
+            key="nuevo_analisis_presupuesto",
+            placeholder="Server default",
+            help=(
+                "Maximum prompt + completion tokens for this analysis (0 = no limit). When exceeded the "
+                "analysis is paused, or continues in text mode if the server is configured to degrade."
+            ),
+        )
+
+        use_pdf_attachments = bool(st.session_state.get("usar_adjuntos_pdf", False))
+        clave_estimacion = json.dumps(
+            [[f["sha256"] for f in processed_files], use_pdf_attachments]
+        )
+        if st.button(
+            "📊 Estimate Cost & Time",
+            key="estimate_analysis",
+            use_container_width=True,
+            help="Count pages and tokens locally and predict LLM calls, cost and duration before starting",
+        ):
+            with st.spinner("📊 Estimating..."):
+                try:
+                    response = _estimar_analisis(processed_files, use_pdf_attachments)
+                    if response.status_code == 200:
+                        st.session_state["nuevo_analisis_estimacion"] = (clave_estimacion, response.json())
+                    else:
+                        st.warning(f"⚠️ Could not estimate the analysis: {response.json().get('error', response.status_code)}")
+                except requests.exceptions.RequestException as e:
+                    st.warning(f"⚠️ Could not estimate the analysis: {e}")
+
+        estimacion_guardada = st.session_state.get("nuevo_analisis_estimacion")
+        if estimacion_guardada and estimacion_guardada[0] == clave_estimacion:
+            _mostrar_estimacion(estimacion_guardada[1])
+
         if st.button(
             "🚀 Start Combined Analysis",
             key="start_analysis_combined",
@@ -202,23 +473,12 @@ def mostrar_nuevo_analisis():
         ):
             with st.spinner("🔄 Processing files and sending them to the analysis service..."):
                 try:
-                    use_pdf_attachments = bool(st.session_state.get("usar_adjuntos_pdf", False))
-                    files_payload = [
-                        (
-                            "files",
-                            (file_info["name"], file_info["bytes"], file_info["mime"]),
-                        )
-                        for file_info in processed_files
-                    ]
-
-                    response = requests.post(
-                        f"{API_URL}/analizar",
-                        files=files_payload,
-                        data={
-                            "use_pdf_attachments": str(use_pdf_attachments).lower(),
-                            "analysis_name": nombre_analisis,
-                        },
-                        timeout=30,
+                    response = _iniciar_analisis_reanudable(
+                        processed_files,
+                        nombre_analisis,
+                        use_pdf_attachments,
+                        reutilizar_resultados,
+                        None if presupuesto_tokens is None else int(presupuesto_tokens),
                     )
 
                     if response.status_code == 200:
@@ -251,6 +511,11 @@ def mostrar_nuevo_analisis():
                                     margin: 0 0 0.4rem 0;
                                     font-size: 0.75rem;
                                 '>ID: <code>{analisis_id[:8]}...</code></p>
+                                <p style='
+                                    color: #1d4ed8;
+                                    margin: 0 0 0.4rem 0;
+                                    font-size: 0.75rem;
+                                '>{_formatear_eta(payload.get("eta"))}</p>
                                 <p style='
                                     color: #1d4ed8;
                                     margin: 0;
@@ -261,12 +526,19 @@ def mostrar_nuevo_analisis():
 
                         st.toast(f"✅ Análisis '{nombre_registrado}' iniciado\n🆔 ID: {analisis_id[:8]}...", icon="🚀")
 
+                    elif response.status_code == 429:
+                        espera = response.headers.get("Retry-After", "?")
+                        st.warning(
+                            f"🚦 The analysis queue is full. Your files are kept on the server; "
+                            f"try again in about {espera} s."
+                        )
+                        st.toast("🚦 Cola de análisis llena", icon="🚦")
                     else:
                         st.error("❌ Failed to start the analysis. Please try again.")
                         st.toast("❌ Error al procesar los archivos", icon="🚨")
                 except requests.exceptions.Timeout:
-                    st.error("⏱️ Request timed out. The files might be too large.")
-                    st.toast("⏱️ Timeout - files are too large", icon="⏱️")
+                    st.error("⏱️ Request timed out. Click start again to resume the upload where it stopped.")
+                    st.toast("⏱️ Timeout - the upload will resume on retry", icon="⏱️")
                 except Exception as e:
                     st.error(f"❌ Connection error: {str(e)}")
                     st.toast(f"❌ Error: {str(e)}", icon="🚨")
@@ -3,11 +3,21 @@ import requests
 import time
 import json
 import html
+import threading
 from pathlib import Path
 from db.analisis_db import obtener_analisis_pendientes, actualizar_estado_analisis
+from pages.modules.idempotencia import post_idempotente
 
 API_URL = "http://localhost:8000"  # Cambiar en producción
 
+# Intervalo de refresco del fragment de procesos en curso (el mismo que antes: 3s). Con el
+# canal SSE el refresco no consulta al backend: solo pide /estado de lo que cambió
+REFRESCO_PROCESOS_S = 3
+# Timeout de lectura del canal SSE: mayor que el keepalive del backend (2s por defecto)
+TIMEOUT_LECTURA_SSE_S = 15
+# Espera antes de reconectar el canal SSE tras un corte
+REINTENTO_SSE_S = 5
+
 # Utilidades de caché para evitar lecturas repetidas del JSON de progreso cada 3s
 def _progreso_path(analisis_id: str) -> Path:
     return Path(__file__).parent.parent.parent.parent / "fastapi_backend" / "progreso" / f"{analisis_id}.json"
@@ -26,6 +36,72 @@ def _leer_progreso_cached(analisis_id: str, mtime: float):
     with open(p, "r", encoding="utf-8") as f:
         return json.load(f)
 
+class _LectorEventos:
+    """Lector en segundo plano del canal SSE ``/eventos?ids=`` de los análisis en curso.
+
+    Mantiene la conexión abierta y guarda la última versión notificada de cada análisis;
+    el fragment solo lee ese diccionario, sin peticiones. Si el canal no está disponible
+    (p. ej. detrás de un proxy que no deja pasar SSE) ``conectado`` es False y se consulta
+    ``/estado`` de cada análisis.
+    """
+
+    def __init__(self, ids: list):
+        self.ids = tuple(sorted(ids))
+        self.versiones = {}
+        self.conectado = False
+        self._parar = threading.Event()
+        self._respuesta = None
+        threading.Thread(target=self._leer, daemon=True).start()
+
+    def parar(self):
+        self._parar.set()
+        respuesta = self._respuesta
+        if respuesta is not None:
+            respuesta.close()
+
+    def _leer(self):
+        while not self._parar.is_set():
+            try:
+                with requests.get(
+                    f"{API_URL}/eventos",
+                    params={"ids": ",".join(self.ids)},
+                    stream=True,
+                    timeout=(2, TIMEOUT_LECTURA_SSE_S),
+                ) as resp:
+                    self._respuesta = resp
+                    if resp.status_code == 200:
+                        self._consumir(resp)
+            except Exception:
+                pass
+            self.conectado = False
+            self._parar.wait(REINTENTO_SSE_S)
+
+    def _consumir(self, resp):
+        tipo_evento = None
+        for linea in resp.iter_lines(decode_unicode=True):
+            if self._parar.is_set():
+                return
+            if linea.startswith("event:"):
+                tipo_evento = linea.split(":", 1)[1].strip()
+            elif linea.startswith("data:"):
+                datos = json.loads(linea.split(":", 1)[1])
+                if tipo_evento == "conectado":
+                    self.versiones.update(datos.get("versiones", {}))
+                    self.conectado = True
+                elif datos.get("id") in self.ids and datos.get("version") is not None:
+                    self.versiones[datos["id"]] = datos["version"]
+
+def _lector_eventos(ids: list):
+    """Lector SSE de la sesión para ``ids``; se reemplaza cuando cambian los análisis en curso."""
+    lector = st.session_state.get("procesos_lector_eventos")
+    if lector is not None and lector.ids == tuple(sorted(ids)):
+        return lector
+    if lector is not None:
+        lector.parar()
+    lector = _LectorEventos(ids) if ids else None
+    st.session_state["procesos_lector_eventos"] = lector
+    return lector
+
 def verificar_backend_disponible():
     """Verifica si el backend está disponible"""
     try:
@@ -35,6 +111,46 @@ def verificar_backend_disponible():
     except:
         return False
 
+def _tiempo_promedio_medido():
+    """Mediana de la duración de los análisis completados según ``/metricas/tiempos``."""
+    try:
+        response = requests.get(f"{API_URL}/metricas/tiempos", timeout=1)
+        if response.status_code == 200:
+            serie = response.json().get("series", {}).get("analisis|*") or {}
+            if serie.get("muestras"):
+                return f"{serie['p50'] / 60:.1f}min"
+    except Exception:
+        pass
+    return "Sin datos"
+
+def _mostrar_reanudar(analisis_id, tokens_usados, presupuesto):
+    """Controles para reanudar un análisis pausado por presupuesto con un límite nuevo."""
+    nuevo_presupuesto = st.number_input(
+        "Nuevo presupuesto de tokens (0 = sin límite)",
+        min_value=0,
+        value=int(max(tokens_usados * 2, (presupuesto or 0) * 2)),
+        step=10000,
+        key=f"presupuesto_{analisis_id}",
+    )
+    if st.button("▶️ Reanudar", key=f"reanudar_{analisis_id}", use_container_width=True):
+        if nuevo_presupuesto and nuevo_presupuesto <= tokens_usados:
+            st.warning(f"⚠️ El presupuesto debe superar los {tokens_usados:,} tokens ya usados")
+            return
+        try:
+            resp = post_idempotente(
+                f"{API_URL}/reanudar/{analisis_id}",
+                {"analisis_id": analisis_id, "presupuesto_tokens": nuevo_presupuesto},
+                json={"presupuesto_tokens": nuevo_presupuesto},
+                timeout=10,
+            )
+            if resp.status_code == 200:
+                st.toast("▶️ Análisis reanudado", icon="▶️")
+                st.rerun(scope="fragment")
+            else:
+                st.error(f"❌ No se pudo reanudar: {resp.json().get('error', resp.status_code)}")
+        except requests.exceptions.RequestException as e:
+            st.error(f"❌ Error de conexión: {e}")
+
 def cancelar_proceso(analisis_id):
     """Cancela un proceso de análisis"""
     try:
@@ -156,13 +272,18 @@ def dialogo_cancelar_proceso(analisis_id, filename):
             st.toast("📌 Proceso mantenido", icon="📌")
             st.rerun(scope="app")
 
-@st.fragment(run_every=3)  # Auto-actualiza cada 3 segundos
+@st.fragment(run_every=REFRESCO_PROCESOS_S)  # Auto-actualiza; con SSE solo consulta /estado si algo cambió
 def mostrar_procesos_en_tiempo_real():
     """Fragment que se actualiza automáticamente para mostrar procesos en curso"""
     
     # Indicador de actualización automática compacto
     current_time = time.time()
     ultima_actualizacion = time.strftime("%H:%M:%S", time.localtime(current_time))
+    # Obtener procesos pendientes
+    pendientes = obtener_analisis_pendientes()
+    hay_procesos_activos = False
+    lector = _lector_eventos([row[0] for row in pendientes])
+    etiqueta_canal = "SSE" if lector is not None and lector.conectado else f"{REFRESCO_PROCESOS_S}s"
     
     st.markdown(f"""
         <div style="
@@ -192,17 +313,19 @@ def mostrar_procesos_en_tiempo_real():
                 font-size: 0.65rem;
                 font-weight: 600;
             ">
-                3s
+                {etiqueta_canal}
             </span>
         </div>
     """, unsafe_allow_html=True)
     
-    # Obtener procesos pendientes
-    pendientes = obtener_analisis_pendientes()
-    hay_procesos_activos = False
-    
     # Debug: mostrar cuántos procesos pendientes hay (solo en desarrollo)
     # print(f"DEBUG: {len(pendientes)} procesos pendientes encontrados")
+
+    # Con el canal SSE conectado solo se pide /estado de los análisis cuya versión ha
+    # cambiado desde la última lectura; el resto reutiliza el estado ya leído de la API
+    estados_api = st.session_state.setdefault("procesos_estados_api", {})
+    versiones_leidas = st.session_state.setdefault("procesos_versiones_leidas", {})
+    versiones_sse = dict(lector.versiones) if lector is not None and lector.conectado else None
     
     if pendientes:
         for idx, row in enumerate(pendientes):
@@ -213,10 +336,20 @@ def mostrar_procesos_en_tiempo_real():
             api_detalle = None
             api_data = {}
             try:
-                # Reducir timeout y evitar saturar el backend
-                resp = requests.get(f"{API_URL}/estado/{analisis_id}", timeout=1)
-                if resp.status_code == 200:
-                    data = resp.json()
+                version_sse = versiones_sse.get(analisis_id) if versiones_sse is not None else None
+                if (
+                    version_sse is not None
+                    and analisis_id in estados_api
+                    and versiones_leidas.get(analisis_id) == version_sse
+                ):
+                    data = estados_api[analisis_id]
+                else:
+                    # Reducir timeout y evitar saturar el backend
+                    resp = requests.get(f"{API_URL}/estado/{analisis_id}", timeout=1)
+                    data = resp.json() if resp.status_code == 200 else None
+                    estados_api[analisis_id] = data
+                    versiones_leidas[analisis_id] = version_sse
+                if data:
                     api_estado = data.get("estado")
                     api_detalle = data.get("detalle", "")
                     api_data = data
@@ -302,6 +435,10 @@ def mostrar_procesos_en_tiempo_real():
                 color_estado = "#16a34a"
                 icono_estado = "✅"
                 texto_estado = "Completado"
+            elif estado_archivo == "pausado":
+                color_estado = "#dc2626"
+                icono_estado = "⏸️"
+                texto_estado = "Pausado (presupuesto)"
             elif estado_archivo == "reanalisis_en_progreso" and tipo_reanalisis.startswith('individual_pregunta_'):
                 # Estado especial para reanalisis individual
                 color_estado = "#f59e0b"
@@ -575,8 +712,20 @@ def mostrar_procesos_en_tiempo_real():
                             # Número de completadas es el progreso actual
                             num_completadas = progreso_actual
                             
-                            # Estimación de tiempo restante
-                            if num_completadas > 0:
+                            # Estimación de tiempo restante: la del backend (cola + tiempos medidos, con su p90)
+                            eta_backend = api_data.get("eta") if isinstance(api_data, dict) else None
+                            if eta_backend:
+                                tiempo_restante = int(eta_backend.get("eta_s") or 0)
+                                if tiempo_restante < 60:
+                                    tiempo_str = f"{tiempo_restante}s"
+                                else:
+                                    tiempo_str = f"{tiempo_restante // 60}m {tiempo_restante % 60}s"
+                                eta_p90 = int(eta_backend.get("eta_p90_s") or 0)
+                                if eta_p90 > tiempo_restante:
+                                    tiempo_str += f" (≤{max(1, round(eta_p90 / 60))}m)"
+                                if eta_backend.get("posicion_cola"):
+                                    tiempo_str = f"#{eta_backend['posicion_cola']} en cola · {tiempo_str}"
+                            elif num_completadas > 0:
                                 tiempo_por_pregunta = 30  # segundos estimados por pregunta
                                 preguntas_restantes = total - num_completadas
                                 tiempo_restante = preguntas_restantes * tiempo_por_pregunta
@@ -616,8 +765,19 @@ def mostrar_procesos_en_tiempo_real():
                             
                             # Barra de progreso nativa de Streamlit
                             st.progress(progreso_pct / 100, text=f"{progreso_pct}% completado")
+
+                            uso_tokens = progreso_data.get('uso_tokens') or {}
+                            presupuesto = progreso_data.get('presupuesto_tokens')
+                            if uso_tokens.get('total') or presupuesto:
+                                texto_uso = f"🔢 {uso_tokens.get('total', 0):,} tokens"
+                                if presupuesto:
+                                    texto_uso += f" de {presupuesto:,}"
+                                st.caption(texto_uso)
                             
                             st.markdown("</div>", unsafe_allow_html=True)
+
+                            if estado_archivo == 'pausado':
+                                _mostrar_reanudar(analisis_id, uso_tokens.get('total', 0), presupuesto)
                         
                     except Exception:
                         st.markdown("""
@@ -728,7 +888,7 @@ def mostrar_procesos():
         '>
             <span style='color: #ea580c; font-size: 0.8rem;'>⏳</span>
             <span style='color: #9a3412; font-size: 0.75rem; font-weight: 600;'>Seguimiento en Tiempo Real</span>
-            <span style='color: #c2410c; font-size: 0.65rem; margin-left: auto;'>⚡ Auto 3s</span>
+            <span style='color: #c2410c; font-size: 0.65rem; margin-left: auto;'>⚡ En vivo</span>
         </div>
     """, unsafe_allow_html=True)
     
@@ -766,21 +926,8 @@ def mostrar_procesos():
         """)
         completados_hoy = c.fetchone()[0]
         
-        # Calcular tiempo promedio dinámico
-        c.execute("""
-            SELECT COUNT(*) FROM analisis 
-            WHERE estado = '✅ Completed' AND date(created_at) >= date('now', '-7 days')
-        """)
-        completados_semana = c.fetchone()[0]
-        
-        # Estimación dinámica del tiempo promedio
-        if completados_semana > 0:
-            base_time = 5.0
-            factor_optimizacion = max(0.5, 1.0 - (completados_semana * 0.05))
-            tiempo_estimado = base_time * factor_optimizacion
-            tiempo_promedio = f"{tiempo_estimado:.1f}min"
-        else:
-            tiempo_promedio = "~5min"
+        # Tiempo medio real de los análisis completados (mediana medida por el backend)
+        tiempo_promedio = _tiempo_promedio_medido()
         
         conn.close()
         
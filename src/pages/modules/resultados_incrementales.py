@@ -0,0 +1,60 @@
+import streamlit as st
+import requests
+
+API_URL = "http://localhost:8000"  # Cambiar en producción
+
+
+def _clave_cache(analisis_id: str) -> str:
+    return f"resultados_incrementales_{analisis_id}"
+
+
+def descartar_cache_resultados(analisis_id: str):
+    """Olvida la copia local para forzar una descarga completa en la próxima lectura."""
+    st.session_state.pop(_clave_cache(analisis_id), None)
+
+
+def obtener_progreso_incremental(analisis_id: str, timeout: float = 2):
+    """
+    Devuelve el progreso completo del análisis descargando solo los resultados
+    nuevos o modificados desde la última lectura y fusionándolos con la copia en
+    ``st.session_state``. Devuelve None si el backend no está disponible para que
+    el llamador recurra a leer el archivo de progreso.
+    """
+    clave = _clave_cache(analisis_id)
+    cache = st.session_state.get(clave)
+
+    params = {}
+    if cache:
+        params["desde_version"] = cache["version"]
+
+    try:
+        resp = requests.get(f"{API_URL}/resultados/{analisis_id}", params=params, timeout=timeout)
+        if resp.status_code != 200:
+            return None
+        delta = resp.json()
+    except Exception:
+        return None
+
+    if cache and not delta.get("completo"):
+        resultados = list(cache["resultados"])
+    else:
+        resultados = []
+
+    total = delta.get("total_resultados", 0)
+    resultados = resultados[:total] + [None] * max(0, total - len(resultados))
+
+    for item in delta.get("resultados", []):
+        indice = item.pop("indice", None)
+        if isinstance(indice, int) and 0 <= indice < total:
+            resultados[indice] = item
+
+    if any(r is None for r in resultados):
+        # Copia local inconsistente: se descarta y la próxima lectura será completa
+        descartar_cache_resultados(analisis_id)
+        return None
+
+    st.session_state[clave] = {"version": delta.get("version", 0), "resultados": resultados}
+
+    progreso = dict(delta.get("progreso") or {})
+    progreso["resultados"] = list(resultados)
+    return progreso